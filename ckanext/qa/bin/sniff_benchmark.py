@@ -0,0 +1,436 @@
+'''
+Benchmark of sniffing file formats.
+
+By default it builds a synthetic corpus of files (deterministically, so that
+the results are comparable between runs and machines) - large CSVs, deep
+JSON, a zip with a huge number of members, a big XLS (if xlwt is installed),
+pathological text etc. It then times sniff_file_format end to end and each of
+the detectors on each file, reporting latency percentiles, and the peak RSS
+of sniffing each file (in a separate process).
+
+With --text-formats it times run_text_detectors, which pre-filters the
+detectors of the formats a text buffer could not be in, against the chain of
+detectors it replaced, which ran is_json, is_csv, is_psv,
+is_xml_but_without_declaration and is_ttl in turn. It uses the text files
+among the test fixtures (or the files given) and checks that both give the
+same result for each of them.
+
+The same corpus and timings are used by ckanext/qa/tests/test_sniff_benchmark.py
+when pytest-benchmark is installed.
+'''
+
+from optparse import OptionParser
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+import timeit
+import zipfile
+
+# NB put no CKAN imports here, or logging breaks
+
+FIXTURE_DATA_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'tests',
+                                'data')
+CORPUS_SEED = 20120401
+
+
+def detector_chain(buf):
+    '''The detectors that run_text_detectors replaced, as they were run for a
+    TXT file.'''
+    from ckanext.qa import sniff_format
+    if sniff_format.is_json(buf):
+        return {'format': 'JSON'}
+    elif sniff_format.is_csv(buf):
+        return {'format': 'CSV'}
+    elif sniff_format.is_psv(buf):
+        return {'format': 'PSV'}
+    elif sniff_format.is_xml_but_without_declaration(buf):
+        return sniff_format.get_xml_variant_without_xml_declaration(buf)
+    elif sniff_format.is_ttl(buf):
+        return {'format': 'TTL'}
+
+
+def read_buffer(filepath, num_chars=10000):
+    with io.open(filepath, 'r', encoding='ISO-8859-1', newline=None) as f:
+        return f.read(num_chars)
+
+
+def is_text_file(filepath):
+    '''Returns whether magic says the file is text, rather than binary.'''
+    import magic
+    with open(filepath, 'rb') as f:
+        encoding = magic.Magic(mime_encoding=True).from_buffer(
+            f.read(1024 * 1024))
+    return encoding != 'binary'
+
+
+def benchmark_text_formats(filepaths, repeat=5, number=20):
+    '''Returns a list of (filename, format, chain_seconds, prefiltered_seconds,
+    same_result), with the best of the repeats for each.'''
+    from ckanext.qa import sniff_format
+    results = []
+    for filepath in filepaths:
+        buf = read_buffer(filepath)
+        chain_format = detector_chain(buf)
+        prefiltered_format = sniff_format.run_text_detectors(
+            buf, sniff_format.TXT_FORMATS)
+        # the repeats of each are interleaved, so that both see the same
+        # conditions on the machine
+        chain_times = []
+        prefiltered_times = []
+        for _ in range(repeat):
+            chain_times.append(timeit.timeit(lambda: detector_chain(buf),
+                                             number=number))
+            prefiltered_times.append(timeit.timeit(
+                lambda: sniff_format.run_text_detectors(buf), number=number))
+        results.append((os.path.basename(filepath),
+                        (prefiltered_format or {}).get('format'),
+                        min(chain_times) / number,
+                        min(prefiltered_times) / number,
+                        chain_format == prefiltered_format))
+    return results
+
+
+# Synthetic corpus
+
+def build_corpus(corpus_dir, scale=1.0):
+    '''Writes the benchmark corpus files to corpus_dir (if they are not
+    there already) and returns their filepaths. The files are the same every
+    time for a given scale.
+
+    :param scale: multiplies the size of the files
+    '''
+    if not os.path.exists(corpus_dir):
+        os.makedirs(corpus_dir)
+    filepaths = []
+    for filename, writer in CORPUS_FILES:
+        filepath = os.path.join(corpus_dir, filename)
+        if not os.path.exists(filepath):
+            partial_filepath = filepath + '.partial'
+            # each file has its own seed, so they do not depend on each other
+            if writer(partial_filepath, scale,
+                      random.Random('%s-%s' % (CORPUS_SEED, filename))) \
+                    is False:
+                # not possible here e.g. missing optional library
+                if os.path.exists(partial_filepath):
+                    os.remove(partial_filepath)
+                continue
+            os.rename(partial_filepath, filepath)
+        filepaths.append(filepath)
+    return filepaths
+
+
+def _csv_row(rand):
+    return u'%s,%s,%.2f,"%s"\n' % (
+        rand.randint(1, 10 ** 6),
+        u'2012-%02d-%02d' % (rand.randint(1, 12), rand.randint(1, 28)),
+        rand.random() * 10000,
+        rand.choice([u'Acme Ltd', u'Widgets plc', u'Smith, J', u'Council']))
+
+
+def write_large_csv(filepath, scale, rand):
+    with io.open(filepath, 'w', encoding='utf8', newline='') as f:
+        f.write(u'Id,Date,Amount,Supplier\n')
+        for _ in range(int(400000 * scale)):
+            f.write(_csv_row(rand))
+
+
+def write_deep_json(filepath, scale, rand):
+    depth = int(2000 * scale)
+    with io.open(filepath, 'w', encoding='utf8') as f:
+        f.write(u'{"data": ' + u'[{"a": ' * depth + u'1' + u'}]' * depth)
+        f.write(u', "rows": [')
+        for i in range(int(50000 * scale)):
+            f.write(u'%s{"id": %d, "value": %.3f}' % (
+                u', ' if i else u'', i, rand.random()))
+        f.write(u']}\n')
+
+
+def write_huge_zip(filepath, scale, rand):
+    with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_STORED) as zip_:
+        for i in range(int(100000 * scale)):
+            zip_.writestr('data/%06d.%s' % (i, rand.choice(['csv', 'csv', 'txt'])),
+                          b'')
+
+
+def write_zip_of_csvs(filepath, scale, rand):
+    with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED) as zip_:
+        for i in range(10):
+            zip_.writestr('%d.csv' % i, u''.join(
+                _csv_row(rand) for _ in range(int(20000 * scale)))
+                .encode('utf8'))
+
+
+def write_big_xls(filepath, scale, rand):
+    try:
+        import xlwt
+    except ImportError:
+        print('xlwt is not installed - skipping the XLS corpus file')
+        return False
+    workbook = xlwt.Workbook()
+    for sheet_index in range(3):
+        sheet = workbook.add_sheet('Sheet %d' % sheet_index)
+        for row in range(min(int(20000 * scale), 65535)):
+            for col in range(10):
+                sheet.write(row, col, rand.random())
+    workbook.save(filepath)
+
+
+def write_pathological_text(filepath, scale, rand):
+    # unbalanced quotes and semi-colons, which the old turtle_regex
+    # backtracked on, and long quoted lines
+    with io.open(filepath, 'w', encoding='utf8') as f:
+        for _ in range(int(200 * scale)):
+            f.write(u'; "a' * 2500 + u'\n')
+            f.write(u'"' + u'x' * 10000 + u'\n')
+            f.write(u'<a> "x ' * 1000 + u'\n')
+
+
+def write_html_landing_page(filepath, scale, rand):
+    with io.open(filepath, 'w', encoding='utf8') as f:
+        f.write(u'<!DOCTYPE html>\n<html><head><title>Dataset</title>\n')
+        f.write(u'<meta name="description" content="A landing page">\n' * 50)
+        f.write(u'</head>\n<body>\n')
+        for i in range(int(20000 * scale)):
+            f.write(u'<p class="row">Row %d <a href="/data/%d.csv">download'
+                    u'</a></p>\n' % (i, rand.randint(1, 10 ** 6)))
+        f.write(u'</body></html>\n')
+
+
+def write_turtle(filepath, scale, rand):
+    with io.open(filepath, 'w', encoding='utf8') as f:
+        for i in range(int(50000 * scale)):
+            f.write(u'<http://example.com/s/%d> <http://example.com/p> '
+                    u'"%s"@en ;\n    <http://example.com/q> %d .\n'
+                    % (i, rand.random(), i))
+
+
+CORPUS_FILES = [
+    ('large.csv', write_large_csv),
+    ('deep.json', write_deep_json),
+    ('huge.zip', write_huge_zip),
+    ('csvs.zip', write_zip_of_csvs),
+    ('big.xls', write_big_xls),
+    ('pathological.txt', write_pathological_text),
+    ('landing-page.html', write_html_landing_page),
+    ('triples.txt', write_turtle),
+]
+
+
+# Timing
+
+def get_detectors():
+    '''Returns a list of (name, function(filepath)) for each detector, as
+    they are called by sniff_file_format.'''
+    from ckanext.qa import sniff_format as sf
+    return [
+        ('is_json', lambda filepath: sf.is_json(read_buffer(filepath))),
+        ('is_csv', lambda filepath: sf.is_csv(read_buffer(filepath))),
+        ('is_excel', sf.is_excel),
+        ('get_zipped_format', sf.get_zipped_format),
+        ('run_bsd_file', sf.run_bsd_file),
+        ('is_ttl', lambda filepath: sf.is_ttl(read_buffer(filepath))),
+        ('has_rdfa', lambda filepath: sf.has_rdfa(
+            read_buffer(filepath, sf.RDFA_MAX_SIZE))),
+    ]
+
+
+def percentile(sorted_values, percent):
+    '''Returns the nearest-rank percentile of the sorted values.'''
+    index = max(int(round(percent / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def time_function(function, args, repeat):
+    '''Calls function(*args) repeat times and returns the sorted seconds
+    that each call took.'''
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        function(*args)
+        times.append(time.time() - start)
+    return sorted(times)
+
+
+def _peak_rss_child(queue, function, args):
+    # at module level, so that it can be pickled for a spawned process
+    import resource
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    function(*args)
+    queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+
+
+def peak_rss_kb(function, args):
+    '''Runs function(*args) in a child process and returns by how much it
+    increased the peak RSS (in KB), or None if that is not possible here.
+    The function must be picklable (e.g. defined at module level), in case
+    the process is spawned rather than forked.'''
+    try:
+        import resource  # noqa: F401
+        import multiprocessing
+    except ImportError:
+        return None
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_peak_rss_child,
+                                      args=(queue, function, args))
+    process.start()
+    result = None
+    deadline = time.time() + 600
+    while time.time() < deadline:
+        # checked before waiting, so that a result sent just before the
+        # child exited is still picked up
+        alive = process.is_alive()
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Exception:
+            if not alive:
+                # it died, e.g. the function could not be unpickled
+                break
+    process.join()
+    return result
+
+
+def benchmark_corpus(filepaths, repeat=5, detectors=True, rss=True):
+    '''Returns a list of dicts, one per (file, detector), with keys:
+    filename, detector ('sniff_file_format' for end to end), result, p50, p90,
+    p99, max (seconds) and peak_rss_kb (end to end only).'''
+    from ckanext.qa.sniff_format import sniff_file_format
+    results = []
+    for filepath in filepaths:
+        filename = os.path.basename(filepath)
+        functions = [('sniff_file_format', sniff_file_format)]
+        if detectors:
+            functions += get_detectors()
+        for name, function in functions:
+            result = function(filepath)
+            times = time_function(function, (filepath,), repeat)
+            results.append({
+                'filename': filename,
+                'detector': name,
+                'result': result,
+                'p50': percentile(times, 50),
+                'p90': percentile(times, 90),
+                'p99': percentile(times, 99),
+                'max': times[-1],
+                'peak_rss_kb': peak_rss_kb(function, (filepath,))
+                if rss and name == 'sniff_file_format' else None,
+            })
+    return results
+
+
+def set_default_config():
+    from ckan.plugins.toolkit import config
+    if not config.get('ckan.resource_formats'):
+        import ckan.config
+        config['ckan.resource_formats'] = os.path.join(
+            os.path.dirname(ckan.config.__file__), 'resource_formats.json')
+
+
+def run_text_formats(options, filepaths):
+    if not filepaths:
+        # the detectors are only run on text, so binary fixtures (XLS, zips
+        # etc.) would only give meaningless formats and timings
+        filepaths = [
+            filepath for filepath in sorted(
+                os.path.join(FIXTURE_DATA_DIR, filename)
+                for filename in os.listdir(FIXTURE_DATA_DIR))
+            if is_text_file(filepath)]
+    results = benchmark_text_formats(filepaths, repeat=options.repeat,
+                                     number=options.number)
+    print('%-50s %-10s %10s %14s' % ('File', 'TXT format', 'Chain ms',
+                                     'Pre-filter ms'))
+    for filename, format_, chain_time, prefiltered_time, same in results:
+        print('%-50s %-10s %10.3f %14.3f%s' % (
+            filename[:50], format_, chain_time * 1000,
+            prefiltered_time * 1000, '' if same else '  DIFFERENT RESULT'))
+    total_chain = sum(result[2] for result in results)
+    total_prefiltered = sum(result[3] for result in results)
+    print('Total: chain %.1fms pre-filter %.1fms (%.1fx faster)' % (
+        total_chain * 1000, total_prefiltered * 1000,
+        total_chain / total_prefiltered))
+    differences = [result[0] for result in results if not result[4]]
+    if differences:
+        print('Results differ for: %s' % ', '.join(differences))
+    return not differences
+
+
+def run_corpus(options, filepaths):
+    corpus_dir = options.corpus_dir
+    temporary_corpus_dir = not corpus_dir and not filepaths
+    if temporary_corpus_dir:
+        corpus_dir = tempfile.mkdtemp(prefix='qa-sniff-corpus-')
+    try:
+        if not filepaths:
+            start = time.time()
+            filepaths = build_corpus(corpus_dir, options.scale)
+            print('Corpus built in %.1fs: %s' % (time.time() - start,
+                                                 corpus_dir))
+        results = benchmark_corpus(filepaths, repeat=options.repeat,
+                                   detectors=not options.end_to_end_only,
+                                   rss=not options.no_rss)
+    finally:
+        if temporary_corpus_dir:
+            shutil.rmtree(corpus_dir)
+    if options.json:
+        for result in results:
+            result['result'] = repr(result['result'])
+        print(json.dumps(results, indent=2))
+        return True
+    print('%-20s %-18s %9s %9s %9s %9s %10s  %s' % (
+        'File', 'Detector', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+        'Peak RSS', 'Result'))
+    for result in results:
+        print('%-20s %-18s %9.2f %9.2f %9.2f %9.2f %10s  %s' % (
+            result['filename'][:20], result['detector'],
+            result['p50'] * 1000, result['p90'] * 1000, result['p99'] * 1000,
+            result['max'] * 1000,
+            '%dKB' % result['peak_rss_kb']
+            if result['peak_rss_kb'] is not None else '',
+            result['result']))
+    return True
+
+
+if __name__ == '__main__':
+    usage = """Benchmark of sniffing file formats
+
+    usage: %prog [options] [filepath ...]
+
+    Give filepaths to benchmark them instead of the synthetic corpus (or the
+    test fixtures, with --text-formats).
+    """
+    parser = OptionParser(usage=usage)
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=5,
+                      help='timing repeats')
+    parser.add_option('-n', '--number', dest='number', type='int', default=20,
+                      help='calls per timing repeat (--text-formats only)')
+    parser.add_option('-t', '--text-formats', dest='text_formats',
+                      action='store_true',
+                      help='compare run_text_detectors with the detector chain '
+                      'it replaced')
+    parser.add_option('-d', '--corpus-dir', dest='corpus_dir',
+                      help='build the corpus here and keep it, to reuse '
+                      '(default is a temporary directory)')
+    parser.add_option('-s', '--scale', dest='scale', type='float', default=1.0,
+                      help='multiplies the size of the corpus files')
+    parser.add_option('-e', '--end-to-end-only', dest='end_to_end_only',
+                      action='store_true',
+                      help='only time sniff_file_format, not each detector')
+    parser.add_option('--no-rss', dest='no_rss', action='store_true',
+                      help='do not measure the peak RSS')
+    parser.add_option('--json', dest='json', action='store_true',
+                      help='print the results as JSON')
+    (options, args) = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+    set_default_config()
+    if options.text_formats:
+        success = run_text_formats(options, args)
+    else:
+        success = run_corpus(options, args)
+    if not success:
+        raise SystemExit(1)
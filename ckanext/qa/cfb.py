@@ -0,0 +1,220 @@
+'''
+Minimal reader for the Microsoft Compound File Binary (CFB, also known as
+OLE2) container, used by .xls, .doc and .ppt files.
+
+It reads just enough to list the directory entries and read small streams
+such as SummaryInformation, directly from a buffer (e.g. a memory map), so
+that sniffing does not need to run the "file" command or parse the whole
+document.
+'''
+import struct
+
+SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+# special sector numbers
+MAXREGSECT = 0xFFFFFFFA
+ENDOFCHAIN = 0xFFFFFFFE
+FREESECT = 0xFFFFFFFF
+
+# directory entry object types
+STREAM = 2
+ROOT_STORAGE = 5
+
+# property set types and ids
+VT_I2 = 0x02
+VT_LPSTR = 0x1E
+VT_LPWSTR = 0x1F
+PIDSI_CODEPAGE = 0x01
+PIDSI_APPNAME = 0x12
+
+
+class CFBError(Exception):
+    pass
+
+
+def is_cfb(buf):
+    return buf[:8] == SIGNATURE
+
+
+class DirectoryEntry(object):
+    def __init__(self, name, type_, start_sector, size):
+        self.name = name
+        self.type = type_
+        self.start_sector = start_sector
+        self.size = size
+
+    def __repr__(self):
+        return '<DirectoryEntry %r type=%s size=%s>' % (self.name, self.type,
+                                                        self.size)
+
+
+class CompoundFile(object):
+    '''A CFB container in a buffer - anything that supports len() and
+    slicing to bytes, such as bytes or an mmap.
+
+    Raises CFBError if the buffer is not a valid (or is a truncated) CFB.
+    '''
+    def __init__(self, buf):
+        self.buf = buf
+        if len(buf) < 512 or not is_cfb(buf):
+            raise CFBError('Not a compound file')
+        (sector_shift, mini_sector_shift) = struct.unpack('<HH', buf[30:34])
+        if sector_shift not in (9, 12) or mini_sector_shift != 6:
+            raise CFBError('Unexpected sector size')
+        self.sector_size = 1 << sector_shift
+        self.mini_sector_size = 1 << mini_sector_shift
+        (self.num_fat_sectors, self.first_directory_sector) = \
+            struct.unpack('<II', buf[44:52])
+        (self.mini_stream_cutoff, self.first_mini_fat_sector,
+         self.num_mini_fat_sectors, self.first_difat_sector,
+         self.num_difat_sectors) = struct.unpack('<IIIII', buf[56:76])
+        # any chain longer than the number of sectors in the buffer must loop
+        self.max_sectors = len(buf) // self.sector_size
+        self.fat = self._read_fat()
+        self.entries = self._read_directory()
+        self._mini_fat = None
+        self._mini_stream = None
+
+    def _sector(self, sector):
+        if sector > MAXREGSECT:
+            raise CFBError('Invalid sector number %s' % sector)
+        offset = (sector + 1) * self.sector_size
+        data = self.buf[offset:offset + self.sector_size]
+        if len(data) != self.sector_size:
+            raise CFBError('Sector %s is beyond the end of the file' % sector)
+        return data
+
+    def _read_fat(self):
+        fat_sectors = list(struct.unpack('<109I', self.buf[76:512]))
+        difat_sector = self.first_difat_sector
+        ints_per_sector = self.sector_size // 4
+        for _ in range(self.num_difat_sectors):
+            if difat_sector > MAXREGSECT:
+                break
+            difat = struct.unpack('<%dI' % ints_per_sector,
+                                  self._sector(difat_sector))
+            fat_sectors.extend(difat[:-1])
+            difat_sector = difat[-1]
+        fat = []
+        for sector in fat_sectors[:self.num_fat_sectors]:
+            if sector > MAXREGSECT:
+                continue
+            fat.extend(struct.unpack('<%dI' % ints_per_sector,
+                                     self._sector(sector)))
+        return fat
+
+    def _chain(self, start_sector, fat, max_sectors):
+        sector = start_sector
+        steps = 0
+        while sector != ENDOFCHAIN:
+            if sector >= len(fat) or steps > max_sectors:
+                raise CFBError('Broken sector chain')
+            yield sector
+            sector = fat[sector]
+            steps += 1
+
+    def _read_chain(self, start_sector, size=None):
+        data = []
+        length = 0
+        for sector in self._chain(start_sector, self.fat, self.max_sectors):
+            data.append(self._sector(sector))
+            length += self.sector_size
+            if size is not None and length >= size:
+                break
+        data = b''.join(data)
+        return data if size is None else data[:size]
+
+    def _read_directory(self):
+        data = self._read_chain(self.first_directory_sector)
+        entries = []
+        for offset in range(0, len(data) - 127, 128):
+            entry = data[offset:offset + 128]
+            name_length, type_ = struct.unpack('<HB', entry[64:67])
+            if not type_:
+                continue
+            name = entry[:max(name_length - 2, 0)].decode('utf-16-le',
+                                                          'replace')
+            start_sector, size = struct.unpack('<IQ', entry[116:128])
+            if self.sector_size == 512:
+                # version 3 files only use the low 32 bits of the size
+                size &= 0xFFFFFFFF
+            entries.append(DirectoryEntry(name, type_, start_sector, size))
+        if not entries or entries[0].type != ROOT_STORAGE:
+            raise CFBError('No root directory entry')
+        return entries
+
+    def find(self, *names):
+        '''Returns the first stream with one of the given names (compared
+        case-insensitively), or None.'''
+        names = [name.lower() for name in names]
+        for entry in self.entries:
+            if entry.type == STREAM and entry.name.lower() in names:
+                return entry
+
+    def read_stream(self, entry, max_size=None):
+        '''Returns the contents of a stream, or its first max_size bytes.'''
+        size = entry.size if max_size is None else min(entry.size, max_size)
+        if entry.size < self.mini_stream_cutoff:
+            return self._read_mini_stream(entry.start_sector, size)
+        return self._read_chain(entry.start_sector, size)
+
+    def _read_mini_stream(self, start_sector, size):
+        if self._mini_stream is None:
+            root = self.entries[0]
+            self._mini_stream = self._read_chain(root.start_sector, root.size)
+            mini_fat = self._read_chain(self.first_mini_fat_sector) \
+                if self.num_mini_fat_sectors else b''
+            self._mini_fat = struct.unpack('<%dI' % (len(mini_fat) // 4),
+                                           mini_fat)
+        data = []
+        for sector in self._chain(start_sector, self._mini_fat,
+                                  len(self._mini_stream)):
+            offset = sector * self.mini_sector_size
+            data.append(self._mini_stream[offset:offset + self.mini_sector_size])
+            if len(data) * self.mini_sector_size >= size:
+                break
+        return b''.join(data)[:size]
+
+
+def get_creating_application(compound_file):
+    '''Returns the "Name of Creating Application" from the SummaryInformation
+    stream, or None (including if the stream is corrupt).'''
+    entry = compound_file.find(u'\x05SummaryInformation')
+    if not entry:
+        return None
+    try:
+        data = compound_file.read_stream(entry, max_size=64 * 1024)
+        return _get_property(data, PIDSI_APPNAME)
+    except (CFBError, struct.error, UnicodeDecodeError, LookupError):
+        return None
+
+
+def _get_property(data, property_id):
+    '''Returns the value of a string property in the first section of a
+    property set stream.'''
+    (section_offset,) = struct.unpack('<I', data[44:48])
+    (num_properties,) = struct.unpack(
+        '<I', data[section_offset + 4:section_offset + 8])
+    offsets = {}
+    for i in range(min(num_properties, 1000)):
+        start = section_offset + 8 + i * 8
+        id_, offset = struct.unpack('<II', data[start:start + 8])
+        offsets[id_] = section_offset + offset
+    if property_id not in offsets:
+        return None
+    codepage = 1252
+    if PIDSI_CODEPAGE in offsets:
+        offset = offsets[PIDSI_CODEPAGE]
+        type_, value = struct.unpack('<Ih', data[offset:offset + 6])
+        if type_ == VT_I2:
+            codepage = value & 0xFFFF
+    offset = offsets[property_id]
+    type_, length = struct.unpack('<II', data[offset:offset + 8])
+    if type_ == VT_LPSTR:
+        value = data[offset + 8:offset + 8 + length]
+        encoding = 'utf-8' if codepage == 65001 else 'cp%d' % codepage
+        return value.split(b'\x00')[0].decode(encoding)
+    if type_ == VT_LPWSTR:
+        value = data[offset + 8:offset + 8 + length * 2]
+        return value.decode('utf-16-le').split(u'\x00')[0]
+    return None
@@ -16,16 +16,46 @@ def qa():
 
     Usage::
 
-        ckan -c <path to CKAN config file> qa init
+        ckan -c <path to CKAN config file> qa init [--dedupe]
            - Creates the database tables that QA expects for storing
-           results
+           results. Option: --dedupe to delete all but the latest of a
+           resource's QA rows, if an old database has several
 
         ckan -c <path to CKAN config file> qa [options] update [dataset/group name/id]
            - QA analysis on all resources in a given dataset, or on all
-           datasets if no dataset given
+           datasets if no dataset given. Options: --batch-size N to QA N
+           datasets in each job and save their results together, --force
+           to QA resources even if they have not changed since last time
 
-        ckan -c <path to CKAN config file> qa sniff {filepath}
-           - Opens the file and determines its type by the contents
+        ckan -c <path to CKAN config file> qa sniff [options] {filepath}
+           - Opens the file and determines its type by the contents.
+             Options: --recursive to sniff the files in directories,
+             --workers N to sniff in N processes, --output jsonl to print
+             a JSON record per file
+
+        ckan -c <path to CKAN config file> qa sniff-cache stats
+           - Summarize the cache of sniffed file formats
+
+        ckan -c <path to CKAN config file> qa sniff-cache prune [options]
+           - Evict old and least recently used entries from the sniff cache
+
+        ckan -c <path to CKAN config file> qa sniff-cache warm [dataset name/id]
+           - Sniff archived files that are not in the sniff cache yet
+
+        ckan -c <path to CKAN config file> qa rescore-formats [--dry-run]
+           - Re-score QA results from the formats already found, after
+             changing the format scores, and reindex the datasets that
+             changed, without sniffing the files again
+
+        ckan -c <path to CKAN config file> qa reindex-flush
+           - Reindex the datasets waiting in the reindex buffer now
+
+        ckan -c <path to CKAN config file> qa quarantine list [--all]
+           - List the archived files that are not being sniffed because
+             sniffing them failed
+
+        ckan -c <path to CKAN config file> qa quarantine release {key or resource id}|--all
+           - Release quarantined files, so they are sniffed next time
 
         ckan -c <path to CKAN config file> qa view [dataset name/id]
            - See package score information
@@ -48,25 +78,102 @@ def qa():
 
 
 @qa.command()
-def init():
-    utils.init_db()
+@click.option('--dedupe', is_flag=True,
+              help='Delete all but the latest of any duplicate QA rows of '
+              'a resource, so that qa.resource_id can be made unique')
+def init(dedupe):
+    utils.init_db(dedupe=dedupe)
 
 
 @qa.command()
 @click.argument('ids', nargs=-1)
 @click.option('-q', '--queue', help='Send to a particular queue')
-def update(ids, queue):
-    utils.update(ids, queue)
+@click.option('-b', '--batch-size', type=int, default=1,
+              help='Number of datasets to QA in each job')
+@click.option('-f', '--force', is_flag=True,
+              help='QA resources even if they have not changed')
+def update(ids, queue, batch_size, force):
+    utils.update(ids, queue, batch_size=batch_size, force=force)
 
 
 @qa.command()
 @click.argument('filepaths', nargs=-1)
-def sniff(filepaths):
+@click.option('-w', '--workers', type=int, default=1,
+              help='Number of processes to sniff files in parallel')
+@click.option('-r', '--recursive', is_flag=True,
+              help='Sniff all the files in the given directories')
+@click.option('-o', '--output', type=click.Choice(['text', 'jsonl']),
+              default='text',
+              help='Output format - jsonl gives a JSON record per file')
+def sniff(filepaths, workers, recursive, output):
     if len(filepaths) < 1:
         print('Not enough arguments', filepaths)
         sys.exit(1)
 
-    utils.sniff(filepaths)
+    utils.sniff(filepaths, workers=workers, recursive=recursive,
+                output=output)
+
+
+@qa.group('sniff-cache')
+def sniff_cache():
+    """
+    Inspect, prune and warm the cache of sniffed file formats
+    """
+
+
+@sniff_cache.command('stats')
+def sniff_cache_stats():
+    utils.sniff_cache_stats()
+
+
+@sniff_cache.command('prune')
+@click.option('--max-age-days', type=int,
+              help='Evict entries not used for this many days')
+@click.option('--max-entries', type=int,
+              help='Evict the least recently used entries beyond this number')
+def sniff_cache_prune(max_age_days, max_entries):
+    utils.sniff_cache_prune(max_age_days, max_entries)
+
+
+@sniff_cache.command('warm')
+@click.argument('ids', nargs=-1)
+def sniff_cache_warm(ids):
+    utils.sniff_cache_warm(ids)
+
+
+@qa.command('rescore-formats')
+@click.option('-n', '--dry-run', is_flag=True,
+              help='Only report what would be re-scored')
+def rescore_formats(dry_run):
+    utils.rescore_formats(dry_run)
+
+
+@qa.command('reindex-flush')
+def reindex_flush():
+    utils.reindex_flush()
+
+
+@qa.group()
+def quarantine():
+    """
+    List and release archived files that are not sniffed because sniffing
+    them failed
+    """
+
+
+@quarantine.command('list')
+@click.option('-a', '--all', 'include_expired', is_flag=True,
+              help='Include files whose backoff has passed')
+def quarantine_list(include_expired):
+    utils.quarantine_list(include_expired)
+
+
+@quarantine.command('release')
+@click.argument('ids', nargs=-1)
+@click.option('-a', '--all', 'release_all', is_flag=True,
+              help='Release all the quarantined files')
+def quarantine_release(ids, release_all):
+    utils.quarantine_release(ids, release_all)
 
 
 @qa.command()
@@ -1,7 +1,9 @@
 import logging
 import sys
 import ckan.plugins as p
-from ckanext.qa.utils import init_db, update, sniff, view, clean, migrate1
+from ckanext.qa.utils import init_db, update, sniff, view, clean, migrate1, \
+    sniff_cache_stats, sniff_cache_prune, sniff_cache_warm, quarantine_list, \
+    quarantine_release, rescore_formats, reindex_flush
 
 REQUESTS_HEADER = {'content-type': 'application/json',
                    'User-Agent': 'ckanext-qa commands'}
@@ -17,16 +19,46 @@ class QACommand(p.toolkit.CkanCommand):
 
     Usage::
 
-        paster qa init
+        paster qa init [--dedupe]
            - Creates the database tables that QA expects for storing
-           results
+           results. Option: --dedupe to delete all but the latest of a
+           resource's QA rows, if an old database has several
 
         paster qa [options] update [dataset/group name/id]
            - QA analysis on all resources in a given dataset, or on all
-           datasets if no dataset given
+           datasets if no dataset given. Options: --batch-size N to QA N
+           datasets in each job and save their results together, --force
+           to QA resources even if they have not changed since last time
 
-        paster qa sniff {filepath}
-           - Opens the file and determines its type by the contents
+        paster qa [options] sniff {filepath}
+           - Opens the file and determines its type by the contents.
+             Options: --recursive to sniff the files in directories,
+             --workers N to sniff in N processes, --output jsonl to print
+             a JSON record per file
+
+        paster qa sniff-cache stats
+           - Summarize the cache of sniffed file formats
+
+        paster qa sniff-cache prune
+           - Evict old and least recently used entries from the sniff cache
+
+        paster qa sniff-cache warm [dataset name/id]
+           - Sniff archived files that are not in the sniff cache yet
+
+        paster qa rescore-formats [--dry-run]
+           - Re-score QA results from the formats already found, after
+             changing the format scores, and reindex the datasets that
+             changed, without sniffing the files again
+
+        paster qa reindex-flush
+           - Reindex the datasets waiting in the reindex buffer now
+
+        paster qa quarantine list [--all]
+           - List the archived files that are not being sniffed because
+             sniffing them failed
+
+        paster qa quarantine release {key or resource id}|--all
+           - Release quarantined files, so they are sniffed next time
 
         paster qa view [dataset name/id]
            - See package score information
@@ -57,6 +89,46 @@ class QACommand(p.toolkit.CkanCommand):
                                action='store',
                                dest='queue',
                                help='Send to a particular queue')
+        self.parser.add_option('-b', '--batch-size',
+                               action='store', type='int',
+                               dest='batch_size', default=1,
+                               help='Number of datasets to QA in each job')
+        self.parser.add_option('-f', '--force',
+                               action='store_true',
+                               dest='force', default=False,
+                               help='QA resources even if they have not '
+                               'changed')
+        self.parser.add_option('-w', '--workers',
+                               action='store', type='int',
+                               dest='workers', default=1,
+                               help='Number of processes to sniff files in '
+                               'parallel')
+        self.parser.add_option('-r', '--recursive',
+                               action='store_true',
+                               dest='recursive', default=False,
+                               help='Sniff all the files in the given '
+                               'directories')
+        self.parser.add_option('-o', '--output',
+                               action='store', type='choice',
+                               choices=['text', 'jsonl'],
+                               dest='output', default='text',
+                               help='Output format - jsonl gives a JSON '
+                               'record per file')
+        self.parser.add_option('-a', '--all',
+                               action='store_true',
+                               dest='all', default=False,
+                               help='quarantine: list/release all the '
+                               'entries')
+        self.parser.add_option('-n', '--dry-run',
+                               action='store_true',
+                               dest='dry_run', default=False,
+                               help='rescore-formats: only report what '
+                               'would be re-scored')
+        self.parser.add_option('--dedupe',
+                               action='store_true',
+                               dest='dedupe', default=False,
+                               help='init: delete all but the latest of any '
+                               'duplicate QA rows of a resource')
 
     def command(self):
         """
@@ -77,6 +149,14 @@ class QACommand(p.toolkit.CkanCommand):
             self.update()
         elif cmd == 'sniff':
             self.sniff()
+        elif cmd == 'sniff-cache':
+            self.sniff_cache()
+        elif cmd == 'quarantine':
+            self.quarantine()
+        elif cmd == 'rescore-formats':
+            rescore_formats(dry_run=self.options.dry_run)
+        elif cmd == 'reindex-flush':
+            reindex_flush()
         elif cmd == 'view':
             if len(self.args) == 2:
                 self.view(self.args[1])
@@ -92,18 +172,46 @@ class QACommand(p.toolkit.CkanCommand):
             self.log.error('Command "%s" not recognized' % (cmd,))
 
     def init_db(self):
-        init_db()
+        init_db(dedupe=self.options.dedupe)
 
     def update(self):
         if len(self.args) > 1:
             ids = self.args[1:]
-        update(ids, self.options.queue)
+        update(ids, self.options.queue, batch_size=self.options.batch_size,
+               force=self.options.force)
 
     def sniff(self):
         if len(self.args) < 2:
             print('Not enough arguments', self.args)
             sys.exit(1)
-        sniff(self.args[1:])
+        sniff(self.args[1:], workers=self.options.workers,
+              recursive=self.options.recursive, output=self.options.output)
+
+    def sniff_cache(self):
+        if len(self.args) < 2:
+            print('Not enough arguments', self.args)
+            sys.exit(1)
+        subcmd = self.args[1]
+        if subcmd == 'stats':
+            sniff_cache_stats()
+        elif subcmd == 'prune':
+            sniff_cache_prune()
+        elif subcmd == 'warm':
+            sniff_cache_warm(self.args[2:])
+        else:
+            self.log.error('Command "sniff-cache %s" not recognized' % (subcmd,))
+
+    def quarantine(self):
+        if len(self.args) < 2:
+            print('Not enough arguments', self.args)
+            sys.exit(1)
+        subcmd = self.args[1]
+        if subcmd == 'list':
+            quarantine_list(include_expired=self.options.all)
+        elif subcmd == 'release':
+            quarantine_release(self.args[2:], release_all=self.options.all)
+        else:
+            self.log.error('Command "quarantine %s" not recognized' % (subcmd,))
 
     def view(self, package_ref=None):
         view(package_ref)
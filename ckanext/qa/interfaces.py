@@ -0,0 +1,38 @@
+from ckan.plugins.interfaces import Interface
+
+
+class IQASniffer(Interface):
+    '''
+    Adds file format detectors to the sniffing of archived files, without
+    changing ckanext-qa.
+    '''
+
+    def get_sniff_detectors(self):
+        '''
+        Returns detectors to register in the sniff pipeline.
+
+        A detector with the same name as a built-in one (see
+        ckanext.qa.sniff_format.builtin_detectors) replaces it.
+
+        :returns: list of ckanext.qa.sniff_format.Detector
+        '''
+        return []
+
+
+class IQATimings(Interface):
+    '''
+    Receives the time spent in each stage of QA jobs, when qa.timing is
+    enabled, e.g. to send them to a metrics system.
+    '''
+
+    def qa_timings(self, timings):
+        '''
+        Called at the end of each QA job (for a package, and for each of its
+        resources).
+
+        :param timings: dict with keys: job (e.g. 'update_package' or
+            'resource'), info (e.g. {'package_id': ...}), total (seconds),
+            failed (bool) and stages, which is a dict of stage name to
+            {'count': ..., 'seconds': ...}
+        '''
+        pass
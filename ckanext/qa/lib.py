@@ -1,18 +1,29 @@
 import os
 import json
+import hashlib
 import re
 import logging
+import threading
+import time
+from collections import namedtuple
+
+from ckan.plugins import toolkit
 from ckan.plugins.toolkit import config
 
 from ckan import plugins as p
-from ckanext.qa.tasks import update_package, update
+from ckanext.qa import pending_jobs
+from ckanext.qa import timing
+from ckanext.qa.tasks import update_package, update, update_packages
 
 log = logging.getLogger(__name__)
 
-_RESOURCE_FORMAT_SCORES = None
+_FORMAT_INDEX = None
+_format_index_lock = threading.Lock()
+# how often to check whether the JSON files have changed (seconds)
+DEFAULT_FORMAT_INDEX_CHECK_INTERVAL = 10
 
 
-def compat_enqueue(name, fn, queue, args=None):
+def compat_enqueue(name, fn, queue, args=None, kwargs=None):
 
     u'''
     Enqueue a background job using Celery or RQ.
@@ -20,12 +31,13 @@ def compat_enqueue(name, fn, queue, args=None):
     try:
         # Try to use RQ
         from ckan.plugins.toolkit import enqueue_job
-        enqueue_job(fn, args=args, queue=queue)
+        enqueue_job(fn, args=args, kwargs=kwargs, queue=queue)
     except ImportError:
         # Fallback to Celery
         import uuid
         from ckan.lib.celery_app import celery
-        celery.send_task(name, args=args + [queue], task_id=str(uuid.uuid4()))
+        celery.send_task(name, args=args + [queue], kwargs=kwargs,
+                         task_id=str(uuid.uuid4()))
 
 
 def resource_format_scores():
@@ -41,37 +53,310 @@ def resource_format_scores():
     Fuller description of the fields are described in
     `ckan/config/resource_formats.json`.
     '''
-    global _RESOURCE_FORMAT_SCORES
-    if not _RESOURCE_FORMAT_SCORES:
-        _RESOURCE_FORMAT_SCORES = {}
-        json_filepath = config.get('qa.resource_format_openness_scores_json')
-        if not json_filepath:
-            json_filepath = os.path.join(
-                os.path.dirname(os.path.realpath(__file__)),
-                'resource_format_openness_scores.json'
-            )
-        with open(json_filepath) as format_file:
-            try:
-                file_resource_formats = json.loads(format_file.read())
-            except ValueError as e:
-                # includes simplejson.decoder.JSONDecodeError
-                raise ValueError('Invalid JSON syntax in %s: %s' %
-                                 (json_filepath, e))
-
-            for format_line in file_resource_formats:
-                if format_line[0] == '_comment':
-                    continue
-                format_, score = format_line
-                if not isinstance(score, int):
-                    raise ValueError('Score must be integer in %s: %s: %r'
-                                     % json_filepath, format_, score)
-                if format_ in _RESOURCE_FORMAT_SCORES:
+    return get_format_index().scores
+
+
+def get_score_table():
+    '''Returns the ScoreTable that is currently in use.'''
+    return get_format_index().score_table
+
+
+def _resource_format_scores_filepath():
+    json_filepath = config.get('qa.resource_format_openness_scores_json')
+    if not json_filepath:
+        json_filepath = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)),
+            'resource_format_openness_scores.json'
+        )
+    return json_filepath
+
+
+def _resource_formats_filepath():
+    json_filepath = config.get('ckan.resource_formats')
+    if not json_filepath:
+        import ckan.config
+        json_filepath = os.path.join(
+            os.path.dirname(os.path.realpath(ckan.config.__file__)),
+            'resource_formats.json'
+        )
+    return json_filepath
+
+
+def _load_json(json_filepath):
+    with open(json_filepath, 'rb') as format_file:
+        try:
+            return json.loads(format_file.read().decode('utf-8'))
+        except ValueError as e:
+            # includes simplejson.decoder.JSONDecodeError
+            raise ValueError('Invalid JSON syntax in %s: %s' %
+                             (json_filepath, e))
+
+
+def load_resource_format_scores(json_filepath):
+    '''Reads the openness score of each format from the JSON file.'''
+    resource_format_scores_ = {}
+    for format_line in _load_json(json_filepath):
+        if format_line[0] == '_comment':
+            continue
+        format_, score = format_line
+        if not isinstance(score, int):
+            raise ValueError('Score must be integer in %s: %s: %r'
+                             % (json_filepath, format_, score))
+        if format_ in resource_format_scores_:
+            raise ValueError('Duplicate resource format '
+                             'identifier in %s: %s' %
+                             (json_filepath, format_))
+        resource_format_scores_[format_] = score
+    return resource_format_scores_
+
+
+def load_resource_formats(json_filepath):
+    '''Reads ckan's resource formats JSON file, in the same way as
+    ckan.lib.helpers.resource_formats().
+
+    This duplicates ckan's parsing because resource_formats() caches the file
+    for the life of the process, so it cannot be used to pick up changes to
+    it. test_lib.test_load_resource_formats_matches_ckan checks that the two
+    agree - keep them in step.'''
+    resource_formats = {}
+    for format_line in _load_json(json_filepath):
+        if format_line[0] == '_comment':
+            continue
+        line = [format_line[2], format_line[0], format_line[1]]
+        alternatives = format_line[3] if len(format_line) == 4 else []
+        for item in line + alternatives:
+            if item:
+                item = item.lower()
+                if item in resource_formats \
+                        and resource_formats[item] != line:
                     raise ValueError('Duplicate resource format '
                                      'identifier in %s: %s' %
-                                     (json_filepath, format_))
-                _RESOURCE_FORMAT_SCORES[format_] = score
+                                     (json_filepath, item))
+                resource_formats[item] = line
+    return resource_formats
 
-    return _RESOURCE_FORMAT_SCORES
+
+class ScoreTable(object):
+    '''The openness score of each format, as configured in
+    qa.resource_format_openness_scores_json, with a version that identifies
+    the scores, so that QA results record which scores they were given by.
+
+    It is not changed once it is built - when the file changes, a new one is
+    built instead.
+    '''
+    __slots__ = ('scores', 'version', 'filepath')
+
+    def __init__(self, scores, filepath=None):
+        self.scores = scores
+        self.filepath = filepath
+        # depends only on the scores, not on the file's layout or location
+        self.version = hashlib.sha1(json.dumps(
+            sorted(scores.items())).encode('utf-8')).hexdigest()[:12]
+
+    @classmethod
+    def load(cls, json_filepath):
+        return cls(load_resource_format_scores(json_filepath), json_filepath)
+
+    def get(self, format_):
+        return self.scores.get(format_)
+
+    def __repr__(self):
+        return '<ScoreTable %s %s formats>' % (self.version, len(self.scores))
+
+
+# What a format alias refers to. score is None if it is not configured.
+FormatInfo = namedtuple('FormatInfo', ['format', 'score', 'mimetype', 'title'])
+
+
+class FormatIndex(object):
+    '''Maps every alias of a resource format - its name, extension, mime
+    type, title, the alternative names in ckan's resource_formats.json, and
+    the munged form of each - straight to a FormatInfo, so that finding a
+    format and its openness score is a single lookup.
+
+    It is not changed once it is built - get_format_index() replaces it
+    instead, so it can be shared between threads.
+    '''
+    __slots__ = ('_index', 'score_table', 'scores', 'signature')
+
+    def __init__(self, resource_formats, score_table, signature=None):
+        '''
+        :param resource_formats: as returned by load_resource_formats
+        :param score_table: ScoreTable
+        :param signature: identifies the versions of the JSON files it was
+                          built from
+        '''
+        self.score_table = score_table
+        self.scores = scores = score_table.scores
+        self.signature = signature
+        index = {}
+        for alias, (mimetype, format_, title) in resource_formats.items():
+            index[alias] = FormatInfo(format_, scores.get(format_), mimetype,
+                                      title)
+        # munged aliases never override real ones
+        for alias in list(index.keys()):
+            munged_alias = munge_format_to_be_canonical(alias)
+            if munged_alias and munged_alias not in index:
+                index[munged_alias] = index[alias]
+        self._index = index
+
+    def get(self, alias):
+        '''Returns the FormatInfo for an alias (compared case-insensitively),
+        or None.'''
+        if not alias:
+            return None
+        return self._index.get(alias.lower())
+
+    def lookup(self, name):
+        '''Returns the FormatInfo for a name given by a user e.g. in a
+        resource's format field, trying its munged form too, or None.'''
+        if not name:
+            return None
+        return self._index.get(name.lower()) or \
+            self._index.get(munge_format_to_be_canonical(name))
+
+    def __contains__(self, alias):
+        return self.get(alias) is not None
+
+    def __len__(self):
+        return len(self._index)
+
+
+def _format_index_signature():
+    signature = []
+    for json_filepath in (_resource_formats_filepath(),
+                          _resource_format_scores_filepath()):
+        stat = os.stat(json_filepath)
+        signature.append((json_filepath, stat.st_mtime, stat.st_size))
+    return tuple(signature)
+
+
+def get_format_index():
+    '''Returns the FormatIndex. It is built the first time it is needed in
+    each process, and rebuilt when either JSON file changes, which is
+    checked at most every qa.format_index.check_interval seconds.'''
+    global _FORMAT_INDEX
+    index = _FORMAT_INDEX
+    now = time.time()
+    if index is not None and now < index[1]:
+        return index[0]
+    with _format_index_lock:
+        index = _FORMAT_INDEX
+        if index is not None and now < index[1]:
+            return index[0]
+        check_interval = toolkit.asint(config.get(
+            'qa.format_index.check_interval',
+            DEFAULT_FORMAT_INDEX_CHECK_INTERVAL))
+        signature = _format_index_signature()
+        if index is None or index[0].signature != signature:
+            format_index = FormatIndex(
+                load_resource_formats(signature[0][0]),
+                ScoreTable.load(signature[1][0]),
+                signature)
+            if index is not None:
+                log.info('Resource format JSON changed - rebuilt the format '
+                         'index. Score table version: %s (was %s)',
+                         format_index.score_table.version,
+                         index[0].score_table.version)
+        else:
+            format_index = index[0]
+        # the index and when to next check the files
+        _FORMAT_INDEX = (format_index, now + check_interval)
+        return format_index
+
+
+def reset_format_index():
+    '''Forgets the FormatIndex, so that it is rebuilt next time, e.g. after
+    the config has changed.'''
+    global _FORMAT_INDEX
+    _FORMAT_INDEX = None
+
+
+def rescore_formats(dry_run=False):
+    '''Re-scores QA results from the format that they stored, using the
+    current score table, in bulk SQL rather than sniffing the files again.
+    Only results with a positive score and a format in the table are
+    re-scored - a score of 0 is for a broken link or a licence that is not
+    open, which the format does not change - and not those whose format could
+    not be understood, which score 1 and just keep the format stored before.
+    Results whose score is unchanged, including those scoring 0, just have
+    their score_table_version updated, so that `qa update` does not score
+    them again.
+
+    It does not reindex the datasets - see reindex_packages.
+
+    :returns: tuple (changes, package_ids) where changes is a dict of
+              (format, old score, new score): number of resources and
+              package_ids is the set of datasets with a changed score
+    '''
+    import datetime
+    from sqlalchemy import case, func, or_
+    from ckan import model
+    from ckan.common import _
+    from ckanext.qa.model import QA
+
+    score_table = get_score_table()
+    scores = score_table.scores
+    if not scores:
+        return {}, set()
+    new_score = case(scores, value=QA.format)
+    reasons = dict(
+        (format_, _('Format "%s" receives score: %s.') % (format_, score))
+        for format_, score in scores.items())
+    # the reason given by tasks.resource_score when the format is not known
+    not_understood = _('Could not understand the file format, therefore '
+                       'score is 1.')
+    is_rescorable = QA.format.in_(list(scores.keys())) & \
+        (QA.openness_score > 0) & \
+        or_(QA.openness_score_reason == None,  # noqa: E711
+            ~QA.openness_score_reason.contains(not_understood))
+    rescorable = model.Session.query(QA).filter(is_rescorable)
+    changed = rescorable.filter(QA.openness_score != new_score)
+
+    changes = dict(
+        ((format_, old_score, scores[format_]), count)
+        for format_, old_score, count in
+        changed.with_entities(QA.format, QA.openness_score, func.count(QA.id))
+        .group_by(QA.format, QA.openness_score))
+    package_ids = set(
+        package_id for (package_id,) in
+        changed.with_entities(QA.package_id).distinct())
+    if dry_run:
+        return changes, package_ids
+
+    now = datetime.datetime.now()
+    changed.update({
+        QA.openness_score: new_score,
+        QA.openness_score_reason: case(reasons, value=QA.format),
+        QA.score_table_version: score_table.version,
+        QA.updated: now,
+    }, synchronize_session=False)
+    model.Session.query(QA).filter(
+        is_rescorable | (QA.openness_score == 0)
+    ).filter(
+        (QA.score_table_version != score_table.version) |
+        (QA.score_table_version == None)  # noqa: E711
+    ).update({QA.score_table_version: score_table.version},
+             synchronize_session=False)
+    model.Session.commit()
+    log.info('Re-scored %i resources in %i datasets with score table %s',
+             sum(changes.values()), len(package_ids), score_table.version)
+    return changes, package_ids
+
+
+def reindex_packages(package_ids):
+    '''Updates the search index for the given datasets, committing to solr
+    once at the end. Datasets that no longer exist are skipped.'''
+    from ckan.lib.search.index import PackageSearchIndex
+    from ckanext.qa.tasks import _update_search_index
+    for package_id in package_ids:
+        try:
+            _update_search_index(package_id, defer_commit=True)
+        except toolkit.ObjectNotFound:
+            log.warning('Not reindexing dataset %s - not found', package_id)
+    if package_ids:
+        with timing.stage('update_search_index'):
+            PackageSearchIndex().commit()
 
 
 def munge_format_to_be_canonical(format_name):
@@ -84,13 +369,45 @@ def munge_format_to_be_canonical(format_name):
     return re.sub('[^a-z/+]', '', format_name)
 
 
-def create_qa_update_package_task(package, queue):
+def _job_kwargs(queue, force):
+    '''Returns the keyword arguments for a QA job of datasets, or None.'''
+    kwargs = {}
+    if force:
+        kwargs['force'] = True
+    if queue and pending_jobs.is_enabled():
+        # so that the job can clear its pending record
+        kwargs['queue'] = queue
+    return kwargs or None
+
+
+def create_qa_update_package_task(package, queue, force=False):
 
-    compat_enqueue('qa.update_package', update_package, queue,  args=[package.id])
+    if queue and pending_jobs.is_enabled() and \
+            not pending_jobs.request(queue, package.id, force=force):
+        # merged into the job that is already queued
+        return
+    compat_enqueue('qa.update_package', update_package, queue,  args=[package.id],
+                   kwargs=_job_kwargs(queue, force))
     log.debug('QA of package put into celery queue %s: %s',
               queue, package.name)
 
 
+def create_qa_update_packages_task(packages, queue, force=False):
+
+    if queue and pending_jobs.is_enabled():
+        # leave out those already queued
+        packages = [package for package in packages
+                    if pending_jobs.request(queue, package.id, force=force)]
+        if not packages:
+            return
+    compat_enqueue('qa.update_packages', update_packages, queue,
+                   args=[[package.id for package in packages]],
+                   kwargs=_job_kwargs(queue, force))
+    log.debug('QA of %i packages put into celery queue %s: %s',
+              len(packages), queue,
+              ' '.join(package.name for package in packages))
+
+
 def create_qa_update_task(resource, queue):
     if p.toolkit.check_ckan_version(max_version='2.2.99'):
         package = resource.resource_group.package
@@ -33,13 +33,20 @@ class QA(Base):
 
     id = Column(types.UnicodeText, primary_key=True, default=make_uuid)
     package_id = Column(types.UnicodeText, nullable=False, index=True)
-    resource_id = Column(types.UnicodeText, nullable=False, index=True)
+    # unique, so that results can be upserted
+    resource_id = Column(types.UnicodeText, nullable=False, index=True,
+                         unique=True)
     resource_timestamp = Column(types.DateTime)  # key to resource_revision
     archival_timestamp = Column(types.DateTime)
 
     openness_score = Column(types.Integer)
     openness_score_reason = Column(types.UnicodeText)
     format = Column(types.UnicodeText)
+    # lib.ScoreTable.version of the scores that it was scored with
+    score_table_version = Column(types.UnicodeText, index=True)
+    # tasks.resource_fingerprint of what it was scored from, so that it is
+    # not scored again until one of them changes
+    fingerprint = Column(types.UnicodeText)
 
     created = Column(types.DateTime, default=datetime.datetime.now)
     updated = Column(types.DateTime, default=datetime.datetime.now)
@@ -74,10 +81,53 @@ class QA(Base):
             .filter(model.Resource.state == 'active') \
             .all()
 
+    # the columns that hold the result of a QA check
+    RESULT_COLUMNS = ('openness_score', 'openness_score_reason', 'format',
+                      'archival_timestamp', 'score_table_version',
+                      'fingerprint')
+
+    @classmethod
+    def upsert(cls, rows):
+        '''Inserts or updates the QA rows of many resources in one statement,
+        using PostgreSQL's INSERT ... ON CONFLICT. A row whose result is the
+        same as before is not written at all. Check supports_upsert first.
+
+        :param rows: dicts with keys resource_id, package_id, updated and
+                     RESULT_COLUMNS
+        :returns: the resource ids of the rows that were inserted or changed
+        '''
+        from sqlalchemy import or_
+        from sqlalchemy.dialects.postgresql import insert
+        if not rows:
+            return []
+        table = cls.__table__
+        now = datetime.datetime.now()
+        values = []
+        for row in rows:
+            row = dict(row)
+            row.setdefault('id', make_uuid())
+            row.setdefault('created', now)
+            row.setdefault('updated', now)
+            values.append(row)
+        stmt = insert(table).values(values)
+        changed = or_(*[table.c[column].is_distinct_from(stmt.excluded[column])
+                        for column in cls.RESULT_COLUMNS + ('package_id',)])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.resource_id],
+            set_=dict((column, stmt.excluded[column]) for column
+                      in cls.RESULT_COLUMNS + ('package_id', 'updated')),
+            where=changed,
+        ).returning(table.c.resource_id)
+        return [resource_id for (resource_id,)
+                in model.Session.execute(stmt)]
+
     @classmethod
-    def create(cls, resource_id):
+    def create(cls, resource_id, package_id=None):
         c = cls()
         c.resource_id = resource_id
+        if package_id:
+            c.package_id = package_id
+            return c
 
         # Find the package_id for the resource.
         q = model.Session.query(model.Package.id)
@@ -92,6 +142,89 @@ class QA(Base):
         return c
 
 
+class SniffCache(Base):
+    """
+    The format that was sniffed from the contents of an archived file, so
+    that a file that has not changed does not need sniffing again. Keyed by
+    the content hash, or the file path, size and mtime if there is no hash.
+    """
+    __tablename__ = 'qa_sniff_cache'
+
+    key = Column(types.UnicodeText, primary_key=True)
+    # format is None when the contents were not recognised
+    format = Column(types.UnicodeText)
+    container = Column(types.UnicodeText)
+    # sniff_format.DETECTOR_VERSION that produced the result
+    detector_version = Column(types.Integer, nullable=False)
+    # set if sniffing exceeded a sandbox limit, e.g. u'timeout' (see
+    # sniff_sandbox.SniffLimitError)
+    outcome = Column(types.UnicodeText)
+
+    created = Column(types.DateTime, default=datetime.datetime.now)
+    last_used = Column(types.DateTime, default=datetime.datetime.now,
+                       index=True)
+    hit_count = Column(types.Integer, default=0, nullable=False)
+
+    def __repr__(self):
+        return '<SniffCache %s format=%s container=%s outcome=%s version=%s>' \
+            % (self.key, self.format, self.container, self.outcome,
+               self.detector_version)
+
+    @classmethod
+    def get(cls, key):
+        return model.Session.query(cls).get(key)
+
+
+class SniffQuarantine(Base):
+    """
+    An archived file that made sniffing fail, so is not sniffed again until
+    retry_after. Keyed like SniffCache, by content hash or by file path, size
+    and mtime.
+    """
+    __tablename__ = 'qa_sniff_quarantine'
+
+    key = Column(types.UnicodeText, primary_key=True)
+    # the resource that it last failed for
+    resource_id = Column(types.UnicodeText, index=True)
+    failure_count = Column(types.Integer, default=0, nullable=False)
+    last_error = Column(types.UnicodeText)
+    first_failure = Column(types.DateTime, default=datetime.datetime.now)
+    last_failure = Column(types.DateTime, default=datetime.datetime.now)
+    retry_after = Column(types.DateTime, index=True)
+
+    def __repr__(self):
+        return '<SniffQuarantine %s resource=%s failures=%s until=%s>' % \
+            (self.key, self.resource_id, self.failure_count,
+             self.retry_after)
+
+    @classmethod
+    def get(cls, key):
+        return model.Session.query(cls).get(key)
+
+
+class QATiming(Base):
+    """
+    The time spent in each stage of the latest QA of a resource, stored when
+    qa.timing.store is enabled. It is kept apart from the qa table as it is
+    only for diagnosing performance, and is written after the QA row.
+    """
+    __tablename__ = 'qa_timing'
+
+    resource_id = Column(types.UnicodeText, primary_key=True)
+    package_id = Column(types.UnicodeText, index=True)
+    # JSON dict of stage name to {"count": ..., "seconds": ...}
+    timings = Column(types.UnicodeText)
+    total = Column(types.Float)
+    updated = Column(types.DateTime, default=datetime.datetime.now)
+
+    def __repr__(self):
+        return '<QATiming %s total=%s>' % (self.resource_id, self.total)
+
+    @classmethod
+    def get(cls, resource_id):
+        return model.Session.query(cls).get(resource_id)
+
+
 def aggregate_qa_for_a_dataset(qa_objs):
     '''Returns aggregated archival info for a dataset, given the archivals for
     its resources (returned by get_for_package).
@@ -121,6 +254,142 @@ def aggregate_qa_for_a_dataset(qa_objs):
     return qa_dict
 
 
-def init_tables(engine):
+def add_qa_to_package_dict(pkg_dict, qa_objs):
+    '''Adds the qa info to a package dict (as returned by package_show) - the
+    aggregated info for the dataset and the info of each resource.
+
+    :param qa_objs: A list of the QA objects for the dataset's resources
+    '''
+    # dataset
+    pkg_dict['qa'] = aggregate_qa_for_a_dataset(qa_objs)
+    # resources
+    qa_by_res_id = dict((a.resource_id, a) for a in qa_objs)
+    for res in pkg_dict.get('resources', []):
+        qa = qa_by_res_id.get(res['id'])
+        if qa:
+            qa_dict = qa.as_dict()
+            del qa_dict['id']
+            del qa_dict['package_id']
+            del qa_dict['resource_id']
+            # internal to QA, for deciding when to score it again
+            del qa_dict['score_table_version']
+            del qa_dict['fingerprint']
+            res['qa'] = qa_dict
+
+
+def init_tables(engine, dedupe=False):
     Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    make_qa_resource_id_unique(engine, dedupe=dedupe)
     log.info('QA database tables are set-up')
+
+
+def _qa_resource_id_is_unique(inspector):
+    table_name = QA.__table__.name
+    for index in inspector.get_indexes(table_name):
+        if index['column_names'] == ['resource_id'] and index['unique']:
+            return True
+    for constraint in inspector.get_unique_constraints(table_name):
+        if constraint['column_names'] == ['resource_id']:
+            return True
+    return False
+
+
+# whether QA.upsert can be used, for each database url
+_upsert_supported = {}
+
+
+def supports_upsert(engine):
+    '''Returns whether QA.upsert can be used with the database - it needs
+    PostgreSQL and the unique index on qa.resource_id, which `qa init` adds
+    when upgrading. It is checked once per database.'''
+    from sqlalchemy import inspect
+    engine = engine.engine  # in case it is a connection
+    url = str(engine.url)
+    if url not in _upsert_supported:
+        supported = engine.dialect.name == 'postgresql'
+        if supported and not _qa_resource_id_is_unique(inspect(engine)):
+            log.warning('qa.resource_id is not unique, so QA results will be '
+                        'saved one by one rather than upserted in bulk - run '
+                        '"qa init" to make it unique')
+            supported = False
+        _upsert_supported[url] = supported
+    return _upsert_supported[url]
+
+
+def make_qa_resource_id_unique(engine, dedupe=False):
+    '''Makes the qa table's resource_id index unique, if it was created
+    before it had to be. If any resource has more than one QA row, it is
+    only done if dedupe is True, in which case all but the most recently
+    updated row of each are deleted first.
+
+    :returns: whether qa.resource_id is now unique
+    '''
+    from sqlalchemy import inspect, func
+    from sqlalchemy.orm import sessionmaker
+    table = QA.__table__
+    inspector = inspect(engine)
+    if _qa_resource_id_is_unique(inspector):
+        return True
+    session = sessionmaker(bind=engine)()
+    try:
+        duplicated = [resource_id for (resource_id,) in
+                      session.query(QA.resource_id)
+                      .group_by(QA.resource_id)
+                      .having(func.count(QA.id) > 1)]
+        if duplicated and not dedupe:
+            log.warning('qa.resource_id cannot be made unique, as %i '
+                        'resources have more than one QA row: %s. Run "qa '
+                        'init --dedupe" to delete all but the most recently '
+                        'updated row of each.', len(duplicated),
+                        ', '.join(duplicated))
+            return False
+        deleted = 0
+        for resource_id in duplicated:
+            qas = session.query(QA).filter_by(resource_id=resource_id) \
+                .order_by(QA.updated.desc()).all()
+            for qa in qas[1:]:
+                session.delete(qa)
+                deleted += 1
+        session.commit()
+    finally:
+        session.close()
+    if duplicated:
+        log.warning('Deleted %i duplicate QA rows, of resources: %s',
+                    deleted, ', '.join(duplicated))
+    with engine.begin() as connection:
+        for index in table.indexes:
+            if [column.name for column in index.columns] == ['resource_id']:
+                # the old index has the same name, but is not unique
+                if index.name in [existing['name'] for existing
+                                  in inspector.get_indexes(table.name)]:
+                    index.drop(connection)
+                index.create(connection)
+    _upsert_supported.pop(str(engine.url), None)
+    log.info('Made qa.resource_id unique')
+    return True
+
+
+def add_missing_columns(engine):
+    '''Adds columns that have been added to the model since the tables were
+    created (and their indexes), so that running init again upgrades the
+    tables. New columns must be nullable.'''
+    from sqlalchemy import inspect, text
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = set(column['name'] for column
+                               in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            log.info('Adding column %s.%s', table.name, column.name)
+            with engine.begin() as connection:
+                connection.execute(text('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name,
+                    column.type.compile(dialect=engine.dialect))))
+                for index in table.indexes:
+                    if column in index.columns.values():
+                        index.create(connection)
@@ -0,0 +1,221 @@
+'''
+Deduplication of queued QA jobs.
+
+Every package-archived notification from the archiver queues a QA job for
+the dataset, as does each `qa update`, so when a dataset is archived several
+times in quick succession, or a bulk run overlaps the archiver, it would be
+QA'd several times over. With qa.job_dedup enabled, a job that is queued for
+a dataset is recorded as pending, until it starts, and any more requests to
+QA the dataset on the same queue in the meantime are merged into it (a
+--force request makes the pending job force it too), rather than queuing
+another job.
+
+Requests are only merged for qa.job_dedup.quiet_period seconds after the
+pending job was queued. After that, in case it has been lost or is stuck
+behind a long queue, another job is queued.
+
+The pending jobs are recorded in qa.job_dedup.store:
+
+* redis (the default) - shared by all the workers and CKAN processes
+* sqlite - in the file qa.job_dedup.sqlite_path, for a single server
+* memory - in the process, which only suits tests and development
+'''
+import logging
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from ckan.plugins import toolkit
+from ckan.plugins.toolkit import config
+
+log = logging.getLogger(__name__)
+
+DEFAULT_QUIET_PERIOD = 300  # seconds
+DEFAULT_STORE = 'redis'
+
+
+def is_enabled():
+    return toolkit.asbool(config.get('qa.job_dedup', False))
+
+
+def get_quiet_period():
+    return float(config.get('qa.job_dedup.quiet_period',
+                            DEFAULT_QUIET_PERIOD))
+
+
+class MemoryStore(object):
+    '''Records the pending jobs in this process.'''
+    def __init__(self):
+        # key: (time it was queued, force)
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def request(self, key, force, quiet_period):
+        '''Records a request for a job.
+
+        :returns: True if a new job needs queuing, or False if it was merged
+                  into the pending one
+        '''
+        now = time.time()
+        with self.lock:
+            pending = self.pending.get(key)
+            if pending and now - pending[0] < quiet_period:
+                self.pending[key] = (pending[0], pending[1] or force)
+                return False
+            self.pending[key] = (now, force)
+            return True
+
+    def start(self, key):
+        '''Clears the pending job, as it is starting.
+
+        :returns: whether any of the requests merged into it were forced
+        '''
+        with self.lock:
+            pending = self.pending.pop(key, None)
+            return bool(pending and pending[1])
+
+
+class SqliteStore(object):
+    '''Records the pending jobs in an SQLite file, which the processes on
+    this server share.'''
+    def __init__(self, filepath=None):
+        if filepath is None:
+            filepath = config.get('qa.job_dedup.sqlite_path') or \
+                os.path.join(tempfile.gettempdir(),
+                             'ckanext-qa-pending-jobs.sqlite')
+        # transactions are begun explicitly
+        self.conn = sqlite3.connect(filepath, timeout=30,
+                                    isolation_level=None,
+                                    check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute('CREATE TABLE IF NOT EXISTS qa_pending_job '
+                          '(key TEXT PRIMARY KEY, queued REAL, '
+                          'force INTEGER)')
+
+    def _transaction(self, fn):
+        with self.lock:
+            # IMMEDIATE takes the write lock straight away, so that another
+            # process cannot read the same row in between
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn(self.conn)
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+            return result
+
+    def request(self, key, force, quiet_period):
+        now = time.time()
+
+        def request(conn):
+            row = conn.execute('SELECT queued FROM qa_pending_job '
+                               'WHERE key = ?', (key,)).fetchone()
+            if row and now - row[0] < quiet_period:
+                if force:
+                    conn.execute('UPDATE qa_pending_job SET force = 1 '
+                                 'WHERE key = ?', (key,))
+                return False
+            conn.execute('INSERT OR REPLACE INTO qa_pending_job '
+                         '(key, queued, force) VALUES (?, ?, ?)',
+                         (key, now, int(bool(force))))
+            return True
+        return self._transaction(request)
+
+    def start(self, key):
+        def start(conn):
+            row = conn.execute('SELECT force FROM qa_pending_job '
+                               'WHERE key = ?', (key,)).fetchone()
+            conn.execute('DELETE FROM qa_pending_job WHERE key = ?', (key,))
+            return bool(row and row[0])
+        return self._transaction(start)
+
+
+class RedisStore(object):
+    '''Records the pending jobs in Redis, with keys that expire after the
+    quiet period.'''
+    prefix = 'ckanext-qa:pending-job:'
+
+    def __init__(self, redis=None):
+        if redis is None:
+            from ckan.lib.redis import connect_to_redis
+            redis = connect_to_redis()
+        self.redis = redis
+
+    def request(self, key, force, quiet_period):
+        # the value is whether it is forced
+        key = self.prefix + key
+        expires = max(int(math.ceil(quiet_period)), 1)
+        if self.redis.set(key, int(bool(force)), nx=True, ex=expires):
+            return True
+        if force:
+            # keeping the time that it expires
+            ttl = self.redis.ttl(key)
+            self.redis.set(key, 1, xx=True, ex=ttl if ttl > 0 else expires)
+        return False
+
+    def start(self, key):
+        key = self.prefix + key
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.get(key)
+        pipe.delete(key)
+        return pipe.execute()[0] in (b'1', '1')
+
+
+STORES = {
+    'memory': MemoryStore,
+    'sqlite': SqliteStore,
+    'redis': RedisStore,
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    '''Returns the store of pending jobs, as configured by
+    qa.job_dedup.store.'''
+    global _store
+    name = config.get('qa.job_dedup.store', DEFAULT_STORE)
+    with _store_lock:
+        if _store is None or _store[0] != name:
+            if name not in STORES:
+                raise ValueError('Unknown qa.job_dedup.store: %r (should be '
+                                 'one of: %s)'
+                                 % (name, ', '.join(sorted(STORES))))
+            _store = (name, STORES[name]())
+        return _store[1]
+
+
+def _key(queue, package_id):
+    return u'%s:%s' % (queue, package_id)
+
+
+def request(queue, package_id, force=False):
+    '''Records a request to QA a dataset on a queue.
+
+    :returns: True if a job needs queuing for it, or False if the request
+              was merged into a job that is already pending
+    '''
+    new = get_store().request(_key(queue, package_id), force,
+                              get_quiet_period())
+    if not new:
+        log.info('QA of dataset %s is already pending on queue %s',
+                 package_id, queue)
+    return new
+
+
+def start(queue, package_ids):
+    '''Clears the pending jobs of datasets, as their QA is starting, so that
+    any requests from now on queue another job.
+
+    :returns: whether any of the requests merged into them were forced
+    '''
+    store = get_store()
+    force = False
+    for package_id in package_ids:
+        force = store.start(_key(queue, package_id)) or force
+    return force
@@ -1,3 +1,4 @@
+import json
 import logging
 
 import ckan.model as model
@@ -6,7 +7,8 @@ from ckan.plugins import toolkit
 
 from ckanext.archiver.interfaces import IPipe
 from ckanext.qa.logic import action, auth
-from ckanext.qa.model import QA, aggregate_qa_for_a_dataset
+from ckanext.qa import search_index
+from ckanext.qa.model import QA, add_qa_to_package_dict
 from ckanext.qa.helpers import qa_openness_stars_resource_html, qa_openness_stars_dataset_html
 from ckanext.qa.lib import create_qa_update_package_task
 from ckanext.report.interfaces import IReport
@@ -94,16 +96,13 @@ class QAPlugin(MixinPlugin, p.SingletonPlugin, toolkit.DefaultDatasetForm):
         qa_objs = QA.get_for_package(pkg_dict['id'])
         if not qa_objs:
             return
-        # dataset
-        dataset_qa = aggregate_qa_for_a_dataset(qa_objs)
-        pkg_dict['qa'] = dataset_qa
-        # resources
-        qa_by_res_id = dict((a.resource_id, a) for a in qa_objs)
-        for res in pkg_dict['resources']:
-            qa = qa_by_res_id.get(res['id'])
-            if qa:
-                qa_dict = qa.as_dict()
-                del qa_dict['id']
-                del qa_dict['package_id']
-                del qa_dict['resource_id']
-                res['qa'] = qa_dict
+        add_qa_to_package_dict(pkg_dict, qa_objs)
+
+    def before_index(self, pkg_dict):
+        # With partial updates of the search index, the qa info is indexed
+        # in fields of its own, which the partial updates set
+        if search_index.is_enabled():
+            pkg_dict.pop('qa', None)
+            pkg_dict.update(search_index.index_fields(
+                json.loads(pkg_dict['data_dict'])))
+        return pkg_dict
@@ -0,0 +1,138 @@
+'''
+Quarantine of archived files that make sniffing fail.
+
+A file that makes sniff_file_format raise an exception (or, with the sniff
+sandbox, time out or use too much memory) would otherwise be sniffed again
+every time its resource is QA'd - after each archival and in each bulk
+``qa update``. Instead, with qa.quarantine enabled, the failure is recorded
+against the file's content (the same key as the sniff cache - the content
+hash, or the file's path, size and mtime) and the file is not sniffed again
+until a backoff has passed, which doubles with each failure:
+qa.quarantine.backoff_hours, then twice that and so on, up to
+qa.quarantine.max_backoff_days. Meanwhile the resource is scored by its URL
+extension and format field. When the content changes, so does the key, so
+the new content is sniffed straight away.
+
+Entries are listed and released with ``qa quarantine list|release``.
+
+Unless qa.quarantine is set, it is enabled along with the sniff sandbox, so
+that a file that exceeds the sandbox's limits is not sniffed again (and
+timed out again) every time it is QA'd.
+'''
+import datetime
+import logging
+
+from ckan.plugins import toolkit
+from ckan.plugins.toolkit import config
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BACKOFF_HOURS = 1
+DEFAULT_MAX_BACKOFF_DAYS = 30
+
+
+def is_enabled():
+    enabled = config.get('qa.quarantine')
+    if enabled is None:
+        from ckanext.qa import sniff_sandbox
+        return sniff_sandbox.is_enabled()
+    return toolkit.asbool(enabled)
+
+
+def get_backoff(failure_count):
+    '''Returns the timedelta to wait before sniffing a file again, after it
+    has failed failure_count times.'''
+    backoff_hours = float(config.get('qa.quarantine.backoff_hours',
+                                     DEFAULT_BACKOFF_HOURS))
+    max_backoff_days = float(config.get('qa.quarantine.max_backoff_days',
+                                        DEFAULT_MAX_BACKOFF_DAYS))
+    # cap the exponent too, so that it cannot overflow
+    hours = backoff_hours * 2 ** min(max(failure_count - 1, 0), 32)
+    return min(datetime.timedelta(hours=hours),
+               datetime.timedelta(days=max_backoff_days))
+
+
+def get(key):
+    '''Returns the SniffQuarantine entry for the file with this key, if it
+    has failed, otherwise None.'''
+    from ckanext.qa.model import SniffQuarantine
+    return SniffQuarantine.get(key)
+
+
+def is_quarantined(entry, now=None):
+    '''Returns whether a file with this SniffQuarantine entry (or None)
+    should not be sniffed yet, because its backoff has not passed.'''
+    return bool(entry) and \
+        entry.retry_after > (now or datetime.datetime.now())
+
+
+def record_failure(key, resource_id, error):
+    '''Records that sniffing a file failed, and quarantines it for the next
+    backoff. It is committed along with the rest of the QA session.
+
+    :returns: the SniffQuarantine entry
+    '''
+    from ckan import model
+    from ckanext.qa.model import SniffQuarantine
+    now = datetime.datetime.now()
+    entry = SniffQuarantine.get(key)
+    if not entry:
+        entry = SniffQuarantine(key=key, failure_count=0, first_failure=now)
+        model.Session.add(entry)
+    entry.resource_id = resource_id
+    entry.failure_count += 1
+    entry.last_failure = now
+    entry.last_error = u'%s: %s' % (type(error).__name__, error)
+    entry.retry_after = now + get_backoff(entry.failure_count)
+    log.warning('Quarantined %s (resource %s) until %s after %i failure(s): '
+                '%s', key, resource_id, entry.retry_after.isoformat(),
+                entry.failure_count, entry.last_error)
+    return entry
+
+
+def record_success(entry):
+    '''Clears the record of failures (a SniffQuarantine entry) for a file
+    that has now been sniffed ok.'''
+    from ckan import model
+    log.info('Sniffed %s ok after %i failure(s)', entry.key,
+             entry.failure_count)
+    model.Session.delete(entry)
+
+
+def list_entries(include_expired=False):
+    '''Returns the SniffQuarantine entries, most recent failure first.
+
+    :param include_expired: also return entries whose backoff has passed,
+                            which will be sniffed again next time
+    '''
+    from ckan import model
+    from ckanext.qa.model import SniffQuarantine
+    q = model.Session.query(SniffQuarantine)
+    if not include_expired:
+        q = q.filter(SniffQuarantine.retry_after > datetime.datetime.now())
+    return q.order_by(SniffQuarantine.last_failure.desc()).all()
+
+
+def release(keys_or_resource_ids=None):
+    '''Deletes quarantine entries (and any limit outcomes cached for them in
+    the sniff cache), so that the files are sniffed again next time. Entries
+    are matched by key or by resource id. With no keys given, all the
+    entries are released.
+
+    :returns: the number of entries released
+    '''
+    from ckan import model
+    from ckanext.qa import sniff_cache
+    from ckanext.qa.model import SniffQuarantine
+    q = model.Session.query(SniffQuarantine)
+    if keys_or_resource_ids:
+        ids = list(keys_or_resource_ids)
+        q = q.filter(SniffQuarantine.key.in_(ids) |
+                     SniffQuarantine.resource_id.in_(ids))
+    # and any outcome in the sniff cache, which would stop it being sniffed
+    sniff_cache.forget_outcomes(key for (key,) in q.with_entities(
+        SniffQuarantine.key))
+    released = q.delete(synchronize_session=False)
+    model.Session.commit()
+    log.info('Released %i quarantined files', released)
+    return released
@@ -0,0 +1,177 @@
+'''
+Coalesced updates of the search index.
+
+Each QA job used to reindex its dataset straight away, with a Solr commit, so
+a bulk run made a commit per dataset. With qa.reindex_buffer enabled, the
+jobs instead add the ids of the datasets to reindex to a buffer, where they
+are deduplicated, and the buffer is flushed - the datasets reindexed, with a
+single commit - once it holds qa.reindex_buffer.max_size datasets, or when
+a dataset is added and the oldest has waited qa.reindex_buffer.max_age
+seconds. `qa reindex-flush` flushes it straight away, e.g. from cron, so
+that the last datasets of a run are not left waiting for the next job.
+
+The buffer is kept in Redis (qa.reindex_buffer.store = redis, the default),
+so that it is shared by all the workers - RQ runs each job in a process of
+its own. With qa.reindex_buffer.store = memory it is kept in the process,
+which only suits long-lived workers, and is flushed when it exits.
+'''
+import atexit
+import collections
+import logging
+import threading
+import time
+
+from ckan.plugins import toolkit
+from ckan.plugins.toolkit import config
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 100
+DEFAULT_MAX_AGE = 60  # seconds
+DEFAULT_STORE = 'redis'
+
+
+def is_enabled():
+    return toolkit.asbool(config.get('qa.reindex_buffer', False))
+
+
+def get_thresholds():
+    '''Returns the configured thresholds for flushing: (max_size,
+    max_age)'''
+    max_size = toolkit.asint(
+        config.get('qa.reindex_buffer.max_size', DEFAULT_MAX_SIZE))
+    max_age = float(config.get('qa.reindex_buffer.max_age', DEFAULT_MAX_AGE))
+    return max_size, max_age
+
+
+class MemoryStore(object):
+    '''Buffers the dataset ids in this process.'''
+    def __init__(self):
+        self.package_ids = collections.OrderedDict()
+        self.since = None
+        self.lock = threading.Lock()
+
+    def add(self, package_ids):
+        '''Adds dataset ids to the buffer.
+
+        :returns: (the number of datasets in the buffer, the time.time()
+                  when the oldest was added)
+        '''
+        with self.lock:
+            for package_id in package_ids:
+                self.package_ids[package_id] = None
+            if self.since is None:
+                self.since = time.time()
+            return len(self.package_ids), self.since
+
+    def pop_all(self):
+        '''Empties the buffer, returning the dataset ids that were in it.'''
+        with self.lock:
+            package_ids = list(self.package_ids)
+            self.package_ids.clear()
+            self.since = None
+            return package_ids
+
+
+class RedisStore(object):
+    '''Buffers the dataset ids in a Redis set, shared by all the workers.'''
+    key = 'ckanext-qa:reindex-buffer'
+    since_key = 'ckanext-qa:reindex-buffer:since'
+
+    def __init__(self, redis=None):
+        if redis is None:
+            from ckan.lib.redis import connect_to_redis
+            redis = connect_to_redis()
+        self.redis = redis
+
+    def add(self, package_ids):
+        pipe = self.redis.pipeline()
+        pipe.sadd(self.key, *package_ids)
+        pipe.set(self.since_key, time.time(), nx=True)
+        pipe.scard(self.key)
+        pipe.get(self.since_key)
+        size, since = pipe.execute()[2:]
+        return size, float(since)
+
+    def pop_all(self):
+        # in a transaction, so that no ids are added in between
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.smembers(self.key)
+        pipe.delete(self.key, self.since_key)
+        package_ids = pipe.execute()[0]
+        return sorted(package_id.decode('utf8')
+                      if isinstance(package_id, bytes) else package_id
+                      for package_id in package_ids)
+
+
+STORES = {
+    'memory': MemoryStore,
+    'redis': RedisStore,
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    '''Returns the buffer's store, as configured by
+    qa.reindex_buffer.store.'''
+    global _store
+    name = config.get('qa.reindex_buffer.store', DEFAULT_STORE)
+    with _store_lock:
+        if _store is None or _store[0] != name:
+            if name not in STORES:
+                raise ValueError('Unknown qa.reindex_buffer.store: %r (should '
+                                 'be one of: %s)'
+                                 % (name, ', '.join(sorted(STORES))))
+            _store = (name, STORES[name]())
+        return _store[1]
+
+
+def add(package_ids):
+    '''Adds datasets to be reindexed to the buffer, and flushes it if it is
+    full or the oldest has waited long enough.
+
+    :returns: the ids of the datasets that were reindexed, if it was flushed
+    '''
+    package_ids = list(package_ids)
+    if not package_ids:
+        return []
+    size, since = get_store().add(package_ids)
+    log.debug('Buffered %i datasets for reindexing (%i in the buffer)',
+              len(package_ids), size)
+    max_size, max_age = get_thresholds()
+    if size >= max_size or time.time() - since >= max_age:
+        return flush()
+    return []
+
+
+def flush():
+    '''Reindexes the datasets in the buffer, with a single commit, and
+    empties it.
+
+    :returns: the ids of the datasets that were reindexed
+    '''
+    from ckanext.qa.lib import reindex_packages
+    store = get_store()
+    package_ids = store.pop_all()
+    if not package_ids:
+        return []
+    try:
+        reindex_packages(package_ids)
+    except Exception:
+        # put them back, so they are reindexed next time
+        store.add(package_ids)
+        raise
+    log.info('Reindexed %i buffered datasets', len(package_ids))
+    return package_ids
+
+
+@atexit.register
+def _flush_memory_store():
+    if _store is None or not isinstance(_store[1], MemoryStore):
+        return
+    try:
+        flush()
+    except Exception:
+        log.exception('Could not reindex the buffered datasets on exit')
@@ -0,0 +1,232 @@
+'''
+Partial updates of the search index, of just the qa info.
+
+To get the latest qa info into the search index, QA normally reindexes the
+whole dataset, which runs package_show and so is expensive for datasets with
+lots of extras and resources. With qa.solr_partial_update enabled, the qa
+info is instead indexed in fields of its own:
+
+* qa_openness_score - the dataset's openness score
+* res_qa_openness_score - the openness scores of its resources
+* res_qa_format - the formats of its resources
+
+and after QA, only they (and the qa info in the stored data_dict and
+validated_data_dict) are set, with a Solr atomic update.
+
+Atomic updates rebuild the rest of the document from its stored fields, so
+a field that is not stored (and has no docValues) loses its value, unless it
+is a copyField destination or the update sets it too. The fields of CKAN's
+default schema that are not stored are set by the update (RECOMPUTED_FIELDS,
+and the extras that are indexed under their own keys, which go in the
+catch-all * dynamic field), are not set by CKAN's indexer
+(UNINDEXED_FIELDS), or only hold a dataset's relationships
+(RELATIONSHIP_FIELDS) - a dataset with relationships is reindexed in full.
+So the default schema only needs the qa fields adding. The schema is checked
+the first time it is needed and, if it would lose another field or lacks the
+qa fields, the dataset is reindexed in full instead, as it is if the atomic
+update fails.
+
+Fields added by other plugins' before_dataset_index that match a dynamic
+field that is not stored (e.g. the catch-all *) cannot be checked, and need
+storing for partial updates.
+'''
+import json
+import logging
+
+from ckan.plugins import toolkit
+from ckan.plugins.toolkit import config
+
+from ckanext.qa import timing
+
+log = logging.getLogger(__name__)
+
+QA_FIELDS = ('qa_openness_score', 'res_qa_openness_score', 'res_qa_format')
+# fields that need not be stored, as update_qa_fields sets them
+RECOMPUTED_FIELDS = ('permission_labels', 'title_string', 'views_total',
+                     'views_recent')
+# fields in CKAN's schema that its indexer does not set
+UNINDEXED_FIELDS = ('resources_accessed_total', 'resources_accessed_recent')
+RELATIONSHIP_FIELDS = ('depends_on', 'dependency_of', 'derives_from',
+                       'has_derivation', 'links_to', 'linked_from',
+                       'child_of', 'parent_of')
+
+# whether the schema of each Solr url supports partial updates
+_schema_supported = {}
+
+
+def is_enabled():
+    return toolkit.asbool(config.get('qa.solr_partial_update', False))
+
+
+def index_fields(pkg_dict):
+    '''Returns the QA_FIELDS to index for a package dict that has the qa
+    info in it (see model.add_qa_to_package_dict).'''
+    resource_qas = [res['qa'] for res in pkg_dict.get('resources', [])
+                    if res.get('qa')]
+    return {
+        'qa_openness_score': (pkg_dict.get('qa') or {}).get('openness_score'),
+        'res_qa_openness_score': [qa['openness_score'] for qa in resource_qas
+                                  if qa.get('openness_score') is not None],
+        'res_qa_format': [qa['format'] for qa in resource_qas
+                          if qa.get('format')],
+    }
+
+
+def check_schema(fields, dynamic_fields, copy_fields):
+    '''Checks that a Solr schema allows partial updates of the qa fields,
+    without losing the value of any field that is not stored.
+
+    :param fields: the schema's fields, as returned by Solr's schema API
+                   with showDefaults (dicts of the field properties)
+    :param dynamic_fields: the schema's dynamic fields, likewise
+    :param copy_fields: the schema's copy fields (dicts with source and
+                        dest)
+    :returns: a list of the problems - empty if it does allow them
+    '''
+    problems = []
+    field_names = set(field['name'] for field in fields)
+    for name in QA_FIELDS:
+        if name not in field_names:
+            problems.append('Field %s is not in the schema' % name)
+    not_lost = set(copy_field['dest'] for copy_field in copy_fields)
+    not_lost.update(RECOMPUTED_FIELDS + UNINDEXED_FIELDS +
+                    RELATIONSHIP_FIELDS)
+    # the catch-all holds the extras indexed under their own keys, which the
+    # update sets
+    not_lost.add('*')
+    for field in fields + dynamic_fields:
+        if field['name'] in not_lost:
+            continue
+        if field.get('stored', True):
+            continue
+        if field.get('docValues') and \
+                field.get('useDocValuesAsStored', True):
+            continue
+        problems.append('Field %s is not stored, so an atomic update would '
+                        'lose its value' % field['name'])
+    return problems
+
+
+def recomputed_fields(package_id, data_dict):
+    '''Returns the values of the fields that are not stored in CKAN's
+    default schema, which an atomic update would otherwise lose, worked out
+    in the same way as ckan.lib.search.index.PackageSearchIndex does.
+
+    :param data_dict: the dataset's data_dict, as stored in the index
+    '''
+    from ckan import model
+    from ckan.lib import plugins as lib_plugins
+    from ckan.lib.search.index import (
+        KEY_CHARS, RESERVED_FIELDS, escape_xml_illegal_chars)
+
+    fields = {}
+    if data_dict.get('title'):
+        fields['title_string'] = escape_xml_illegal_chars(data_dict['title'])
+    if hasattr(model, 'TrackingSummary'):
+        tracking_summary = model.TrackingSummary.get_for_package(package_id)
+        fields['views_total'] = tracking_summary['total']
+        fields['views_recent'] = tracking_summary['recent']
+    # extras are also indexed under their own keys
+    index_fields = set(RESERVED_FIELDS) | set(data_dict) | \
+        set(('data_dict', 'validated_data_dict', 'title_string'))
+    for extra in data_dict.get('extras', []):
+        key, value = extra['key'], extra['value']
+        if isinstance(value, (tuple, list)):
+            value = ' '.join(map(str, value))
+        key = ''.join([c for c in key if c in KEY_CHARS])
+        if key not in index_fields and value is not None:
+            fields[key] = value
+    package = model.Package.get(package_id)
+    fields['permission_labels'] = \
+        lib_plugins.get_permission_labels().get_dataset_labels(package) \
+        if package else []
+    return fields
+
+
+def _schema_supports_partial_updates(conn):
+    if conn.url not in _schema_supported:
+        session = conn.get_session()
+
+        def get(path, key):
+            response = session.get(
+                '%s/schema/%s' % (conn.url, path),
+                params={'showDefaults': 'true', 'wt': 'json'},
+                timeout=conn.timeout)
+            response.raise_for_status()
+            return response.json()[key]
+        try:
+            problems = check_schema(get('fields', 'fields'),
+                                    get('dynamicfields', 'dynamicFields'),
+                                    get('copyfields', 'copyFields'))
+        except Exception as e:
+            problems = ['Could not read the schema: %s' % e]
+        if problems:
+            log.warning('The Solr schema does not allow partial updates of '
+                        'the qa info, so datasets will be reindexed in full: '
+                        '%s', '; '.join(problems))
+        _schema_supported[conn.url] = not problems
+    return _schema_supported[conn.url]
+
+
+def update_qa_fields(package_id, defer_commit=False):
+    '''Updates just the qa info of a dataset in the search index, with an
+    atomic update.
+
+    :param defer_commit: leave it to the caller to commit the index
+    :returns: whether it was updated - if not, it needs reindexing in full
+    '''
+    import pysolr
+    from ckan.lib.search.common import make_connection
+    from ckanext.qa.model import QA, add_qa_to_package_dict
+
+    conn = make_connection()
+    if not _schema_supports_partial_updates(conn):
+        return False
+    qa_objs = QA.get_for_package(package_id)
+    if not qa_objs:
+        return False
+    with timing.stage('solr_partial_update'):
+        try:
+            docs = conn.search(
+                'id:"%s"' % package_id,
+                fq='+site_id:"%s"' % config.get('ckan.site_id'),
+                fl='index_id,data_dict,validated_data_dict,_version_',
+                rows=1).docs
+        except pysolr.SolrError as e:
+            log.warning('Could not get dataset %s from the search index: %s',
+                        package_id, e)
+            return False
+        if not docs or not docs[0].get('_version_'):
+            # not indexed yet
+            return False
+        doc = docs[0]
+        data_dict = json.loads(doc['data_dict'])
+        if data_dict.get('relationships_as_subject') or \
+                data_dict.get('relationships_as_object'):
+            # the relationship fields are not stored
+            return False
+        add_qa_to_package_dict(data_dict, qa_objs)
+        fields = index_fields(data_dict)
+        if any(value is None or value == [] for value in fields.values()):
+            # an empty value would be left out of the update, rather than
+            # clearing the field
+            return False
+        update = dict(fields, data_dict=json.dumps(data_dict))
+        update.update(recomputed_fields(package_id, data_dict))
+        if doc.get('validated_data_dict'):
+            validated_data_dict = json.loads(doc['validated_data_dict'])
+            add_qa_to_package_dict(validated_data_dict, qa_objs)
+            update['validated_data_dict'] = json.dumps(validated_data_dict)
+        field_updates = dict((key, 'set') for key in update)
+        # _version_ makes it fail if the document has changed since it was
+        # read
+        update.update(index_id=doc['index_id'], _version_=doc['_version_'])
+        commit = not defer_commit and \
+            toolkit.asbool(config.get('ckan.search.solr_commit', True))
+        try:
+            conn.add([update], fieldUpdates=field_updates, commit=commit)
+        except pysolr.SolrError as e:
+            log.warning('Partial update of dataset %s in the search index '
+                        'failed: %s', package_id, e)
+            return False
+    return True
@@ -0,0 +1,169 @@
+'''
+Persistent cache of sniffed file formats.
+
+The archiver usually fetches content that has not changed since last time, so
+rather than sniffing the archived file again, the result is looked up by the
+content hash that the archiver recorded. If there is no hash, the key falls
+back to the cache file's path, size and mtime.
+
+If sniffing a file exceeded a limit of the sniff sandbox, e.g. it timed out,
+that is cached too, so that the same content is not sniffed again each time
+the resource is QA'd - unless qa.quarantine is enabled, in which case the
+quarantine decides when it is sniffed again.
+
+Entries made by an older DETECTOR_VERSION are treated as misses. Entries are
+evicted by `qa sniff-cache prune` - those not used for
+qa.sniff_cache.max_age_days and then the least recently used ones, until
+there are no more than qa.sniff_cache.max_entries.
+'''
+import datetime
+import logging
+import os
+
+from ckan.plugins import toolkit
+from ckan.plugins.toolkit import config
+
+from ckanext.qa.sniff_format import DETECTOR_VERSION
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_AGE_DAYS = 90
+DEFAULT_MAX_ENTRIES = 500000
+
+
+def is_enabled():
+    return toolkit.asbool(config.get('qa.sniff_cache', False))
+
+
+def cache_key(content_hash, filepath):
+    '''Returns the key to cache the sniffed format of an archived file under.
+
+    :param content_hash: the hash of the file contents that the archiver
+                         recorded (Archival.hash), or None
+    '''
+    if content_hash:
+        return u'hash:%s' % content_hash
+    stat = os.stat(filepath)
+    return u'file:%s:%d:%d' % (os.path.realpath(filepath), stat.st_size,
+                               int(stat.st_mtime))
+
+
+def get(key):
+    '''Looks up a sniffed format in the cache.
+
+    :returns: tuple (hit, format_) where format_ is as returned by
+              sniff_file_format, so can be None for a hit too.
+    :raises: sniff_sandbox.SniffLimitError if sniffing this content
+             previously exceeded a limit
+    '''
+    from ckanext.qa.model import SniffCache
+    from ckanext.qa.sniff_sandbox import LIMIT_ERRORS, SniffLimitError
+    entry = SniffCache.get(key)
+    if not entry or entry.detector_version != DETECTOR_VERSION:
+        return False, None
+    entry.last_used = datetime.datetime.now()
+    entry.hit_count += 1
+    if entry.outcome:
+        raise LIMIT_ERRORS.get(entry.outcome, SniffLimitError)(
+            'Sniffing this content previously failed: %s' % entry.outcome)
+    if not entry.format:
+        return True, None
+    format_ = {'format': entry.format}
+    if entry.container:
+        format_['container'] = entry.container
+    return True, format_
+
+
+def put(key, format_, outcome=None):
+    '''Stores a sniffed format (or None) in the cache. It is committed along
+    with the rest of the QA session.
+
+    :param outcome: the outcome of a SniffLimitError, if sniffing exceeded a
+                    limit
+    '''
+    from ckan import model
+    from ckanext.qa.model import SniffCache
+    entry = SniffCache.get(key)
+    if not entry:
+        entry = SniffCache(key=key)
+        model.Session.add(entry)
+    entry.format = format_['format'] if format_ else None
+    entry.container = format_.get('container') if format_ else None
+    entry.outcome = outcome
+    entry.detector_version = DETECTOR_VERSION
+    entry.last_used = datetime.datetime.now()
+    entry.hit_count = 0
+
+
+def forget_outcomes(keys):
+    '''Deletes the cached outcomes of sniffing that exceeded a limit, for
+    the given keys, so that the content is sniffed again. It is committed
+    along with the rest of the QA session.
+
+    :returns: the number of entries deleted
+    '''
+    from ckan import model
+    from ckanext.qa.model import SniffCache
+    keys = list(keys)
+    if not keys:
+        return 0
+    return model.Session.query(SniffCache) \
+        .filter(SniffCache.key.in_(keys)) \
+        .filter(SniffCache.outcome.isnot(None)) \
+        .delete(synchronize_session=False)
+
+
+def prune(max_age_days=None, max_entries=None):
+    '''Evicts entries that have not been used for max_age_days, that were
+    made by an old DETECTOR_VERSION, and then the least recently used ones
+    until there are no more than max_entries.
+
+    :returns: the number of entries deleted
+    '''
+    from ckan import model
+    from ckanext.qa.model import SniffCache
+    if max_age_days is None:
+        max_age_days = toolkit.asint(config.get('qa.sniff_cache.max_age_days',
+                                                DEFAULT_MAX_AGE_DAYS))
+    if max_entries is None:
+        max_entries = toolkit.asint(config.get('qa.sniff_cache.max_entries',
+                                               DEFAULT_MAX_ENTRIES))
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=max_age_days)
+    q = model.Session.query(SniffCache)
+    deleted = q.filter((SniffCache.last_used < cutoff) |
+                       (SniffCache.detector_version != DETECTOR_VERSION)) \
+        .delete(synchronize_session=False)
+    excess = q.count() - max_entries
+    if excess > 0:
+        least_recently_used = model.Session.query(SniffCache.key) \
+            .order_by(SniffCache.last_used).limit(excess)
+        deleted += q.filter(SniffCache.key.in_(least_recently_used)) \
+            .delete(synchronize_session=False)
+    model.Session.commit()
+    log.info('Sniff cache pruned: %s entries deleted', deleted)
+    return deleted
+
+
+def stats():
+    '''Returns a dict summarizing the cache contents.'''
+    from sqlalchemy import func
+    from ckan import model
+    from ckanext.qa.model import SniffCache
+    q = model.Session.query
+    return {
+        'entries': q(SniffCache).count(),
+        'current_detector_version': DETECTOR_VERSION,
+        'by_detector_version': dict(
+            q(SniffCache.detector_version, func.count(SniffCache.key))
+            .group_by(SniffCache.detector_version).all()),
+        'by_outcome': dict(
+            q(SniffCache.outcome, func.count(SniffCache.key))
+            .filter(SniffCache.outcome != None)  # noqa
+            .group_by(SniffCache.outcome).all()),
+        'by_format': dict(
+            q(SniffCache.format, func.count(SniffCache.key))
+            .group_by(SniffCache.format).all()),
+        'hits': q(func.sum(SniffCache.hit_count)).scalar() or 0,
+        'oldest_last_used': q(func.min(SniffCache.last_used)).scalar(),
+        'newest_last_used': q(func.max(SniffCache.last_used)).scalar(),
+    }
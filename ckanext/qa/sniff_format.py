@@ -3,16 +3,30 @@
 from io import BytesIO, open
 import sys
 import re
-import zipfile
 import os
+import mmap
 from collections import defaultdict
 import subprocess
+import time
+import bz2
+import itertools
+import zlib
+try:
+    import lzma
+except ImportError:
+    # python 2
+    lzma = None
 
 import xlrd
 import magic
 import messytables
 
-from ckan.lib import helpers as ckan_helpers
+from ckan.plugins import toolkit
+from ckan.plugins.toolkit import config
+
+from ckanext.qa import cfb
+from ckanext.qa import timing
+from ckanext.qa.zip_directory import ZipDirectory, ZipDirectoryError
 
 
 if sys.version_info[0] >= 3:
@@ -23,6 +37,122 @@ import logging
 log = logging.getLogger(__name__)
 
 
+# Increment this when a change to the detectors could change the format
+# sniffed from a file, so that cached results are sniffed again
+DETECTOR_VERSION = 5
+
+# libmagic only looks at the start of a file - its default bytes_max
+MAGIC_BUFFER_SIZE = 1024 * 1024
+
+
+class SniffContext(object):
+    '''A file that is being sniffed. The file is opened and memory-mapped
+    once, and that same map is shared by all the detectors, rather than each
+    of them opening the file and reading and decoding their own buffer.
+
+    Use it as a context manager so that the map is closed afterwards:
+
+        with SniffContext(filepath) as context:
+            mime_type = magic.from_buffer(context.head(MAGIC_BUFFER_SIZE))
+    '''
+    def __init__(self, filepath, data=None, container=None):
+        '''
+        :param data: the file contents as bytes, if it is not a file on disk,
+                     e.g. the start of a member of a zip
+        :param container: the format of the file that it is a member of
+                          (e.g. 'ZIP'), if any
+        '''
+        self.filepath = filepath
+        self.container = container
+        self._text_cache = {}
+        if data is not None:
+            self._file = None
+            self.size = len(data)
+            self.data = data
+            return
+        self._file = open(filepath, 'rb')
+        try:
+            self.size = os.fstat(self._file.fileno()).st_size
+            if self.size:
+                self.data = mmap.mmap(self._file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+            else:
+                # an empty file cannot be mapped
+                self.data = b''
+        except Exception:
+            self._file.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        if self._file:
+            self._file.close()
+
+    def head(self, num_bytes):
+        '''Returns the first num_bytes of the file, as bytes.'''
+        return self.data[:num_bytes]
+
+    def text(self, num_chars, universal_newlines=False):
+        '''Returns the start of the file decoded as ISO-8859-1 (so one byte
+        is one character). Decoded buffers are cached, so detectors asking for
+        the same length share the same string.
+
+        :param universal_newlines: translate \\r\\n and \\r to \\n, like
+                                   opening the file with newline=None
+        '''
+        key = (num_chars, universal_newlines)
+        if key not in self._text_cache:
+            text = self.head(num_chars).decode('ISO-8859-1')
+            if universal_newlines:
+                text = text.replace('\r\n', '\n').replace('\r', '\n')
+            self._text_cache[key] = text
+        return self._text_cache[key]
+
+    def iter_text(self, num_chars, chunk_size):
+        '''Yields the start of the file, decoded as ISO-8859-1, in chunks,
+        so that a detector can stop reading as soon as it knows.'''
+        for offset in range(0, min(num_chars, self.size), chunk_size):
+            yield self.data[offset:min(offset + chunk_size, num_chars)] \
+                .decode('ISO-8859-1')
+
+    def compound_file(self):
+        '''Returns the file parsed as a cfb.CompoundFile (cached), or None if
+        it is not one. Raises cfb.CFBError if its headers are invalid.'''
+        if not hasattr(self, '_compound_file'):
+            self._compound_file = None
+            if cfb.is_cfb(self.head(8)):
+                try:
+                    self._compound_file = cfb.CompoundFile(self.data)
+                except cfb.CFBError as e:
+                    self._compound_file = e
+        if isinstance(self._compound_file, cfb.CFBError):
+            raise self._compound_file
+        return self._compound_file
+
+    def new_map(self):
+        '''Returns a separate map of the same open file, for libraries such
+        as xlrd that close the buffer they are given when they are done.
+        It shares the page cache with the main map, so nothing is re-read.'''
+        if not isinstance(self.data, mmap.mmap):
+            return self.data
+        return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def fileobj(self):
+        '''Returns a seekable file-like object for the file contents, for
+        libraries such as zipfile that want one.'''
+        if isinstance(self.data, mmap.mmap):
+            self.data.seek(0)
+            return self.data
+        return BytesIO(self.data)
+
+
 def sniff_file_format(filepath):
     '''For a given filepath, work out what file format it is.
 
@@ -38,129 +168,384 @@ def sniff_file_format(filepath):
     Note, log is a logger, either a Celery one or a standard Python logging
     one.
     '''
-    format_ = None
     log.info('Sniffing file format of: %s', filepath)
-    filepath_utf8 = filepath.encode('utf8') if isinstance(filepath, unicode) \
-        else filepath
-    mime_type = magic.from_file(filepath_utf8, mime=True)
+    with SniffContext(filepath) as context:
+        format_ = _sniff_file_format(context)
+    if not format_:
+        log.warning('Could not detect format of file: %s', filepath)
+    return format_
+
+
+def _sniff_file_format(context):
+    with timing.stage('libmagic'):
+        mime_type = magic.from_buffer(context.head(MAGIC_BUFFER_SIZE),
+                                      mime=True)
     log.info('Magic detects file as: %s', mime_type)
-    if mime_type:
-        if mime_type in ('application/xml', 'text/xml'):
-            with open(filepath, 'r', encoding='ISO-8859-1') as f:
-                buf = f.read(5000)
-            format_ = get_xml_variant_including_xml_declaration(buf)
-        elif mime_type == 'application/zip':
-            format_ = get_zipped_format(filepath)
-        elif mime_type in ('application/msword', 'application/vnd.ms-office'):
-            # In the past Magic gives the msword mime-type for Word and other
-            # MS Office files too, so use BSD File to be sure which it is.
-            format_ = run_bsd_file(filepath)
-            if not format_ and is_excel(filepath):
-                format_ = {'format': 'XLS'}
-        elif mime_type == 'application/octet-stream':
-            # Excel files sometimes come up as this
-            if is_excel(filepath):
-                format_ = {'format': 'XLS'}
-            else:
-                # e.g. Shapefile
-                format_ = run_bsd_file(filepath)
-            if not format_:
-                with open(filepath, 'r', encoding='ISO-8859-1') as f:
-                    buf = f.read(500)
-                format_ = is_html(buf)
-        elif mime_type == 'text/html':
-            # Magic can mistake IATI for HTML
-            with open(filepath, 'r', encoding='ISO-8859-1') as f:
-                buf = f.read(100)
-            if is_iati(buf):
-                format_ = {'format': 'IATI'}
-        elif mime_type == 'application/csv':
-            with open(filepath, 'r', encoding='ISO-8859-1', newline=None) as f:
-                buf = f.read(10000)
-            if is_csv(buf):
-                format_ = {'format': 'CSV'}
-            elif is_psv(buf):
-                format_ = {'format': 'PSV'}
+    registry = get_detector_registry()
+    format_ = registry.detect(context, mime_type)
+    if format_ or not mime_type:
+        return format_
 
-        if format_:
-            return format_
-
-        format_tuple = ckan_helpers.resource_formats().get(mime_type)
-        if format_tuple:
-            format_ = {'format': format_tuple[1]}
-
-        if not format_:
-            if mime_type.startswith('text/'):
-                # is it JSON?
-                with open(filepath, 'r', encoding='ISO-8859-1', newline=None) as f:
-                    buf = f.read(10000)
-                if is_json(buf):
-                    format_ = {'format': 'JSON'}
-                # is it CSV?
-                elif is_csv(buf):
-                    format_ = {'format': 'CSV'}
-                elif is_psv(buf):
-                    format_ = {'format': 'PSV'}
-
-        if not format_:
-            log.warning('Mimetype not recognised by CKAN as a data format: %s',
-                        mime_type)
+    format_info = get_format_index().get(mime_type)
+    if format_info:
+        format_ = {'format': format_info.format}
+        log.info('Mimetype translates to filetype: %s', format_['format'])
+    # e.g. TXT might be refined to CSV, or no format to JSON
+    refined_format = registry.refine(context, mime_type, format_)
+    if refined_format:
+        return refined_format
+    if not format_:
+        log.warning('Mimetype not recognised by CKAN as a data format: %s',
+                    mime_type)
+    return format_
 
-        if format_:
-            log.info('Mimetype translates to filetype: %s',
+
+# Relative cost of running a detector - the detectors that apply to a file are
+# run cheapest first
+COST_CHEAP = 10  # e.g. a regex over a small buffer
+COST_MODERATE = 20  # e.g. parsing a container's headers
+COST_EXPENSIVE = 30  # e.g. messytables, or running a subprocess
+
+# A high confidence detection is used straight away. A low confidence one is
+# only used if none of the other detectors that apply have high confidence.
+CONFIDENCE_LOW = 'low'
+CONFIDENCE_HIGH = 'high'
+
+
+class Detector(object):
+    '''A file format detector, for registering in the sniff pipeline.
+
+    :param name: unique name. Registering a detector with the same name as an
+                 existing one replaces it.
+    :param detect: function(context, mime_type) that is given the
+                   SniffContext and libmagic\'s mime type, and returns a
+                   format dict or None
+    :param mime_types: the libmagic mime types that it applies to. A type
+                       can end in \'/*\' to match all subtypes, and None
+                       matches when libmagic does not give a mime type.
+                       Defaults to all of them.
+    :param formats: if given, the detector refines a provisional format,
+                    instead of detecting a format from scratch. It runs after
+                    the mime type has been translated to a provisional format
+                    by ckan\'s resource formats, if that is one of these
+                    formats. None matches when there is no provisional format.
+    :param cost: COST_CHEAP, COST_MODERATE or COST_EXPENSIVE
+    :param confidence: CONFIDENCE_HIGH or CONFIDENCE_LOW
+    '''
+    def __init__(self, name, detect, mime_types=None, formats=None,
+                 cost=COST_MODERATE, confidence=CONFIDENCE_HIGH):
+        self.name = name
+        self.detect = detect
+        self.mime_types = tuple(mime_types) if mime_types is not None else None
+        self.formats = tuple(formats) if formats is not None else None
+        self.cost = cost
+        self.confidence = confidence
+
+    def __repr__(self):
+        return '<Detector %s cost=%s confidence=%s>' % (
+            self.name, self.cost, self.confidence)
+
+    def applies_to_mime_type(self, mime_type):
+        if self.mime_types is None:
+            return True
+        for detector_mime_type in self.mime_types:
+            if detector_mime_type is None:
+                if not mime_type:
+                    return True
+            elif detector_mime_type.endswith('/*'):
+                if mime_type and mime_type.startswith(detector_mime_type[:-1]):
+                    return True
+            elif detector_mime_type == mime_type:
+                return True
+        return False
+
+
+class DetectorRegistry(object):
+    '''The detectors that sniff_file_format runs.'''
+    def __init__(self, detectors=()):
+        self._detectors = []
+        for detector in detectors:
+            self.register(detector)
+
+    @property
+    def detectors(self):
+        return list(self._detectors)
+
+    def register(self, detector):
+        for i, existing in enumerate(self._detectors):
+            if existing.name == detector.name:
+                self._detectors[i] = detector
+                return
+        self._detectors.append(detector)
+
+    def unregister(self, name):
+        self._detectors = [detector for detector in self._detectors
+                           if detector.name != name]
+
+    def detect(self, context, mime_type):
+        '''Runs the detectors that apply to the mime type. Returns a format
+        dict or None.'''
+        return self._run([
+            detector for detector in self._detectors
+            if detector.formats is None and
+            detector.applies_to_mime_type(mime_type)], context, mime_type)
+
+    def refine(self, context, mime_type, provisional_format):
+        '''Runs the refining detectors that apply to the provisional format
+        (format dict or None) and mime type. Returns a format dict or None.
+        '''
+        format_name = provisional_format['format'] \
+            if provisional_format else None
+        return self._run([
+            detector for detector in self._detectors
+            if detector.formats is not None and
+            format_name in detector.formats and
+            detector.applies_to_mime_type(mime_type)], context, mime_type)
+
+    def _run(self, detectors, context, mime_type):
+        # sorted() is stable, so equal cost detectors run in the order that
+        # they were registered
+        low_confidence_format = None
+        for detector in sorted(detectors, key=lambda d: d.cost):
+            with timing.stage('detector:%s' % detector.name):
+                format_ = detector.detect(context, mime_type)
+            if not format_:
+                continue
+            log.info('Detector %s detected format: %s', detector.name,
                      format_['format'])
+            if detector.confidence == CONFIDENCE_HIGH:
+                return format_
+            low_confidence_format = low_confidence_format or format_
+        return low_confidence_format
+
+
+def _detect_xml_variant(context, mime_type):
+    return get_xml_variant_including_xml_declaration(context.text(5000))
 
-            if format_['format'] == 'TXT':
-                # is it JSON?
-                with open(filepath, 'r', encoding='ISO-8859-1', newline=None) as f:
-                    buf = f.read(10000)
-                if is_json(buf):
-                    format_ = {'format': 'JSON'}
-                # is it CSV?
-                elif is_csv(buf):
-                    format_ = {'format': 'CSV'}
-                elif is_psv(buf):
-                    format_ = {'format': 'PSV'}
-                # XML files without the "<?xml ... ?>" tag end up here
-                elif is_xml_but_without_declaration(buf):
-                    format_ = get_xml_variant_without_xml_declaration(buf)
-                elif is_ttl(buf):
-                    format_ = {'format': 'TTL'}
-
-            elif format_['format'] == 'HTML':
-                # maybe it has RDFa in it
-                with open(filepath, 'r', encoding='ISO-8859-1') as f:
-                    buf = f.read(100000)
-                if has_rdfa(buf):
-                    format_ = {'format': 'RDFa'}
 
-    else:
-        # Excel files sometimes not picked up by magic, so try alternative
-        if is_excel(filepath):
-            format_ = {'format': 'XLS'}
-        # BSD file picks up some files that Magic misses
-        # e.g. some MS Word files
-        if not format_:
-            format_ = run_bsd_file(filepath)
+def _detect_zipped_format(context, mime_type):
+    return get_zipped_format(context.filepath, context)
 
-    if not format_:
-        log.warning('Could not detect format of file: %s', filepath)
-    return format_
+
+def _detect_compressed_format(context, mime_type):
+    # the contents of compressed files are not decompressed any deeper
+    if not context.container:
+        return get_compressed_format(context, mime_type)
+
+
+def _detect_excel(context, mime_type):
+    if is_excel(context.filepath, context):
+        return {'format': 'XLS'}
+
+
+def _detect_bsd_file(context, mime_type):
+    return run_bsd_file(context.filepath, context)
+
+
+def _detect_html(context, mime_type):
+    return is_html(context.text(500))
+
+
+def _detect_iati(context, mime_type):
+    return is_iati(context.text(100))
+
+
+def _detect_csv(context, mime_type):
+    return run_text_detectors(context.text(10000, universal_newlines=True),
+                              ('CSV', 'PSV'))
+
+
+def _detect_text_format(context, mime_type):
+    return run_text_detectors(context.text(10000, universal_newlines=True),
+                              TEXT_FORMATS)
+
+
+def _detect_txt_format(context, mime_type):
+    return run_text_detectors(context.text(10000, universal_newlines=True),
+                              TXT_FORMATS)
+
+
+def _detect_rdfa(context, mime_type):
+    if scan_rdfa(context.iter_text(RDFA_MAX_SIZE, RDFA_CHUNK_SIZE)):
+        return {'format': 'RDFa'}
+
+
+def builtin_detectors():
+    '''Returns the detectors that ckanext-qa provides.'''
+    return [
+        Detector('xml-variant', _detect_xml_variant,
+                 mime_types=('application/xml', 'text/xml'),
+                 cost=COST_CHEAP),
+        Detector('zip', _detect_zipped_format,
+                 mime_types=('application/zip',),
+                 cost=COST_MODERATE),
+        Detector('compressed', _detect_compressed_format,
+                 mime_types=tuple(COMPRESSED_MIME_TYPES) + (TAR_MIME_TYPE,),
+                 cost=COST_MODERATE),
+        # Magic can mistake IATI for HTML
+        Detector('iati', _detect_iati,
+                 mime_types=('text/html',),
+                 cost=COST_CHEAP),
+        Detector('html', _detect_html,
+                 mime_types=('application/octet-stream',),
+                 cost=COST_CHEAP),
+        # Excel files sometimes come up as octet-stream, or are not picked up
+        # by magic at all
+        Detector('excel', _detect_excel,
+                 mime_types=('application/octet-stream', 'application/msword',
+                             'application/vnd.ms-office', None),
+                 cost=COST_MODERATE),
+        # In the past Magic gives the msword mime-type for Word and other MS
+        # Office files too, so use BSD File to be sure which it is. It also
+        # picks up Shapefiles and some files that Magic misses.
+        Detector('bsd-file', _detect_bsd_file,
+                 mime_types=('application/octet-stream', 'application/msword',
+                             'application/vnd.ms-office', None),
+                 cost=COST_MODERATE),
+        Detector('csv', _detect_csv,
+                 mime_types=('application/csv',),
+                 cost=COST_EXPENSIVE),
+        # Refining detectors
+        Detector('text', _detect_text_format,
+                 mime_types=('text/*',), formats=(None,),
+                 cost=COST_EXPENSIVE),
+        # XML files without the "<?xml ... ?>" tag end up as TXT too
+        Detector('txt', _detect_txt_format,
+                 formats=('TXT',),
+                 cost=COST_EXPENSIVE),
+        # maybe HTML has RDFa in it
+        Detector('rdfa', _detect_rdfa,
+                 formats=('HTML',),
+                 cost=COST_MODERATE),
+    ]
+
+
+_detector_registry = None
+
+
+def get_format_index():
+    # ckanext.qa.lib imports the tasks, which import this module
+    from ckanext.qa.lib import get_format_index
+    return get_format_index()
+
+
+def get_detector_registry():
+    '''Returns the registry of the built-in detectors, plus those from
+    plugins implementing IQASniffer.'''
+    global _detector_registry
+    if _detector_registry is None:
+        from ckan import plugins
+        from ckanext.qa.interfaces import IQASniffer
+        registry = DetectorRegistry(builtin_detectors())
+        for plugin in plugins.PluginImplementations(IQASniffer):
+            for detector in plugin.get_sniff_detectors():
+                registry.register(detector)
+        _detector_registry = registry
+    return _detector_registry
+
+
+def reset_detector_registry():
+    '''Makes the registry get built again, e.g. after plugins change.'''
+    global _detector_registry
+    _detector_registry = None
+
+
+# Text-based formats that a buffer is checked for, in order of preference,
+# when magic says it is text but not which kind
+TEXT_FORMATS = ('JSON', 'CSV', 'PSV')
+# ... and when magic says it is plain text
+TXT_FORMATS = ('JSON', 'CSV', 'PSV', 'XML', 'TTL')
+
+# The pre-filter of run_text_detectors: JSON values can only start with one
+# of these characters; and messytables only sniffs these delimiters, so
+# without any of them a buffer cannot be CSV (and PSV needs the pipe).
+JSON_START_CHARS = frozenset('{["-0123456789tfn')
+CSV_DELIMITERS = ('\t', ',', ';', '|')
+
+
+def _could_be_json(buf):
+    # is_json accepts an empty buffer
+    return not buf or buf[0] in JSON_START_CHARS
+
+
+def _could_be_csv(buf):
+    # each "in" is a search in C, stopping at the first match
+    return any(delimiter in buf for delimiter in CSV_DELIMITERS)
+
+
+def _could_be_psv(buf):
+    return '|' in buf
+
+
+def run_text_detectors(buf, formats=TXT_FORMATS):
+    '''Runs the detectors for the given text-based formats over the buffer,
+    in the order given, and returns the format dict of the first that
+    matches, or None.
+
+    It is not a one-pass classifier: each detector still reads the buffer.
+    But before a detector is run, a cheap pre-filter rules out its format if
+    the buffer cannot be in it - mostly saving the cost of messytables for
+    CSV/PSV when the buffer has none of the delimiters. The pre-filter is
+    only applied when a format's turn comes, so a buffer that the first
+    detector matches costs no more than before. The result is the same as
+    running all the detectors in turn, which test_sniff_format checks on
+    every test fixture.
+
+    :param formats: sequence of format names, out of JSON, CSV, PSV, XML,
+                    TTL, HTML and IATI. e.g. TEXT_FORMATS, TXT_FORMATS
+    '''
+    for format_name in formats:
+        if format_name == 'JSON':
+            if _could_be_json(buf) and is_json(buf):
+                return {'format': 'JSON'}
+        elif format_name == 'CSV':
+            if _could_be_csv(buf) and is_csv(buf):
+                return {'format': 'CSV'}
+        elif format_name == 'PSV':
+            if _could_be_psv(buf) and is_psv(buf):
+                return {'format': 'PSV'}
+        elif format_name == 'XML':
+            if is_xml_but_without_declaration(buf):
+                return get_xml_variant_without_xml_declaration(buf)
+        elif format_name == 'TTL':
+            if is_ttl(buf):
+                return {'format': 'TTL'}
+        elif format_name == 'HTML':
+            format_ = is_html(buf)
+            if format_:
+                return format_
+        elif format_name == 'IATI':
+            format_ = is_iati(buf)
+            if format_:
+                return format_
+        else:
+            raise ValueError('Unknown text format: %r' % format_name)
+
+
+_json_string = '"[^"]*"'
+_json_string_re = re.compile(_json_string)
+_json_number_re = re.compile(r'-?\d+(\.\d+)?([eE][+-]?\d+)?')
+_json_extra_values_re = re.compile('true|false|null')
+_json_object_start_re = re.compile(r'{%s:\s?' % _json_string)
+_json_object_middle_re = re.compile(r'%s:\s?' % _json_string)
+_json_object_end_re = re.compile('}')
+_json_comma_re = re.compile(r',\s?')
+_json_array_start_re = re.compile(r'\[')
+_json_array_end_re = re.compile(r'\]')
 
 
 def is_json(buf):
     '''Returns whether this text buffer (potentially truncated) is in
     JSON format.'''
-    string = '"[^"]*"'
-    string_re = re.compile(string)
-    number_re = re.compile(r'-?\d+(\.\d+)?([eE][+-]?\d+)?')
-    extra_values_re = re.compile('true|false|null')
-    object_start_re = re.compile(r'{%s:\s?' % string)
-    object_middle_re = re.compile(r'%s:\s?' % string)
-    object_end_re = re.compile('}')
-    comma_re = re.compile(r',\s?')
-    array_start_re = re.compile(r'\[')
-    array_end_re = re.compile(r'\]')
+    string_re = _json_string_re
+    number_re = _json_number_re
+    extra_values_re = _json_extra_values_re
+    object_start_re = _json_object_start_re
+    object_middle_re = _json_object_middle_re
+    object_end_re = _json_object_end_re
+    comma_re = _json_comma_re
+    array_start_re = _json_array_start_re
+    array_end_re = _json_array_end_re
     any_value_regexs = [string_re, number_re, object_start_re, array_start_re, extra_values_re]
 
     # simplified state machine - just looks at stack of object/array and
@@ -269,10 +654,20 @@ def _is_spreadsheet(table_set, format):
     return False
 
 
+_html_re = re.compile(
+    r'.{0,3}\s*(<\?xml[^>]*>\s*)?(<!doctype[^>]*>\s*)?<html[^>]*>',
+    re.IGNORECASE)
+_iati_re = re.compile(
+    r'.{0,3}\s*(<\?xml[^>]*>\s*)?(<!doctype[^>]*>\s*)?<iati-(activities|organisations)[^>]*>',
+    re.IGNORECASE)
+_xml_re = re.compile(
+    r'.{0,3}\s*(<\?xml[^>]*>\s*)?(<!doctype[^>]*>\s*)?<([^>\s]*)([^>]*)>',
+    re.IGNORECASE)
+
+
 def is_html(buf):
     '''If this buffer is HTML, return that format type, else None.'''
-    xml_re = r'.{0,3}\s*(<\?xml[^>]*>\s*)?(<!doctype[^>]*>\s*)?<html[^>]*>'
-    match = re.match(xml_re, buf, re.IGNORECASE)
+    match = _html_re.match(buf)
     if match:
         log.info('HTML tag detected')
         return {'format': 'HTML'}
@@ -281,8 +676,7 @@ def is_html(buf):
 
 def is_iati(buf):
     '''If this buffer is IATI format, return that format type, else None.'''
-    xml_re = r'.{0,3}\s*(<\?xml[^>]*>\s*)?(<!doctype[^>]*>\s*)?<iati-(activities|organisations)[^>]*>'
-    match = re.match(xml_re, buf, re.IGNORECASE)
+    match = _iati_re.match(buf)
     if match:
         log.info('IATI tag detected')
         return {'format': 'IATI'}
@@ -292,8 +686,7 @@ def is_iati(buf):
 def is_xml_but_without_declaration(buf):
     '''Decides if this is a buffer of XML, but missing the usual <?xml ...?>
     tag.'''
-    xml_re = r'.{0,3}\s*(<\?xml[^>]*>\s*)?(<!doctype[^>]*>\s*)?<([^>\s]*)([^>]*)>'
-    match = re.match(xml_re, buf, re.IGNORECASE)
+    match = _xml_re.match(buf)
     if match:
         top_level_tag_name, top_level_tag_attributes = match.groups()[-2:]
         if 'xmlns:' not in top_level_tag_attributes and \
@@ -336,8 +729,11 @@ def get_xml_variant_without_xml_declaration(buf):
         p.Parse(buf.encode('ISO-8859-1'))
     except GotFirstTag as e:
         top_level_tag_name = str(e).lower()
-    except xml.sax.SAXException as e:
-        log.info('Sax parse error: %s %s', e, buf)
+    except xml.parsers.expat.ExpatError as e:
+        log.info('XML parse error: %s %s', e, buf)
+        return {'format': 'XML'}
+    else:
+        log.info('XML has no top level tag: %s', buf)
         return {'format': 'XML'}
 
     log.info('Top level tag detected as: %s', top_level_tag_name)
@@ -353,52 +749,134 @@ def get_xml_variant_without_xml_declaration(buf):
     if top_level_tag_name.lower() in ('coveragedescriptions', 'capabilities') and \
             'xmlns="http://www.opengis.net/wcs/' in buf:
         top_level_tag_name = 'wcs'
-    format_tuple = ckan_helpers.resource_formats().get(top_level_tag_name)
-    if format_tuple:
-        format_ = {'format': format_tuple[1]}
-        log.info('XML variant detected: %s', format_tuple[2])
+    format_info = get_format_index().get(top_level_tag_name)
+    if format_info:
+        format_ = {'format': format_info.format}
+        log.info('XML variant detected: %s', format_info.title)
         return format_
     log.warning('Did not recognise XML format: %s', top_level_tag_name)
     return {'format': 'XML'}
 
 
-def has_rdfa(buf):
+# RDFa is looked for in this much of an HTML file at most
+RDFA_MAX_SIZE = 100000
+# and in no more than this much of the body, after </head>
+RDFA_BODY_BUDGET = 32 * 1024
+RDFA_CHUNK_SIZE = 8 * 1024
+# a partial tag at the end of a chunk longer than this is given up on
+RDFA_MAX_TAG_SIZE = 8 * 1024
+
+_rdfa_about_re = re.compile(r'<[^>]+\sabout="[^"]+"[^>]*>')
+_rdfa_property_re = re.compile(r'<[^>]+\sproperty="[^"]+"[^>]*>')
+_end_of_head_re = re.compile(r'</head\s*>', re.IGNORECASE)
+
+
+def has_rdfa(buf, body_budget=None):
     '''If the buffer HTML contains RDFa then this returns True'''
-    # quick check for the key words
-    if 'about=' not in buf or 'property=' not in buf:
-        log.debug('Not RDFA')
-        return False
+    return scan_rdfa([buf], body_budget)
 
-    # more rigorous check for them as tag attributes
-    about_re = r'<[^>]+\sabout="[^"]+"[^>]*>'
-    property_re = r'<[^>]+\sproperty="[^"]+"[^>]*>'
-    # remove CR to catch tags spanning more than one line
-    # buf = re.sub('\r\n', ' ', buf)
-    if not re.search(about_re, buf):
-        log.debug('Not RDFA')
-        return False
-    if not re.search(property_re, buf):
-        log.debug('Not RDFA')
-        return False
-    log.info('RDFA tags found in HTML')
-    return True
 
+def scan_rdfa(chunks, body_budget=None):
+    '''If the HTML, given as an iterable of text chunks, contains RDFa then
+    this returns True.
 
-def get_zipped_format(filepath):
+    The chunks are only read until both an about= and a property= attribute
+    have been found in tags, or body_budget characters past </head> (default
+    qa.rdfa_body_budget or RDFA_BODY_BUDGET).
+    '''
+    if body_budget is None:
+        body_budget = toolkit.asint(config.get('qa.rdfa_body_budget',
+                                               RDFA_BODY_BUDGET))
+    found_about = found_property = False
+    # the end of the previous chunk, in case a tag spans the chunks
+    carry = ''
+    budget_left = None  # until </head> is found
+    for chunk in chunks:
+        window = carry + chunk
+        if budget_left is None:
+            match = _end_of_head_re.search(window)
+            if match:
+                window = window[:match.end() + body_budget]
+                budget_left = body_budget - (len(window) - match.end())
+        else:
+            window = window[:len(carry) + budget_left]
+            budget_left -= len(window) - len(carry)
+        # quick check for the key words, then more rigorous check for them
+        # as tag attributes
+        if not found_about and 'about=' in window:
+            found_about = bool(_rdfa_about_re.search(window))
+        if not found_property and 'property=' in window:
+            found_property = bool(_rdfa_property_re.search(window))
+        if found_about and found_property:
+            log.info('RDFA tags found in HTML')
+            return True
+        if budget_left is not None and budget_left <= 0:
+            log.debug('Not RDFA - none near the start of the body')
+            return False
+        # carry over a tag that is not closed yet
+        tag_start = window.find('<', window.rfind('>') + 1)
+        carry = window[tag_start:] \
+            if tag_start != -1 and len(window) - tag_start <= RDFA_MAX_TAG_SIZE \
+            else ''
+    log.debug('Not RDFA')
+    return False
+
+
+SHAPEFILE_EXTENSIONS = frozenset(('shp', 'dbf', 'shx'))
+GTFS_FILENAMES = frozenset(('agency.txt', 'stops.txt', 'routes.txt',
+                            'trips.txt', 'stop_times.txt', 'calendar.txt'))
+# A zip's members are tallied until the most popular (of the most open)
+# extension is stable: it has not changed since half as many members had been
+# seen, and its lead over the runner-up is ZIP_MAJORITY_Z standard deviations
+# (a sign test). Only checked every ZIP_MAJORITY_MIN_MEMBERS members.
+ZIP_MAJORITY_MIN_MEMBERS = 1000
+ZIP_MAJORITY_Z = 3
+# Zip member sniffing budget defaults - per archive
+ZIP_MEMBER_SNIFF_MAX_MEMBERS = 5
+ZIP_MEMBER_SNIFF_MAX_BYTES = 1024 * 1024
+ZIP_MEMBER_SNIFF_MAX_SECONDS = 2.0
+# the most of one member that is decompressed and sniffed
+ZIP_MEMBER_SNIFF_PREFIX_SIZE = 128 * 1024
+
+
+def get_zipped_format(filepath, context=None):
     '''For a given zip file, return the format of file inside.
     For multiple files, choose by the most open, and then by the most
-    popular extension.'''
-    from ckanext.qa.lib import resource_format_scores
-    # just check filename extension of each file inside
+    popular extension.
+
+    The member names are read from the central directory one at a time, and
+    it stops as soon as it finds a Shapefile or GTFS, or the most popular
+    extension is stable.
+
+    If qa.zip_member_sniff is enabled, the start of the members with the top
+    extensions are sniffed too, and the format they are sniffed as wins over
+    their extension if it refines it - i.e. it scores at least as much - so
+    that e.g. .csv members are not demoted to TXT. The sniffing of each zip
+    is limited by qa.zip_member_sniff.max_members, max_bytes and
+    max_seconds.
+
+    :param context: SniffContext for the file, if it is already open
+    '''
+    if context is None:
+        with SniffContext(filepath) as context:
+            return get_zipped_format(filepath, context)
+    member_sniffer = None
+    # members of a member are not sniffed
+    if toolkit.asbool(config.get('qa.zip_member_sniff', False)) and \
+            not context.container:
+        member_sniffer = ZipMemberSniffer(
+            max_members=toolkit.asint(config.get(
+                'qa.zip_member_sniff.max_members',
+                ZIP_MEMBER_SNIFF_MAX_MEMBERS)),
+            max_bytes=toolkit.asint(config.get(
+                'qa.zip_member_sniff.max_bytes', ZIP_MEMBER_SNIFF_MAX_BYTES)),
+            max_seconds=float(config.get(
+                'qa.zip_member_sniff.max_seconds',
+                ZIP_MEMBER_SNIFF_MAX_SECONDS)))
     try:
-        # note: Cannot use "with" with a zipfile before python 2.7
-        #       so we have to close it manually.
-        zip = zipfile.ZipFile(filepath, 'r')
-        try:
-            filepaths = zip.namelist()
-        finally:
-            zip.close()
-    except zipfile.BadZipfile as e:
+        zip_directory = ZipDirectory(context.data)
+        return _get_zipped_format(zip_directory, member_sniffer)
+    except ZipDirectoryError as e:
         log.info('Zip file open raised error %s: %s',
                  e, e.args)
         return
@@ -407,60 +885,373 @@ def get_zipped_format(filepath):
                     e, e.args)
         return
 
-    # Shapefile check - a Shapefile is a zip containing specific files:
-    # .shp, .dbf and .shx amongst others
-    extensions = set([f.split('.')[-1].lower() for f in filepaths])
-    if len(extensions & set(('shp', 'dbf', 'shx'))) == 3:
-        log.info('Shapefile detected')
-        return {'format': 'SHP'}
-
-    # GTFS check - a GTFS is a zip which containing specific filenames
-    filenames = set((os.path.basename(f) for f in filepaths))
-    if not (set(('agency.txt', 'stops.txt', 'routes.txt', 'trips.txt',
-                 'stop_times.txt', 'calendar.txt')) - set(filenames)):
-        log.info('GTFS detected')
-        return {'format': 'GTFS'}
 
+def _get_zipped_format(zip_directory, member_sniffer=None):
+    format_index = get_format_index()
+    max_candidates = member_sniffer.max_members if member_sniffer else 0
+    # just check filename extension of each file inside
+    extensions = set()
+    filenames = set()
     top_score = 0
     top_scoring_extension_counts = defaultdict(int)  # extension: number_of_files
-    for filepath in filepaths:
+    # the first few members of each extension, to sniff
+    candidates = defaultdict(list)  # extension: [ZipEntry, ...]
+    leader = None
+    leader_since = 0
+    num_members = 0
+    for entry in zip_directory.iter_entries():
+        filepath = entry.name
+        num_members += 1
         extension = os.path.splitext(filepath)[-1][1:].lower()
-        format_tuple = ckan_helpers.resource_formats().get(extension)
-        if format_tuple:
-            score = resource_format_scores().get(format_tuple[1])
+
+        # Shapefile check - a Shapefile is a zip containing specific files:
+        # .shp, .dbf and .shx amongst others
+        extensions.add(filepath.split('.')[-1].lower())
+        if SHAPEFILE_EXTENSIONS <= extensions:
+            log.info('Shapefile detected')
+            return {'format': 'SHP'}
+
+        # GTFS check - a GTFS is a zip which containing specific filenames
+        filenames.add(os.path.basename(filepath))
+        if GTFS_FILENAMES <= filenames:
+            log.info('GTFS detected')
+            return {'format': 'GTFS'}
+
+        if len(candidates[extension]) < max_candidates and \
+                not filepath.endswith('/'):
+            candidates[extension].append(entry)
+
+        format_info = format_index.get(extension)
+        if format_info:
+            score = format_info.score
             if score is not None and score > top_score:
                 top_score = score
                 top_scoring_extension_counts = defaultdict(int)
             if score == top_score:
                 top_scoring_extension_counts[extension] += 1
         else:
-            log.info('Zipped file of unknown extension: "%s" (%s)',
-                     extension, filepath)
-    if not top_scoring_extension_counts:
-        log.info('Zip has no known extensions: %s', filepath)
-        return {'format': 'ZIP'}
+            log.debug('Zipped file of unknown extension: "%s" (%s)',
+                      extension, filepath)
+
+        if num_members % ZIP_MAJORITY_MIN_MEMBERS == 0:
+            new_leader, stable = _zip_majority(top_scoring_extension_counts)
+            if new_leader != leader:
+                leader = new_leader
+                leader_since = num_members
+            elif stable and leader_since <= num_members // 2:
+                log.info('Zip file\'s most popular extension "%s" is stable '
+                         'after %s members', leader, num_members)
+                break
 
     top_scoring_extension_counts = sorted(top_scoring_extension_counts.items(),
                                           key=lambda x: x[1])
+    if member_sniffer:
+        # sniff members of the top extensions first, or of any extension if
+        # none are known
+        extensions_to_sniff = [extension for extension, count
+                               in reversed(top_scoring_extension_counts)] or \
+            list(candidates.keys())
+        format_ = member_sniffer.sniff(
+            zip_directory,
+            [entry for extension in extensions_to_sniff
+             for entry in candidates[extension]])
+        if format_:
+            format_info = format_index.get(format_['format'])
+            sniffed_score = format_info.score if format_info else None
+            if not top_scoring_extension_counts or \
+                    (sniffed_score is not None and sniffed_score >= top_score):
+                return format_
+            log.info('Zip members sniffed as %s, which scores less than '
+                     'their extension, so it is ignored', format_['format'])
+
+    if not top_scoring_extension_counts:
+        log.info('Zip has no known extensions')
+        return {'format': 'ZIP'}
+
     top_extension = top_scoring_extension_counts[-1][0]
     log.info('Zip file\'s most popular extension is "%s" (All extensions: %r)',
-             top_extension, top_scoring_extension_counts)
-    format_tuple = ckan_helpers.resource_formats()[top_extension]
-    format_ = {'format': format_tuple[1],
+             top_extension, top_scoring_extension_counts[-20:])
+    format_info = format_index.get(top_extension)
+    format_ = {'format': format_info.format,
                'container': 'ZIP'}
-    log.info('Zipped file format detected: %s', format_tuple[2])
+    log.info('Zipped file format detected: %s', format_info.title)
     return format_
 
 
-def is_excel(filepath):
+class ZipMemberSniffer(object):
+    '''Sniffs the content of zip members, within a budget for the whole
+    zip.'''
+    def __init__(self, max_members, max_bytes, max_seconds):
+        self.max_members = max_members
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+
+    def sniff(self, zip_directory, entries):
+        '''Sniffs the start of the given members, in order, until the budget
+        runs out, and returns the most common format found (with container
+        ZIP), or None.'''
+        deadline = time.time() + self.max_seconds
+        bytes_left = self.max_bytes
+        formats = []
+        for entry in entries[:self.max_members]:
+            if bytes_left <= 0 or time.time() > deadline:
+                log.info('Zip member sniffing budget used up')
+                break
+            try:
+                data = zip_directory.read_prefix(
+                    entry, min(bytes_left, ZIP_MEMBER_SNIFF_PREFIX_SIZE),
+                    deadline)
+            except ZipDirectoryError as e:
+                log.info('Could not read zip member %s: %s', entry.name, e)
+                continue
+            bytes_left -= len(data)
+            if data:
+                formats.append(_sniff_member(entry.name, data, 'ZIP'))
+        top_format = _most_common_format(formats)
+        if not top_format:
+            return None
+        log.info('Zipped file format detected by sniffing members: %s',
+                 top_format)
+        return {'format': top_format, 'container': 'ZIP'}
+
+
+def _sniff_member(name, data, container):
+    '''Sniffs the (start of the) contents of a file that is inside a
+    container, and returns the format name or None.'''
+    with SniffContext(name, data=data, container=container) as context:
+        format_ = _sniff_file_format(context)
+    log.info('%s member %s sniffed as: %s', container, name,
+             format_['format'] if format_ else None)
+    # a member that is itself a container is not sniffed any deeper
+    if format_ and format_['format'] not in CONTAINER_FORMATS:
+        return format_['format']
+
+
+def _most_common_format(formats):
+    '''Returns the most common of the format names (ignoring None), or the
+    first of them if they are equally common.'''
+    formats = [format_ for format_ in formats if format_]
+    if not formats:
+        return None
+    return max(formats, key=lambda format_: (formats.count(format_),
+                                             -formats.index(format_)))
+
+
+def _zip_majority(extension_counts):
+    '''Returns the leading extension and whether its lead over the runner-up
+    is statistically significant.'''
+    if not extension_counts:
+        return None, False
+    counts = sorted(extension_counts.items(), key=lambda x: x[1])
+    top_count = counts[-1][1]
+    runner_up_count = counts[-2][1] if len(counts) > 1 else 0
+    stable = (top_count - runner_up_count) > \
+        ZIP_MAJORITY_Z * (top_count + runner_up_count) ** 0.5
+    return counts[-1][0], stable
+
+
+# Formats that contain other files, which are only sniffed one level deep
+CONTAINER_FORMATS = ('ZIP', 'GZ', 'TAR')
+# Mime types of single-file compression formats, and the container name
+COMPRESSED_MIME_TYPES = {
+    'application/gzip': 'GZ',
+    'application/x-gzip': 'GZ',
+    'application/x-bzip2': 'BZ2',
+    'application/x-xz': 'XZ',
+}
+TAR_MIME_TYPE = 'application/x-tar'
+# How much of a compressed file is decompressed to sniff what is inside
+COMPRESSED_SNIFF_SIZE = 256 * 1024
+DECOMPRESS_CHUNK_SIZE = 16 * 1024
+# The most members of a tar that are sniffed
+TAR_SNIFF_MAX_MEMBERS = 5
+TAR_BLOCK_SIZE = 512
+
+
+def get_compressed_format(context, mime_type):
+    '''For a gzip, bzip2, xz or tar file, returns the format of the file
+    inside, with the container format(s) e.g. {'format': 'CSV', 'container':
+    'GZ'} or {'format': 'CSV', 'container': 'TAR.GZ'}. Returns None if it
+    cannot tell.
+
+    Only the start of a compressed file is decompressed, as a stream in
+    memory, and only the members of a tar that are in that start are sniffed.
+    '''
+    if mime_type == TAR_MIME_TYPE:
+        return _get_tar_format(context.head(COMPRESSED_SNIFF_SIZE), 'TAR')
+    container = COMPRESSED_MIME_TYPES[mime_type]
+    data = decompress_head(context.data, container)
+    if not data:
+        return None
+    if is_tar(data):
+        return _get_tar_format(data, 'TAR.' + container)
+    # sniff it as the file with the compression extension removed
+    name = context.filepath
+    if name and '.' in os.path.basename(name):
+        name = os.path.splitext(name)[0]
+    format_ = _sniff_member(name, data, container)
+    if format_:
+        log.info('Compressed file format detected: %s', format_)
+        return {'format': format_, 'container': container}
+
+
+def _get_tar_format(data, container):
+    members = (member for member in iter_tar_members(data) if member[1])
+    formats = [_sniff_member(name, member_data, container)
+               for name, member_data
+               in itertools.islice(members, TAR_SNIFF_MAX_MEMBERS)]
+    format_ = _most_common_format(formats)
+    if format_:
+        log.info('Tar file format detected: %s', format_)
+        return {'format': format_, 'container': container}
+    if container != 'TAR':
+        # at least the compressed file is a tar
+        return {'format': 'TAR', 'container': container.split('.', 1)[1]}
+
+
+def decompress_head(data, container, max_bytes=COMPRESSED_SNIFF_SIZE):
+    '''Returns the first max_bytes of a GZ, BZ2 or XZ compressed file,
+    decompressed. It decompresses a chunk at a time and stops when it has
+    enough, so the size of the whole file does not matter. Returns None if it
+    cannot be decompressed.'''
+    if container == 'GZ':
+        # wbits for the gzip header and trailer
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif container == 'BZ2':
+        decompressor = bz2.BZ2Decompressor()
+    elif container == 'XZ' and lzma:
+        decompressor = lzma.LZMADecompressor()
+    else:
+        log.info('Cannot decompress %s', container)
+        return None
+    output = []
+    length = 0
+    offset = 0
+    while offset < len(data) and length < max_bytes:
+        chunk = data[offset:offset + DECOMPRESS_CHUNK_SIZE]
+        offset += len(chunk)
+        try:
+            try:
+                # max_length bounds the output, however compressible it is
+                decompressed = decompressor.decompress(chunk,
+                                                       max_bytes - length)
+            except TypeError:
+                # python 2's bz2 has no max_length, but the chunks are small
+                decompressed = decompressor.decompress(chunk)
+        except Exception as e:
+            log.info('Could not decompress %s: %s', container, e)
+            break
+        output.append(decompressed)
+        length += len(decompressed)
+        if getattr(decompressor, 'eof', False):
+            break
+    return b''.join(output)[:max_bytes] or None
+
+
+def is_tar(buf):
+    # POSIX (ustar) and GNU tars have this magic in the first header
+    return buf[257:262] == b'ustar'
+
+
+def iter_tar_members(data):
+    '''Yields (name, contents) of the regular files in a tar, as far as
+    the data goes - the last one may be truncated.'''
+    offset = 0
+    long_name = None
+    while offset + TAR_BLOCK_SIZE <= len(data):
+        header = data[offset:offset + TAR_BLOCK_SIZE]
+        if not header.strip(b'\0'):
+            # end of archive
+            return
+        try:
+            size = int(header[124:136].strip(b'\0 ') or b'0', 8)
+        except ValueError:
+            log.info('Bad tar header at %s', offset)
+            return
+        type_ = header[156:157]
+        start = offset + TAR_BLOCK_SIZE
+        contents = data[start:start + size]
+        if type_ == b'L':
+            # GNU long name, for the member that follows
+            long_name = contents.split(b'\0', 1)[0]
+        else:
+            name = long_name or header[:100].split(b'\0', 1)[0]
+            prefix = header[345:500].split(b'\0', 1)[0]
+            if prefix and not long_name:
+                name = prefix + b'/' + name
+            long_name = None
+            if type_ in (b'0', b'\0', b'7'):
+                yield name.decode('utf-8', 'replace'), contents
+        offset = start + (size + TAR_BLOCK_SIZE - 1) // TAR_BLOCK_SIZE * \
+            TAR_BLOCK_SIZE
+
+
+# BIFF "beginning of file" record ids for BIFF2, 3, 4 and 5/8
+BIFF_BOF_RECORDS = (b'\x09\x00', b'\x09\x02', b'\x09\x04', b'\x09\x08')
+
+
+def is_excel(filepath, context=None, full_parse=None):
+    '''Returns whether the file is an Excel (.xls) workbook.
+
+    Only the headers are checked: that it is a compound file with a Workbook
+    (or Book) stream starting with a BIFF record. Giant spreadsheets are
+    therefore cheap to identify. xlrd is only used for compound files whose
+    headers cannot be read (with on_demand loading) and for BIFF2-4 files,
+    which are small and not in a compound file. The whole workbook is parsed
+    by xlrd if full_parse is True, or qa.excel_full_parse is set.
+
+    :param context: SniffContext for the file, if it is already open
+    '''
+    if full_parse is None:
+        full_parse = toolkit.asbool(config.get('qa.excel_full_parse', False))
+    if context is None:
+        with SniffContext(filepath) as context:
+            return is_excel(filepath, context, full_parse)
+    if full_parse:
+        return _is_excel_by_xlrd(context, on_demand=False)
+
+    try:
+        compound_file = context.compound_file()
+    except cfb.CFBError as e:
+        log.info('Could not read compound file headers (%s) - '
+                 'trying xlrd', e)
+        return _is_excel_by_xlrd(context, on_demand=True)
+    if compound_file:
+        workbook = compound_file.find(u'Workbook', u'Book')
+        if not workbook:
+            log.info('Not Excel - compound file has no Workbook stream')
+            return False
+        try:
+            bof = compound_file.read_stream(workbook, max_size=2)
+        except cfb.CFBError as e:
+            log.info('Not Excel - could not read Workbook stream: %s', e)
+            return False
+        if bof not in BIFF_BOF_RECORDS:
+            log.info('Not Excel - Workbook stream does not start with BOF')
+            return False
+        log.info('Excel file detected from its Workbook stream')
+        return True
+    if context.head(2) in BIFF_BOF_RECORDS:
+        # BIFF2-4 worksheets, which xlrd cannot load on demand
+        return _is_excel_by_xlrd(context, on_demand=False)
+    log.info('Not Excel - no compound file or BIFF header')
+    return False
+
+
+def _is_excel_by_xlrd(context, on_demand):
+    workbook_map = context.new_map()
     try:
-        xlrd.open_workbook(filepath)
+        with timing.stage('xlrd'):
+            xlrd.open_workbook(file_contents=workbook_map, on_demand=on_demand)
     except Exception as e:
         log.info('Not Excel - failed to load: %s %s', e, e.args)
         return False
     else:
         log.info('Excel file opened successfully')
         return True
+    finally:
+        if hasattr(workbook_map, 'close'):
+            workbook_map.close()
 
 
 # same as the python 2.7 subprocess.check_output
@@ -478,38 +1269,94 @@ def check_output(*popenargs, **kwargs):
     return output
 
 
-def run_bsd_file(filepath):
-    '''Run the BSD command-line tool "file" to determine file type. Returns
-    a format dict or None if it fails.'''
-    result = check_output(['file', filepath])
-    match = re.search(b'Name of Creating Application: ([^,]*),', result)
-    if match:
-        app_name = match.groups()[0]
-        format_map = {'Microsoft Office PowerPoint': 'ppt',
-                      'Microsoft PowerPoint': 'ppt',
-                      'Microsoft Excel': 'xls',
-                      'Microsoft Office Word': 'doc',
-                      'Microsoft Word 10.0': 'doc',
-                      'Microsoft Macintosh Word': 'doc',
-                      }
-        if app_name in format_map:
-            extension = format_map[app_name]
-            format_tuple = ckan_helpers.resource_formats()[extension]
-            log.info('"file" detected file format: %s',
-                     format_tuple[2])
-            return {'format': format_tuple[1]}
-    match = re.search(b': ESRI Shapefile', result)
-    if match:
+# "Name of Creating Application" values that the "file" tool reports for
+# MS Office documents, and the extension of their format
+CREATING_APPLICATION_EXTENSIONS = {
+    'Microsoft Office PowerPoint': 'ppt',
+    'Microsoft PowerPoint': 'ppt',
+    'Microsoft Excel': 'xls',
+    'Microsoft Office Word': 'doc',
+    'Microsoft Word 10.0': 'doc',
+    'Microsoft Macintosh Word': 'doc',
+}
+
+
+def run_bsd_file(filepath, context=None):
+    '''Determine the file type as the BSD command-line tool "file" does,
+    for the files it is used for here - MS Office documents, by the name of
+    their creating application, and ESRI Shapefiles. Returns a format dict or
+    None if it fails.
+
+    By default the file's headers are parsed in-process. Set
+    qa.bsd_file_mode = subprocess to run the "file" command instead.
+
+    :param context: SniffContext for the file, if it is already open
+    '''
+    if config.get('qa.bsd_file_mode', 'native') == 'subprocess' and \
+            not (context and context.container):
+        return _run_bsd_file_subprocess(filepath)
+    if context is None:
+        with SniffContext(filepath) as context:
+            return _run_bsd_file_native(context)
+    return _run_bsd_file_native(context)
+
+
+def _run_bsd_file_native(context):
+    app_name = None
+    try:
+        compound_file = context.compound_file()
+        if compound_file:
+            app_name = cfb.get_creating_application(compound_file)
+    except cfb.CFBError as e:
+        log.info('Could not read compound file: %s', e)
+    format_ = _bsd_file_format(app_name,
+                               is_shapefile_header(context.head(100)))
+    if not format_:
+        log.info('Could not determine file format of "%s" from its headers'
+                 ' (creating application: %r)', context.filepath, app_name)
+    return format_
+
+
+def _run_bsd_file_subprocess(filepath):
+    with timing.stage('file_subprocess'):
+        result = check_output(['file', filepath]).decode('utf8', 'replace')
+    match = re.search('Name of Creating Application: ([^,]*),', result)
+    app_name = match.groups()[0] if match else None
+    format_ = _bsd_file_format(app_name,
+                               bool(re.search(': ESRI Shapefile', result)))
+    if not format_:
+        log.info('"file" could not determine file format of "%s": %s',
+                 filepath, result)
+    return format_
+
+
+def _bsd_file_format(app_name, is_shapefile):
+    if app_name in CREATING_APPLICATION_EXTENSIONS:
+        extension = CREATING_APPLICATION_EXTENSIONS[app_name]
+        format_info = get_format_index().get(extension)
+        log.info('"file" detected file format: %s',
+                 format_info.title)
+        return {'format': format_info.format}
+    if is_shapefile:
         format_ = {'format': 'SHP'}
         log.info('"file" detected file format: %s',
                  format_['format'])
         return format_
-    log.info('"file" could not determine file format of "%s": %s',
-             filepath, result)
 
 
-def is_ttl(buf):
-    '''If the buffer is a Turtle RDF file then return True.'''
+def is_shapefile_header(buf):
+    '''Returns whether the bytes are the start of an ESRI Shapefile (.shp) -
+    file code 9994 followed by five unused zero integers.'''
+    return len(buf) >= 100 and buf[:4] == b'\x00\x00\x27\x0a' and \
+        buf[4:24] == b'\x00' * 20
+
+
+def is_ttl(buf, max_steps=None):
+    '''If the buffer is a Turtle RDF file then return True.
+
+    :param max_steps: the most tokens to read looking for triples - defaults
+                      to TURTLE_MAX_STEPS
+    '''
     # Turtle spec: "Turtle documents may have the strings '@prefix' or '@base' (case dependent) near the
     # beginning of the document."
     at_re = '^@(prefix|base) '
@@ -520,12 +1367,107 @@ def is_ttl(buf):
 
     # Alternatively look for several triples
     num_required_triples = 5
-    ignore, num_replacements = turtle_regex().subn('', buf, num_required_triples)
-    if num_replacements >= num_required_triples:
-        log.info('Turtle RDF detected - %s triples' % num_replacements)
+    num_triples = count_turtle_triples(buf, num_required_triples, max_steps)
+    if num_triples >= num_required_triples:
+        log.info('Turtle RDF detected - %s triples' % num_triples)
         return True
 
-    log.debug('Not Turtle RDF - triples not detected (%i)' % num_replacements)
+    log.debug('Not Turtle RDF - triples not detected (%i)' % num_triples)
+
+
+# The most tokens that count_turtle_triples reads (at least one character
+# each), whatever the length of the buffer
+TURTLE_MAX_STEPS = 10000
+
+# Turtle tokens. Each alternative can only match one way, so a match (or
+# failure) takes time linear in the length of the token - there is no
+# catastrophic backtracking, as there was with turtle_regex.
+_turtle_datatype = r'(?:@[A-Za-z0-9]+(?:-[A-Za-z0-9]+)*|\^\^(?:<[^\s<>]*>|[\w:-]+(?:\.[\w:-]+)*))?'
+_turtle_token_re = re.compile(
+    r'(?P<ws>\s*)(?:'
+    r'(?P<term>(?:'
+    r'<[^\s<>]+>'
+    r'|_:[\w-]+(?:\.[\w-]+)*'
+    r'|"""(?:[^"\\]|\\.|"(?!""))+"""' + _turtle_datatype +
+    r"|'''(?:[^'\\]|\\.|'(?!''))+'''" + _turtle_datatype +
+    r'|"(?:[^"\\\n]|\\.)+"' + _turtle_datatype +
+    r"|'(?:[^'\\\n]|\\.)+'" + _turtle_datatype +
+    r'|[+-]?(?:[0-9]+(?:\.[0-9]+)?|\.[0-9]+)(?:[eE][+-]?[0-9]+)?'
+    r'|true|false'
+    r')(?=[\s;.,]|$))'
+    r'|(?P<punctuation>[;.])'
+    r'|(?P<other>[^\s;.]+|.)|$)')
+_turtle_end_of_line_re = re.compile(r'[^\S\n]*(?:\n|$)')
+
+
+def _turtle_tokens(buf, max_steps):
+    '''Yields the Turtle tokens in the buffer as tuples:
+    (kind, at_start_of_line, after_whitespace, at_end_of_line)
+    where kind is 'term', ';', '.' or 'other'.'''
+    pos = 0
+    end = len(buf)
+    for _ in range(max_steps):
+        if pos >= end:
+            return
+        match = _turtle_token_re.match(buf, pos)
+        kind = match.lastgroup
+        if kind == 'ws':
+            # trailing whitespace
+            return
+        start = match.start(kind)
+        pos = match.end()
+        at_start_of_line = start == 0 or buf[start - 1] == '\n'
+        at_end_of_line = False
+        if kind == 'punctuation':
+            kind = match.group(kind)
+            at_end_of_line = bool(_turtle_end_of_line_re.match(buf, pos))
+        yield kind, at_start_of_line, start > match.start(), at_end_of_line
+    log.info('Turtle detection step budget used up')
+
+
+def count_turtle_triples(buf, max_count=None, max_steps=None):
+    '''Counts the Turtle triples in the buffer, stopping at max_count.
+
+    A triple is three terms at the start of a line, or a ';' and two terms,
+    ending with a ';' or a '.' at the end of a line - the same that
+    turtle_regex matches - but found with a tokenizer, in time linear in the
+    length of the buffer, and reading no more than max_steps tokens.
+    '''
+    tokens = _turtle_tokens(buf, max_steps or TURTLE_MAX_STEPS)
+    window = []
+    count = 0
+    while max_count is None or count < max_count:
+        while len(window) < 4:
+            token = next(tokens, None)
+            if token is None:
+                break
+            window.append(token)
+        if not window:
+            break
+        length = _match_turtle_triple(window)
+        if length:
+            count += 1
+            del window[:length]
+        else:
+            del window[0]
+    return count
+
+
+def _match_turtle_triple(tokens):
+    '''Returns the number of tokens in the triple at the start of tokens,
+    or 0 if it is not a triple.'''
+    if len(tokens) < 4:
+        return 0
+    # subject predicate object, or ; predicate object
+    (kind, at_start_of_line) = tokens[0][:2]
+    if not ((kind == 'term' and at_start_of_line) or kind == ';'):
+        return 0
+    predicate, object_, end = tokens[1:4]
+    if predicate[0] != 'term' or object_[0] != 'term' or not object_[2]:
+        return 0
+    if end[0] == ';' or (end[0] == '.' and end[3]):
+        return 4
+    return 0
 
 
 turtle_regex_ = None
@@ -534,6 +1476,9 @@ turtle_regex_ = None
 def turtle_regex():
     '''Return a compiled regex that matches a turtle triple.
 
+    NB It can take a very long time on some text, due to backtracking, so
+    is_ttl uses count_turtle_triples instead.
+
     Each RDF term may be in these forms:
          <url>
          "a literal"
@@ -0,0 +1,224 @@
+'''
+Sniffing in a separate, resource-limited process.
+
+xlrd, messytables, expat and the regexes all run on untrusted files, so one
+malformed file can make sniffing hang or use all the memory, stalling the
+worker and every job queued behind it. With qa.sniff_sandbox enabled, files
+are sniffed in a child process that is forked once and then reused, with
+limits on:
+
+* wall-clock time - qa.sniff_timeout seconds, after which the child is
+  killed (and another forked for the next file)
+* CPU time - qa.sniff_max_cpu_seconds (RLIMIT_CPU)
+* memory - qa.sniff_max_memory_mb. This limits RLIMIT_DATA (the heap) rather
+  than RLIMIT_AS, because the file being sniffed is memory-mapped, and that
+  counts towards the address space, so a large file would hit the limit.
+
+A file that exceeds a limit raises a SniffLimitError, rather than the QA
+job failing, and is quarantined (see the quarantine module, which is enabled
+along with the sandbox unless qa.quarantine is set).
+'''
+import logging
+import os
+import signal
+import threading
+
+try:
+    import resource
+except ImportError:
+    # not on Windows
+    resource = None
+
+from ckan.plugins import toolkit
+from ckan.plugins.toolkit import config
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 60
+DEFAULT_MAX_MEMORY_MB = 1024
+
+TIMEOUT = u'timeout'
+MEMORY = u'memory'
+
+
+class SniffError(Exception):
+    '''Sniffing raised an exception in the sandbox.'''
+    pass
+
+
+class SniffLimitError(Exception):
+    '''Sniffing a file exceeded one of the sandbox's limits.'''
+    # what is recorded in the sniff cache
+    outcome = None
+
+
+class SniffTimeout(SniffLimitError):
+    outcome = TIMEOUT
+
+
+class SniffMemoryError(SniffLimitError):
+    outcome = MEMORY
+
+
+LIMIT_ERRORS = dict((error.outcome, error)
+                    for error in (SniffTimeout, SniffMemoryError))
+
+
+def is_enabled():
+    return toolkit.asbool(config.get('qa.sniff_sandbox', False))
+
+
+def get_limits():
+    '''Returns the configured limits: (timeout, max_cpu_seconds,
+    max_memory_mb)'''
+    timeout = float(config.get('qa.sniff_timeout', DEFAULT_TIMEOUT))
+    max_cpu_seconds = toolkit.asint(
+        config.get('qa.sniff_max_cpu_seconds', int(timeout)))
+    max_memory_mb = toolkit.asint(
+        config.get('qa.sniff_max_memory_mb', DEFAULT_MAX_MEMORY_MB))
+    return timeout, max_cpu_seconds, max_memory_mb
+
+
+_sandbox = None
+_sandbox_lock = threading.Lock()
+
+
+def sniff(filepath):
+    '''Sniffs a file in this process's sandbox, which is started the first
+    time it is needed, with the configured limits. Returns the same as
+    sniff_format.sniff_file_format.
+
+    Raises SniffLimitError if a limit was exceeded, or SniffError if sniffing
+    raised an exception.
+    '''
+    global _sandbox
+    with _sandbox_lock:
+        limits = get_limits()
+        if _sandbox is None or _sandbox.limits != limits:
+            if _sandbox is not None:
+                _sandbox.close()
+            _sandbox = SniffSandbox(*limits)
+        return _sandbox.sniff(filepath)
+
+
+class SniffSandbox(object):
+    '''A child process that sniffs files, one at a time, within limits.'''
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_cpu_seconds=None,
+                 max_memory_mb=DEFAULT_MAX_MEMORY_MB):
+        self.timeout = timeout
+        self.max_cpu_seconds = max_cpu_seconds
+        self.max_memory_mb = max_memory_mb
+        self.limits = (timeout, max_cpu_seconds, max_memory_mb)
+        self.process = None
+        self.conn = None
+        self.pid = None
+
+    def _start(self):
+        import multiprocessing
+        # fork, so that the child has the CKAN config and loaded plugins
+        # without importing them again
+        context = multiprocessing.get_context('fork') \
+            if hasattr(multiprocessing, 'get_context') else multiprocessing
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_serve, args=(child_conn, self.max_cpu_seconds,
+                                 self.max_memory_mb),
+            name='qa-sniff-sandbox')
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        # a process forked from this one needs a sandbox of its own
+        self.pid = os.getpid()
+        log.debug('Sniff sandbox started: pid %s', self.process.pid)
+
+    def close(self):
+        '''Stops the child process.'''
+        if self.process is None:
+            return
+        if self.pid == os.getpid():
+            self.conn.close()
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join(1)
+                if self.process.is_alive():
+                    os.kill(self.process.pid, signal.SIGKILL)
+                    self.process.join()
+        self.process = self.conn = None
+
+    def sniff(self, filepath):
+        if self.process is not None and (self.pid != os.getpid() or
+                                         not self.process.is_alive()):
+            self.close()
+        if self.process is None:
+            self._start()
+        self.conn.send(filepath)
+        if not self.conn.poll(self.timeout):
+            self.close()
+            raise SniffTimeout('Sniffing took longer than %s seconds'
+                               % self.timeout)
+        try:
+            outcome, value = self.conn.recv()
+        except EOFError:
+            # the child died before our deadline, so it was not a timeout
+            # unless it was killed for exceeding RLIMIT_CPU
+            self.process.join(1)
+            exitcode = self.process.exitcode
+            self.close()
+            if exitcode == -signal.SIGXCPU:
+                raise SniffTimeout('Sniffing took longer than %s seconds of '
+                                   'CPU time' % self.max_cpu_seconds)
+            if exitcode is not None and exitcode < 0:
+                # e.g. SIGKILL, from the out-of-memory killer or anyone else
+                raise SniffError('Sniff sandbox was killed by signal %s'
+                                 % -exitcode)
+            raise SniffError('Sniff sandbox died with exit code %s'
+                             % exitcode)
+        if outcome == u'ok':
+            return value
+        if outcome in LIMIT_ERRORS:
+            # start afresh, rather than reuse a fragmented heap
+            self.close()
+            raise LIMIT_ERRORS[outcome](value)
+        raise SniffError(value)
+
+
+def _serve(conn, max_cpu_seconds, max_memory_mb):
+    '''The sandbox's child process - sniffs each filepath that it is sent and
+    sends back (outcome, value).'''
+    from ckanext.qa.sniff_format import sniff_file_format
+    # the parent handles Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if resource is not None and max_memory_mb:
+        limit = max_memory_mb * 1024 * 1024
+        hard = resource.getrlimit(resource.RLIMIT_DATA)[1]
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, hard))
+    while True:
+        try:
+            filepath = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if resource is not None and max_cpu_seconds:
+            # RLIMIT_CPU counts the time used over the life of the process,
+            # so allow this much more than has been used so far. Exceeding
+            # the soft limit sends SIGXCPU, which kills the process.
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            used = int(usage.ru_utime + usage.ru_stime) + 1
+            hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+            soft = used + max_cpu_seconds
+            if hard != resource.RLIM_INFINITY:
+                soft = min(soft, hard)
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+        try:
+            result = (u'ok', sniff_file_format(filepath))
+        except MemoryError:
+            result = (MEMORY, u'Sniffing used more than %s MB of memory'
+                      % max_memory_mb)
+        except Exception as e:
+            result = (u'error', u'%s: %s' % (type(e).__name__, e))
+        try:
+            conn.send(result)
+        except MemoryError:
+            conn.send((MEMORY, u'Sniffing used more than %s MB of memory'
+                       % max_memory_mb))
@@ -4,6 +4,7 @@ Berners-Lee\'s five stars of openness
 '''
 import sys
 import datetime
+import hashlib
 import json
 import os
 import traceback
@@ -11,8 +12,13 @@ import traceback
 from ckan.common import _
 
 from ckan.plugins import toolkit
-import ckan.lib.helpers as ckan_helpers
 from ckanext.qa.sniff_format import sniff_file_format
+from ckanext.qa import pending_jobs
+from ckanext.qa import quarantine
+from ckanext.qa import reindex_buffer
+from ckanext.qa import search_index
+from ckanext.qa import sniff_sandbox
+from ckanext.qa import timing
 from ckanext.archiver.model import Archival, Status
 
 import logging
@@ -25,13 +31,19 @@ if sys.version_info[0] >= 3:
 if toolkit.check_ckan_version(max_version='2.6.99'):
     from ckan.lib import celery_app
 
+    # compat_enqueue sends the queue as the last argument, which the tasks
+    # do not need
     @celery_app.celery.task(name="qa.update_package")
-    def update_package_celery(*args, **kwargs):
-        update_package(*args, **kwargs)
+    def update_package_celery(package_id, *args, **kwargs):
+        update_package(package_id, **kwargs)
 
     @celery_app.celery.task(name="qa.update")
-    def update_celery(*args, **kwargs):
-        update(*args, **kwargs)
+    def update_celery(resource_id, *args, **kwargs):
+        update(resource_id, **kwargs)
+
+    @celery_app.celery.task(name="qa.update_packages")
+    def update_packages_celery(package_ids, *args, **kwargs):
+        update_packages(package_ids, **kwargs)
 
 
 class QAError(Exception):
@@ -49,41 +61,139 @@ OPENNESS_SCORE_DESCRIPTION = {
 }
 
 
-def update_package(package_id):
+def update_package(package_id, force=False, queue=None):
     """
     Given a package, calculates an openness score for each of its resources.
     It is more efficient to call this than 'update' for each resource.
 
+    Resources whose archival, URL, format, licence and format scores have
+    not changed since they were last scored are skipped, unless force is
+    True.
+
+    queue is the queue that the job was put in, with qa.job_dedup, so that
+    it is no longer recorded as pending there.
+
     Returns None
     """
 
     try:
-        update_package_(package_id)
+        if queue and pending_jobs.is_enabled():
+            force = pending_jobs.start(queue, [package_id]) or force
+        update_package_(package_id, force=force)
     except Exception as e:
         log.error('Exception occurred during QA update_package: %s: %s',
                   e.__class__.__name__, unicode(e))
         raise
 
 
-def update_package_(package_id):
+def update_package_(package_id, force=False):
     from ckan import model
     package = model.Package.get(package_id)
     if not package:
         raise QAError('Package ID not found: %s' % package_id)
 
+    with timing.job('update_package', package_id=package.id):
+        results = _score_package(package, force=force)
+        if not results:
+            log.info('No resources have changed since they were scored')
+            return
+        # all the resources' results are saved in one transaction
+        changed_resource_ids = save_qa_results(results)
+        log.info('CKAN updated with openness scores (%i resources changed)',
+                 len(changed_resource_ids))
+
+        # Refresh the index for this dataset, so that it contains the latest
+        # qa info
+        if changed_resource_ids:
+            _update_search_index(package.id)
+
+
+def update_packages(package_ids, force=False, queue=None):
+    """
+    Given several packages, calculates an openness score for each of their
+    resources, and saves them all at once. It is more efficient to call this
+    than 'update_package' for each package, e.g. for bulk runs.
+
+    Unchanged resources are skipped unless force is True, and queue is as
+    for update_package.
+
+    Returns None
+    """
+    try:
+        if queue and pending_jobs.is_enabled():
+            force = pending_jobs.start(queue, package_ids) or force
+        update_packages_(package_ids, force=force)
+    except Exception as e:
+        log.error('Exception occurred during QA update_packages: %s: %s',
+                  e.__class__.__name__, unicode(e))
+        raise
+
+
+def update_packages_(package_ids, force=False):
+    from ckan import model
+
+    with timing.job('update_packages', num_packages=len(package_ids)):
+        results = []
+        for package_id in package_ids:
+            package = model.Package.get(package_id)
+            if not package:
+                log.warning('Package ID not found: %s', package_id)
+                continue
+            with timing.job('update_package', package_id=package.id):
+                results.extend(_score_package(package, force=force))
+        changed_resource_ids = set(save_qa_results(results))
+        log.info('CKAN updated with openness scores for %i packages (%i '
+                 'resources changed)', len(package_ids),
+                 len(changed_resource_ids))
+
+        # Only the datasets whose qa info changed need reindexing
+        changed_package_ids = []
+        for resource, qa_result, package_id in results:
+            if resource.id in changed_resource_ids and \
+                    package_id not in changed_package_ids:
+                changed_package_ids.append(package_id)
+        _update_search_indexes(changed_package_ids)
+
+
+def _score_package(package, force=False):
+    '''Scores each of the package's resources, except those whose
+    fingerprint matches the one that they were last scored with and were
+    scored with the current format scores (unless force is True).
+
+    :returns: list of (resource, qa_result, package_id)
+    '''
+    from ckanext.qa.lib import get_score_table
+    from ckanext.qa.model import QA
+
     log.info('Openness scoring package %s (%i resources)', package.name,
              len(package.resources))
-
+    # Load the archivals and QA results of all the resources at once,
+    # rather than a few queries per resource
+    with timing.stage('archival'):
+        archivals = dict((archival.resource_id, archival) for archival
+                         in Archival.get_for_package(package.id))
+        qas = dict((qa.resource_id, qa)
+                   for qa in QA.get_for_package(package.id))
+    score_table_version = get_score_table().version
+    results = []
     for resource in package.resources:
-        qa_result = resource_score(resource)
-        log.info('Openness scoring: \n%r\n%r\n%r\n\n', qa_result, resource,
-                 resource.url)
-        save_qa_result(resource, qa_result)
-        log.info('CKAN updated with openness score')
-
-    # Refresh the index for this dataset, so that it contains the latest
-    # qa info
-    _update_search_index(package.id)
+        qa = qas.get(resource.id)
+        if not force and qa and qa.fingerprint and \
+                qa.score_table_version == score_table_version and \
+                qa.fingerprint == resource_fingerprint(
+                    resource, archivals.get(resource.id), package):
+            log.debug('Resource %s is unchanged since it was scored',
+                      resource.id)
+            continue
+        with timing.job('resource', resource_id=resource.id,
+                        package_id=package.id):
+            qa_result = resource_score(resource, archivals=archivals,
+                                       qas=qas)
+            log.info('Openness scoring: \n%r\n%r\n%r\n\n', qa_result,
+                     resource, resource.url)
+            timing.save(resource.id, package.id, timing.current())
+        results.append((resource, qa_result, package.id))
+    return results
 
 
 def update(resource_id):
@@ -108,29 +218,39 @@ def update_resource_(resource_id):
     resource = model.Resource.get(resource_id)
     if not resource:
         raise QAError('Resource ID not found: %s' % resource_id)
-    qa_result = resource_score(resource)
-    log.info('Openness scoring: \n%r\n%r\n%r\n\n', qa_result, resource,
-             resource.url)
-    save_qa_result(resource, qa_result)
-    log.info('CKAN updated with openness score')
+    with timing.job('resource', resource_id=resource.id):
+        qa_result = resource_score(resource)
+        log.info('Openness scoring: \n%r\n%r\n%r\n\n', qa_result, resource,
+                 resource.url)
 
-    if toolkit.check_ckan_version(max_version='2.2.99'):
-        package = resource.resource_group.package
-    else:
-        package = resource.package
-    if package:
-        # Refresh the index for this dataset, so that it contains the latest
-        # qa info
-        _update_search_index(package.id)
-    else:
-        log.warning('Resource not connected to a package. Res: %r', resource)
+        if toolkit.check_ckan_version(max_version='2.2.99'):
+            package = resource.resource_group.package
+        else:
+            package = resource.package
+        if package:
+            timing.save(resource.id, package.id, timing.current())
+            changed = save_qa_results([(resource, qa_result, package.id)])
+            log.info('CKAN updated with openness score')
+            # Refresh the index for this dataset, so that it contains the
+            # latest qa info - unless that has not changed
+            if changed:
+                _update_search_index(package.id)
+        else:
+            save_qa_result(resource, qa_result)
+            log.warning('Resource not connected to a package. Res: %r',
+                        resource)
     return json.dumps(qa_result)
 
 
-def get_qa_format(resource_id):
-    '''Returns the format of the resource, as recorded in the QA table.'''
+def get_qa_format(resource_id, qas=None):
+    '''Returns the format of the resource, as recorded in the QA table.
+
+    :param qas: the QA objects of the resource's dataset, keyed by resource
+                id, if they have already been loaded
+    '''
     from ckanext.qa.model import QA
-    q = QA.get_for_resource(resource_id)
+    q = qas.get(resource_id) if qas is not None \
+        else QA.get_for_resource(resource_id)
     if not q:
         return ''
     return q.format
@@ -144,32 +264,48 @@ def format_get(key):
     :param key: string
     :returns: format string
     '''
-    format_tuple = ckan_helpers.resource_formats().get(key.lower())
-    if not format_tuple:
+    from ckanext.qa.lib import get_format_index
+    format_info = get_format_index().get(key)
+    if not format_info:
         return
-    return format_tuple[1]  # short name
+    return format_info.format  # short name
 
 
-def resource_score(resource):
+def resource_score(resource, archivals=None, qas=None):
     """
     Score resource on Sir Tim Berners-Lee\'s five stars of openness.
 
+    archivals and qas are the Archival and QA objects of the resource's
+    dataset, keyed by resource id, if they have already been loaded (see
+    update_package_). Otherwise they are looked up.
+
     Returns a dict with keys:
 
         'openness_score': score (int)
         'openness_score_reason': the reason for the score (string)
         'format': format of the data (string)
         'archival_timestamp': time of the archival that this result is based on (iso string)
+        'score_table_version': version of the format scores used (string)
+        'fingerprint': resource_fingerprint of what it was scored from, or
+                       None if its file is quarantined (string)
 
     Raises QAError for reasonable errors
     """
+    from ckanext.qa.lib import get_score_table
     score = 0
     score_reason = ''
     format_ = None
+    score_table_version = get_score_table().version
+    # the file's quarantine entry, if sniffing it is (now) quarantined
+    quarantine_entries = []
 
     try:
         score_reasons = []  # a list of strings detailing how we scored it
-        archival = Archival.get_for_resource(resource_id=resource.id)
+        if archivals is not None:
+            archival = archivals.get(resource.id)
+        else:
+            with timing.stage('archival'):
+                archival = Archival.get_for_resource(resource_id=resource.id)
         if not resource:
             raise QAError('Could not find resource "%s"' % resource.id)
 
@@ -177,8 +313,10 @@ def resource_score(resource):
         if score is None:
             # we don't want to take the publisher's word for it, in case the link
             # is only to a landing page, so highest priority is the sniffed type
-            score, format_ = score_by_sniffing_data(archival, resource,
-                                                    score_reasons)
+            with timing.stage('sniff'):
+                score, format_ = score_by_sniffing_data(
+                    archival, resource, score_reasons,
+                    quarantine_entries=quarantine_entries)
             if score is None:
                 # Fall-backs are user-given data
                 score, format_ = score_by_url_extension(resource, score_reasons)
@@ -191,7 +329,7 @@ def resource_score(resource):
                         score = 1
                         if format_ is None:
                             # use any previously stored format value for this resource
-                            format_ = get_qa_format(resource.id)
+                            format_ = get_qa_format(resource.id, qas)
         score_reason = ' '.join(score_reasons)
         format_ = format_ or None
     except Exception as e:
@@ -222,12 +360,40 @@ def resource_score(resource):
         'openness_score': score,
         'openness_score_reason': score_reason,
         'format': format_,
-        'archival_timestamp': archival_updated
+        'archival_timestamp': archival_updated,
+        'score_table_version': score_table_version,
+        'fingerprint': resource_fingerprint(resource, archival, package),
     }
+    if quarantine_entries:
+        # a quarantined file needs sniffing again once its backoff has
+        # passed, even though nothing else has changed
+        result['fingerprint'] = None
 
     return result
 
 
+def resource_fingerprint(resource, archival, package):
+    '''Returns a hash of what the resource's score is worked out from,
+    besides the format scores - its archival (when it was and the content
+    hash), URL, format field and its dataset's licence. If it is the same as
+    when the resource was last scored, and so is the score_table_version,
+    then scoring it again would give the same result.
+
+    The format scores are left out, so that results re-scored by
+    lib.rescore_formats, which sets their score_table_version, keep their
+    fingerprint.
+    '''
+    inputs = [
+        archival.updated.isoformat() if archival and archival.updated
+        else None,
+        archival.hash if archival else None,
+        resource.url,
+        resource.format,
+        package.license_id if package else None,
+    ]
+    return hashlib.sha1(json.dumps(inputs).encode('utf8')).hexdigest()
+
+
 def broken_link_error_message(archival):
     '''Given an archival for a broken link, it returns a helpful
     error message (string) describing the attempts.'''
@@ -279,11 +445,14 @@ def score_if_link_broken(archival, resource, score_reasons):
     return (None, None)
 
 
-def score_by_sniffing_data(archival, resource, score_reasons):
+def score_by_sniffing_data(archival, resource, score_reasons,
+                           quarantine_entries=None):
     '''
     Looks inside a data file\'s contents to determine its format and score.
 
     It adds strings to score_reasons list about how it came to the conclusion.
+    If the file is quarantined, or is now because sniffing it failed, its
+    SniffQuarantine entry is added to the quarantine_entries list, if given.
 
     Return values:
       * It returns a tuple: (score, format_string)
@@ -301,7 +470,53 @@ def score_by_sniffing_data(archival, resource, score_reasons):
         return (None, None)
     else:
         if filepath:
-            sniffed_format = sniff_file_format(filepath)
+            quarantine_key = quarantine_entry = None
+            if quarantine.is_enabled():
+                from ckanext.qa.sniff_cache import cache_key
+                quarantine_key = cache_key(archival.hash, filepath)
+                quarantine_entry = quarantine.get(quarantine_key)
+                if quarantine.is_quarantined(quarantine_entry):
+                    log.info('Not sniffing quarantined file %s', filepath)
+                    if quarantine_entries is not None:
+                        quarantine_entries.append(quarantine_entry)
+                    score_reasons.append(
+                        _('Analysing the content of the file failed %i times, so it will not be tried again until %s.')
+                        % (quarantine_entry.failure_count,
+                           quarantine_entry.retry_after.strftime('%d/%m/%Y %H:%M')))
+                    score_reasons.append(_('Using other methods to determine file openness.'))
+                    return (None, None)
+                if quarantine_entry:
+                    # its backoff has passed, so sniff it again, even if
+                    # the sniff cache has it timing out
+                    from ckanext.qa import sniff_cache
+                    sniff_cache.forget_outcomes([quarantine_key])
+            try:
+                sniffed_format = sniff_file_format_cached(archival, filepath)
+            except sniff_sandbox.SniffLimitError as e:
+                log.warning('Sniffing %s exceeded a limit: %s', filepath, e)
+                if quarantine_key:
+                    entry = quarantine.record_failure(quarantine_key,
+                                                      resource.id, e)
+                    if quarantine_entries is not None:
+                        quarantine_entries.append(entry)
+                if e.outcome == sniff_sandbox.TIMEOUT:
+                    score_reasons.append(_('Analysing the content of the file timed out.'))
+                else:
+                    score_reasons.append(_('Analysing the content of the file used too much memory.'))
+                score_reasons.append(_('Using other methods to determine file openness.'))
+                return (None, None)
+            except Exception as e:
+                if not quarantine_key:
+                    raise
+                log.exception('Sniffing %s failed', filepath)
+                entry = quarantine.record_failure(quarantine_key, resource.id, e)
+                if quarantine_entries is not None:
+                    quarantine_entries.append(entry)
+                score_reasons.append(_('Analysing the content of the file failed.'))
+                score_reasons.append(_('Using other methods to determine file openness.'))
+                return (None, None)
+            if quarantine_entry:
+                quarantine.record_success(quarantine_entry)
             score = resource_format_scores().get(sniffed_format['format']) \
                 if sniffed_format else None
             if sniffed_format:
@@ -329,6 +544,40 @@ def score_by_sniffing_data(archival, resource, score_reasons):
                 return (None, None)
 
 
+def sniff_file_format_cached(archival, filepath):
+    '''
+    Returns the sniffed format of an archived file, using the sniff cache
+    (if enabled) to avoid sniffing content that has been sniffed before.
+    '''
+    from ckanext.qa import sniff_cache
+    if not sniff_cache.is_enabled():
+        return _sniff_file_format(filepath)
+    key = sniff_cache.cache_key(archival.hash, filepath)
+    with timing.stage('sniff_cache'):
+        hit, sniffed_format = sniff_cache.get(key)
+    if hit:
+        log.info('Sniff cache hit for %s: %r', key, sniffed_format)
+        return sniffed_format
+    try:
+        sniffed_format = _sniff_file_format(filepath)
+    except sniff_sandbox.SniffLimitError as e:
+        # so that it is not sniffed again next time - unless it is
+        # quarantined, which retries it after a backoff
+        if not quarantine.is_enabled():
+            sniff_cache.put(key, None, outcome=e.outcome)
+        raise
+    sniff_cache.put(key, sniffed_format)
+    return sniffed_format
+
+
+def _sniff_file_format(filepath):
+    '''Sniffs the file, in the sniff sandbox if it is enabled.'''
+    if sniff_sandbox.is_enabled():
+        with timing.stage('sniff_sandbox'):
+            return sniff_sandbox.sniff(filepath)
+    return sniff_file_format(filepath)
+
+
 def score_by_url_extension(resource, score_reasons):
     '''
     Looks at the URL for a resource to determine its format and score.
@@ -340,15 +589,16 @@ def score_by_url_extension(resource, score_reasons):
       * If it cannot work out the format then format is None
       * If it cannot score it, then score is None
     '''
-    from ckanext.qa.lib import resource_format_scores
+    from ckanext.qa.lib import get_format_index
     extension_variants_ = extension_variants(resource.url.strip())
     if not extension_variants_:
         score_reasons.append(_('Could not determine a file extension in the URL.'))
         return (None, None)
+    format_index = get_format_index()
     for extension in extension_variants_:
-        format_ = format_get(extension)
-        if format_:
-            score = resource_format_scores().get(format_)
+        format_info = format_index.get(extension)
+        if format_info:
+            format_, score = format_info.format, format_info.score
             if score:
                 score_reasons.append(
                     _('URL extension "%s" relates to format "%s" and receives score: %s.') % (extension, format_, score))
@@ -394,36 +644,60 @@ def score_by_format_field(resource, score_reasons):
       * If it cannot work out the format then format_string is None
       * If it cannot score it, then score is None
     '''
-    from ckanext.qa.lib import resource_format_scores, munge_format_to_be_canonical
+    from ckanext.qa.lib import get_format_index
     format_field = resource.format or ''
     if not format_field:
         score_reasons.append(_('Format field is blank.'))
         return (None, None)
-    format_tuple = ckan_helpers.resource_formats().get(format_field.lower()) or \
-        ckan_helpers.resource_formats().get(munge_format_to_be_canonical(format_field))
-    if not format_tuple:
+    format_info = get_format_index().lookup(format_field)
+    if not format_info:
         score_reasons.append(_('Format field "%s" does not correspond to a known format.') % format_field)
         return (None, None)
-    score = resource_format_scores().get(format_tuple[1])
     score_reasons.append(_('Format field "%s" receives score: %s.') %
-                         (format_field, score))
-    return (score, format_tuple[1])
+                         (format_field, format_info.score))
+    return (format_info.score, format_info.format)
 
 
-def _update_search_index(package_id):
+def _update_search_index(package_id, defer_commit=False):
     '''
-    Tells CKAN to update its search index for a given package.
+    Tells CKAN to update its search index for a given package. With
+    qa.reindex_buffer enabled, the package is added to the buffer instead,
+    unless defer_commit is set. With qa.solr_partial_update enabled, only
+    its qa info is updated, if the Solr schema allows.
+
+    :param defer_commit: leave it to the caller to commit the index
     '''
     from ckan import model
+    if not defer_commit and reindex_buffer.is_enabled():
+        reindex_buffer.add([package_id])
+        return
+    if search_index.is_enabled() and \
+            search_index.update_qa_fields(package_id, defer_commit):
+        log.info('Search indexed the qa info of %s', package_id)
+        return
     from ckan.lib.search.index import PackageSearchIndex
     package_index = PackageSearchIndex()
     context_ = {'model': model, 'ignore_auth': True, 'session': model.Session,
                 'use_cache': False, 'validate': False}
-    package = toolkit.get_action('package_show')(context_, {'id': package_id})
-    package_index.index_package(package, defer_commit=False)
+    with timing.stage('update_search_index'):
+        package = toolkit.get_action('package_show')(context_,
+                                                     {'id': package_id})
+        package_index.index_package(package, defer_commit=defer_commit)
     log.info('Search indexed %s', package['name'])
 
 
+def _update_search_indexes(package_ids):
+    '''
+    Tells CKAN to update its search index for the given packages, with one
+    commit (or adds them to the reindex buffer, if enabled).
+    '''
+    from ckanext.qa.lib import reindex_packages
+    if reindex_buffer.is_enabled():
+        reindex_buffer.add(package_ids)
+    else:
+        reindex_packages(package_ids)
+
+
 def save_qa_result(resource, qa_result):
     """
     Saves the results of the QA check to the qa table.
@@ -443,9 +717,95 @@ def save_qa_result(resource, qa_result):
     for key in ('openness_score', 'openness_score_reason', 'format'):
         setattr(qa, key, qa_result[key])
     qa.archival_timestamp = qa_result['archival_timestamp']
+    qa.score_table_version = qa_result.get('score_table_version')
+    qa.fingerprint = qa_result.get('fingerprint')
     qa.updated = now
 
-    model.Session.commit()
+    timing.save(resource.id, qa.package_id, timing.current())
+
+    with timing.stage('save_qa_result'):
+        model.Session.commit()
 
     log.info('QA results updated ok')
     return qa  # for tests
+
+
+# rows per INSERT statement, which keeps within the limit of bind parameters
+UPSERT_BATCH_SIZE = 1000
+
+
+def save_qa_results(results):
+    """
+    Saves the results of the QA checks of many resources to the qa table, in
+    one transaction. On PostgreSQL (once `qa init` has made qa.resource_id
+    unique) they are upserted in bulk, and results that are the same as
+    before are not written at all.
+
+    :param results: list of (resource, qa_result, package_id)
+    :returns: ids of the resources whose results were inserted or changed
+    """
+    import ckan.model as model
+    from ckanext.qa.model import QA, supports_upsert
+
+    # a resource can only be upserted once per statement
+    rows = {}
+    for resource, qa_result, package_id in results:
+        row = dict((column, qa_result.get(column))
+                   for column in QA.RESULT_COLUMNS)
+        row['archival_timestamp'] = _parse_timestamp(
+            row['archival_timestamp'])
+        row['resource_id'] = resource.id
+        row['package_id'] = package_id
+        rows[resource.id] = row
+
+    with timing.stage('save_qa_result'):
+        if supports_upsert(model.Session.get_bind()):
+            changed = []
+            rows = list(rows.values())
+            for i in range(0, len(rows), UPSERT_BATCH_SIZE):
+                changed.extend(QA.upsert(rows[i:i + UPSERT_BATCH_SIZE]))
+        else:
+            changed = _save_qa_rows(rows)
+        model.Session.commit()
+    return changed
+
+
+def _save_qa_rows(rows):
+    '''Saves QA rows with the ORM, where they cannot be upserted (see
+    model.supports_upsert), without committing.
+
+    :param rows: dict of resource_id: row dict
+    :returns: ids of the resources whose results were inserted or changed
+    '''
+    import ckan.model as model
+    from ckanext.qa.model import QA
+
+    qas = dict((qa.resource_id, qa) for qa in model.Session.query(QA)
+               .filter(QA.resource_id.in_(list(rows.keys()))))
+    changed = []
+    now = datetime.datetime.now()
+    for resource_id, row in rows.items():
+        qa = qas.get(resource_id)
+        if not qa:
+            qa = QA.create(resource_id, package_id=row['package_id'])
+            model.Session.add(qa)
+        elif all(getattr(qa, column) == value
+                 for column, value in row.items()):
+            continue
+        for column, value in row.items():
+            setattr(qa, column, value)
+        qa.updated = now
+        changed.append(resource_id)
+    return changed
+
+
+def _parse_timestamp(timestamp):
+    '''Parses an isoformat timestamp, as given in a qa_result.'''
+    if not timestamp or isinstance(timestamp, datetime.datetime):
+        return timestamp
+    for format_ in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(timestamp, format_)
+        except ValueError:
+            pass
+    raise ValueError('Invalid timestamp: %r' % timestamp)
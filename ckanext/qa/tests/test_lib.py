@@ -0,0 +1,203 @@
+import json
+import os
+
+import pytest
+
+from ckanext.qa import lib
+from ckanext.qa.lib import (
+    FormatIndex, ScoreTable, get_format_index, reset_format_index)
+
+RESOURCE_FORMATS = [
+    ['_comment', 'test formats'],
+    ['CSV', 'Comma Separated Values File', 'text/csv', []],
+    ['XLS', 'MS Excel File', 'application/vnd.ms-excel',
+     ['Excel', 'application/msexcel']],
+    ['Word Document', 'Word Document', 'application/msword', ['doc']],
+]
+SCORES = [
+    ['_comment', 'test scores'],
+    ['CSV', 3],
+    ['XLS', 2],
+]
+
+
+@pytest.fixture
+def format_files(tmpdir, ckan_config, monkeypatch):
+    resource_formats = tmpdir.join('resource_formats.json')
+    resource_formats.write(json.dumps(RESOURCE_FORMATS))
+    scores = tmpdir.join('scores.json')
+    scores.write(json.dumps(SCORES))
+    monkeypatch.setitem(ckan_config, 'ckan.resource_formats',
+                        str(resource_formats))
+    monkeypatch.setitem(ckan_config, 'qa.resource_format_openness_scores_json',
+                        str(scores))
+    monkeypatch.setitem(ckan_config, 'qa.format_index.check_interval', '0')
+    reset_format_index()
+    yield resource_formats, scores
+    reset_format_index()
+
+
+def test_aliases(format_files):
+    index = get_format_index()
+    for alias in ('csv', 'CSV', 'text/csv', 'Comma Separated Values File'):
+        assert index.get(alias) == lib.FormatInfo(
+            'CSV', 3, 'text/csv', 'Comma Separated Values File'), alias
+    assert index.get('excel').format == 'XLS'
+    assert index.get('application/msexcel').score == 2
+
+
+def test_load_resource_formats_matches_ckan():
+    import ckan.lib.helpers as h
+    assert lib.load_resource_formats(lib._resource_formats_filepath()) == \
+        h.resource_formats()
+
+
+def test_unscored_format(format_files):
+    assert get_format_index().get('doc') == lib.FormatInfo(
+        'Word Document', None, 'application/msword', 'Word Document')
+
+
+def test_munged_aliases(format_files):
+    index = get_format_index()
+    assert index.get('worddocument').format == 'Word Document'
+    assert index.lookup(' .CSV').format == 'CSV'
+    assert index.lookup('Word-Document').format == 'Word Document'
+    assert index.get(' .CSV') is None
+    assert index.lookup('unknown') is None
+
+
+def test_rebuilt_when_a_file_changes(format_files):
+    resource_formats, scores = format_files
+    index = get_format_index()
+    assert get_format_index() is index
+    scores.write(json.dumps(SCORES + [['Word Document', 1]]))
+    # make sure the mtime changes, even on a coarse filesystem
+    os.utime(str(scores), (0, 0))
+    new_index = get_format_index()
+    assert new_index is not index
+    assert new_index.get('doc').score == 1
+    assert lib.resource_format_scores()['Word Document'] == 1
+    assert new_index.score_table.version != index.score_table.version
+
+
+def test_score_table_version():
+    assert ScoreTable({'CSV': 3, 'XLS': 2}).version == \
+        ScoreTable({'XLS': 2, 'CSV': 3}).version
+    assert ScoreTable({'CSV': 3}).version != ScoreTable({'CSV': 2}).version
+
+
+def test_duplicate_score(tmpdir):
+    scores = tmpdir.join('scores.json')
+    scores.write(json.dumps([['CSV', 3], ['CSV', 2]]))
+    with pytest.raises(ValueError):
+        lib.load_resource_format_scores(str(scores))
+
+
+def test_index_is_not_mutable():
+    index = FormatIndex({'csv': ['text/csv', 'CSV', 'CSV File']},
+                        ScoreTable({'CSV': 3}))
+    with pytest.raises(AttributeError):
+        index.extra = 1
+    assert 'csv' in index
+    assert len(index) == 1
+
+
+@pytest.mark.usefixtures('with_plugins')
+@pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
+class TestRescoreFormats():
+    @pytest.fixture(autouse=True)
+    def init_data(cls, clean_db):
+        from ckan import model
+        from ckanext.archiver import model as archiver_model
+        from ckanext.qa import model as qa_model
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def _qa(self, format_, score, reason=u'Scored before'):
+        from ckan import model
+        from ckantoolkit.tests import factories as ckan_factories
+        from ckanext.qa.model import QA
+        resource_dict = ckan_factories.Resource()
+        qa = QA.create(resource_dict['id'])
+        qa.format = format_
+        qa.openness_score = score
+        qa.openness_score_reason = reason
+        model.Session.add(qa)
+        model.Session.commit()
+        return qa.id
+
+    def test_rescore(self):
+        from ckan import model
+        from ckanext.qa.model import QA
+        csv_score = lib.resource_format_scores()['CSV']
+        changed_id = self._qa(u'CSV', csv_score - 1)
+        unchanged_id = self._qa(u'CSV', csv_score)
+        not_open_id = self._qa(u'CSV', 0)
+        # the format was only kept from before
+        not_understood_id = self._qa(
+            u'CSV', 1, u'URL extension "zar" is an unknown format. Could not '
+            u'understand the file format, therefore score is 1.')
+
+        changes, package_ids = lib.rescore_formats()
+
+        assert changes == {(u'CSV', csv_score - 1, csv_score): 1}
+        assert package_ids == set([model.Session.query(QA).get(changed_id)
+                                   .package_id])
+        version = lib.get_score_table().version
+        changed = model.Session.query(QA).get(changed_id)
+        assert changed.openness_score == csv_score
+        assert changed.openness_score_reason == \
+            u'Format "CSV" receives score: %s.' % csv_score
+        assert changed.score_table_version == version
+        unchanged = model.Session.query(QA).get(unchanged_id)
+        assert unchanged.openness_score_reason == u'Scored before'
+        assert unchanged.score_table_version == version
+        not_open = model.Session.query(QA).get(not_open_id)
+        assert not_open.openness_score == 0
+        assert not_open.score_table_version == version
+        not_understood = model.Session.query(QA).get(not_understood_id)
+        assert not_understood.openness_score == 1
+        assert not_understood.score_table_version is None
+
+    def test_update_after_rescore(self, format_files, monkeypatch):
+        from ckan import model
+        from ckantoolkit.tests import factories as ckan_factories
+        from ckanext.qa import tasks
+        from ckanext.qa.model import QA
+        resources = [{'url': 'http://example.com/file.csv', 'format': ''},
+                     {'url': 'http://example.com/file.xls', 'format': ''}]
+        open_dataset = ckan_factories.Dataset(license_id='uk-ogl',
+                                              resources=resources)
+        # scores 0
+        closed_dataset = ckan_factories.Dataset(resources=resources)
+        for dataset in (open_dataset, closed_dataset):
+            tasks.update_package_(dataset['id'])
+        resource_id = open_dataset['resources'][0]['id']
+        assert QA.get_for_resource(resource_id).openness_score == 3
+
+        _, scores = format_files
+        scores.write(json.dumps([['CSV', 2], ['XLS', 2]]))
+        os.utime(str(scores), (0, 0))
+        changes, package_ids = lib.rescore_formats()
+        assert package_ids == set([open_dataset['id']])
+        model.Session.expire_all()
+        assert QA.get_for_resource(resource_id).openness_score == 2
+
+        scored = []
+
+        def resource_score(resource, **kwargs):
+            scored.append(resource.id)
+            return real_resource_score(resource, **kwargs)
+        real_resource_score = tasks.resource_score
+        monkeypatch.setattr(tasks, 'resource_score', resource_score)
+        for dataset in (open_dataset, closed_dataset):
+            tasks.update_package_(dataset['id'])
+        assert scored == []
+
+    def test_dry_run(self):
+        from ckan import model
+        from ckanext.qa.model import QA
+        qa_id = self._qa(u'CSV', 1)
+        changes, package_ids = lib.rescore_formats(dry_run=True)
+        assert len(changes) == 1
+        assert model.Session.query(QA).get(qa_id).openness_score == 1
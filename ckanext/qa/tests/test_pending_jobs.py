@@ -0,0 +1,70 @@
+import pytest
+
+from ckanext.qa import lib
+from ckanext.qa import pending_jobs
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmpdir):
+    if request.param == 'sqlite':
+        return pending_jobs.SqliteStore(str(tmpdir.join('pending.sqlite')))
+    return pending_jobs.MemoryStore()
+
+
+class TestStore(object):
+    def test_duplicates_are_merged(self, store):
+        assert store.request('bulk:d1', False, 60) is True
+        assert store.request('bulk:d1', False, 60) is False
+        # other datasets and queues are separate
+        assert store.request('bulk:d2', False, 60) is True
+        assert store.request('priority:d1', False, 60) is True
+
+    def test_started_job_is_no_longer_pending(self, store):
+        store.request('bulk:d1', False, 60)
+        assert store.start('bulk:d1') is False
+        assert store.request('bulk:d1', False, 60) is True
+
+    def test_force_is_merged(self, store):
+        store.request('bulk:d1', False, 60)
+        assert store.request('bulk:d1', True, 60) is False
+        assert store.start('bulk:d1') is True
+        assert store.start('bulk:d1') is False
+
+    def test_quiet_period(self, store):
+        assert store.request('bulk:d1', False, 0) is True
+        assert store.request('bulk:d1', False, 0) is True
+
+
+class Package(object):
+    def __init__(self, id):
+        self.id = self.name = id
+
+
+@pytest.mark.usefixtures('ckan_config')
+@pytest.mark.ckan_config('qa.job_dedup', 'true')
+@pytest.mark.ckan_config('qa.job_dedup.store', 'memory')
+class TestCreateTask(object):
+    @pytest.fixture(autouse=True)
+    def enqueued(self, monkeypatch):
+        enqueued = []
+
+        def compat_enqueue(name, fn, queue, args=None, kwargs=None):
+            enqueued.append((name, queue, args, kwargs))
+        monkeypatch.setattr(lib, 'compat_enqueue', compat_enqueue)
+        monkeypatch.setattr(pending_jobs, '_store', None)
+        return enqueued
+
+    def test_update_package(self, enqueued):
+        for i in range(3):
+            lib.create_qa_update_package_task(Package('d1'), 'bulk')
+        assert enqueued == [('qa.update_package', 'bulk', ['d1'],
+                             {'queue': 'bulk'})]
+
+    def test_update_packages(self, enqueued):
+        lib.create_qa_update_package_task(Package('d1'), 'bulk')
+        lib.create_qa_update_packages_task(
+            [Package('d1'), Package('d2')], 'bulk', force=True)
+        assert enqueued[1] == ('qa.update_packages', 'bulk', [['d2']],
+                               {'queue': 'bulk', 'force': True})
+        # the pending job of d1 will be forced
+        assert pending_jobs.start('bulk', ['d1']) is True
@@ -0,0 +1,50 @@
+import pytest
+
+from ckanext.qa import lib
+from ckanext.qa import reindex_buffer
+
+
+@pytest.mark.usefixtures('ckan_config')
+@pytest.mark.ckan_config('qa.reindex_buffer', 'true')
+@pytest.mark.ckan_config('qa.reindex_buffer.store', 'memory')
+class TestReindexBuffer(object):
+    @pytest.fixture(autouse=True)
+    def reindexed(self, monkeypatch):
+        reindexed = []
+        monkeypatch.setattr(lib, 'reindex_packages', reindexed.append)
+        monkeypatch.setattr(reindex_buffer, '_store', None)
+        return reindexed
+
+    @pytest.mark.ckan_config('qa.reindex_buffer.max_size', '3')
+    def test_flushed_when_full(self, reindexed):
+        assert reindex_buffer.add(['a', 'b']) == []
+        # duplicates are only reindexed once
+        assert reindex_buffer.add(['b', 'a']) == []
+        assert reindexed == []
+        assert reindex_buffer.add(['c']) == ['a', 'b', 'c']
+        assert reindexed == [['a', 'b', 'c']]
+        assert reindex_buffer.flush() == []
+
+    @pytest.mark.ckan_config('qa.reindex_buffer.max_age', '0')
+    def test_flushed_when_old(self, reindexed):
+        assert reindex_buffer.add(['a']) == ['a']
+        assert reindexed == [['a']]
+
+    def test_flush(self, reindexed):
+        reindex_buffer.add(['a', 'b'])
+        assert reindex_buffer.flush() == ['a', 'b']
+        assert reindexed == [['a', 'b']]
+
+    def test_failed_flush_keeps_the_datasets(self, monkeypatch):
+        def reindex_packages(package_ids):
+            raise Exception('Solr is down')
+        monkeypatch.setattr(lib, 'reindex_packages', reindex_packages)
+        reindex_buffer.add(['a'])
+        with pytest.raises(Exception):
+            reindex_buffer.flush()
+        assert reindex_buffer.get_store().pop_all() == ['a']
+
+    def test_unknown_store(self, ckan_config, monkeypatch):
+        monkeypatch.setitem(ckan_config, 'qa.reindex_buffer.store', 'solr')
+        with pytest.raises(ValueError):
+            reindex_buffer.add(['a'])
@@ -0,0 +1,111 @@
+import datetime
+
+from ckanext.qa import search_index
+from ckanext.qa.model import QA, add_qa_to_package_dict
+
+
+def qa_fields(stored=True):
+    return [
+        {'name': 'qa_openness_score', 'stored': stored},
+        {'name': 'res_qa_openness_score', 'stored': True},
+        {'name': 'res_qa_format', 'stored': True},
+    ]
+
+
+class TestCheckSchema(object):
+    def test_supported(self):
+        fields = qa_fields() + [
+            {'name': 'id', 'stored': True},
+            {'name': 'text', 'stored': False},
+            {'name': 'views_total', 'stored': False, 'docValues': True}]
+        dynamic_fields = [{'name': 'extras_*', 'stored': True}]
+        copy_fields = [{'source': 'title', 'dest': 'text'}]
+        assert search_index.check_schema(
+            fields, dynamic_fields, copy_fields) == []
+
+    def test_missing_qa_fields(self):
+        problems = search_index.check_schema(
+            [{'name': 'id', 'stored': True}], [], [])
+        assert len(problems) == 3
+
+    def test_ckan_schema_fields_not_stored(self):
+        # the fields of CKAN's schema that are not stored are recomputed by
+        # the update, or not set by CKAN's indexer
+        fields = qa_fields() + [
+            {'name': name, 'stored': False}
+            for name in ('permission_labels', 'title_string', 'views_total',
+                         'views_recent', 'resources_accessed_total',
+                         'depends_on', 'child_of')]
+        dynamic_fields = [{'name': '*', 'stored': False}]
+        assert search_index.check_schema(fields, dynamic_fields, []) == []
+
+    def test_field_not_stored(self):
+        fields = qa_fields() + [
+            {'name': 'permission_labels', 'stored': False},
+            {'name': 'harvest_source', 'stored': False},
+            {'name': 'popularity', 'stored': False, 'docValues': True,
+             'useDocValuesAsStored': False}]
+        dynamic_fields = [{'name': 'custom_*', 'stored': False}]
+        problems = search_index.check_schema(fields, dynamic_fields, [])
+        assert len(problems) == 3
+        assert 'harvest_source' in problems[0]
+
+
+class TestIndexFields(object):
+    def test_index_fields(self):
+        updated = datetime.datetime(2020, 1, 1)
+        qa_objs = [
+            QA(resource_id='r1', openness_score=3, format='CSV',
+               openness_score_reason='', updated=updated),
+            QA(resource_id='r2', openness_score=0, format=None,
+               openness_score_reason='License not open', updated=updated)]
+        pkg_dict = {'id': 'd1',
+                    'resources': [{'id': 'r1'}, {'id': 'r2'}, {'id': 'r3'}]}
+
+        add_qa_to_package_dict(pkg_dict, qa_objs)
+
+        assert pkg_dict['qa']['openness_score'] == 3
+        assert pkg_dict['resources'][0]['qa']['format'] == 'CSV'
+        assert sorted(pkg_dict['resources'][0]['qa']) == [
+            'archival_timestamp', 'created', 'format', 'openness_score',
+            'openness_score_reason', 'resource_timestamp', 'updated']
+        assert 'qa' not in pkg_dict['resources'][2]
+        assert search_index.index_fields(pkg_dict) == {
+            'qa_openness_score': 3,
+            'res_qa_openness_score': [3, 0],
+            'res_qa_format': ['CSV'],
+        }
+
+
+class TestRecomputedFields(object):
+    def test_recomputed_fields(self, monkeypatch):
+        from ckan import model
+        from ckan.lib import plugins as lib_plugins
+
+        class Labels(object):
+            def get_dataset_labels(self, package):
+                return ['public']
+
+        monkeypatch.setattr(model.Package, 'get',
+                            classmethod(lambda cls, id: object()))
+        monkeypatch.setattr(lib_plugins, 'get_permission_labels', Labels)
+        if hasattr(model, 'TrackingSummary'):
+            monkeypatch.setattr(
+                model.TrackingSummary, 'get_for_package',
+                classmethod(lambda cls, id: {'total': 5, 'recent': 2}))
+        data_dict = {'id': 'd1', 'title': 'Bus stops',
+                     'notes': 'Stops',
+                     'extras': [{'key': 'theme', 'value': 'Transport'},
+                                {'key': 'notes', 'value': 'Not indexed'},
+                                {'key': 'spatial extent', 'value': 'UK'}]}
+
+        fields = search_index.recomputed_fields('d1', data_dict)
+
+        assert fields['permission_labels'] == ['public']
+        assert fields['title_string'] == 'Bus stops'
+        assert fields['theme'] == 'Transport'
+        assert fields['spatialextent'] == 'UK'
+        assert 'notes' not in fields
+        if hasattr(model, 'TrackingSummary'):
+            assert fields['views_total'] == 5
+            assert fields['views_recent'] == 2
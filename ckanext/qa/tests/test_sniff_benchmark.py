@@ -0,0 +1,50 @@
+'''
+Benchmarks of sniffing, using the synthetic corpus from
+ckanext/qa/bin/sniff_benchmark.py. They need pytest-benchmark:
+
+    pip install pytest-benchmark
+    pytest --ckan-ini=test.ini ckanext/qa/tests/test_sniff_benchmark.py
+
+and are skipped if it is not installed. To compare against a saved run, see
+--benchmark-autosave and --benchmark-compare in the pytest-benchmark docs.
+'''
+import os
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+sniff_benchmark = pytest.importorskip('ckanext.qa.bin.sniff_benchmark')
+
+from ckanext.qa.sniff_format import sniff_file_format  # noqa: E402
+
+CORPUS_SCALE = 0.1
+CORPUS_FILENAMES = [filename for filename, writer in sniff_benchmark.CORPUS_FILES]
+DETECTOR_NAMES = ['is_json', 'is_csv', 'is_excel', 'get_zipped_format', 'run_bsd_file', 'is_ttl', 'has_rdfa']
+
+
+@pytest.fixture(scope='module')
+def corpus_dir(tmp_path_factory):
+    corpus_dir = str(tmp_path_factory.mktemp('sniff-corpus'))
+    sniff_benchmark.build_corpus(corpus_dir, scale=CORPUS_SCALE)
+    return corpus_dir
+
+
+def corpus_filepath(corpus_dir, filename):
+    filepath = os.path.join(corpus_dir, filename)
+    if not os.path.exists(filepath):
+        pytest.skip('Corpus file not built (missing optional library?): %s' % filename)
+    return filepath
+
+
+@pytest.mark.parametrize('filename', CORPUS_FILENAMES)
+def test_sniff_file_format(benchmark, corpus_dir, filename):
+    benchmark.group = 'sniff_file_format'
+    benchmark(sniff_file_format, corpus_filepath(corpus_dir, filename))
+
+
+@pytest.mark.parametrize('detector_name', DETECTOR_NAMES)
+@pytest.mark.parametrize('filename', CORPUS_FILENAMES)
+def test_detector(benchmark, corpus_dir, filename, detector_name):
+    detector = dict(sniff_benchmark.get_detectors())[detector_name]
+    benchmark.group = filename
+    benchmark(detector, corpus_filepath(corpus_dir, filename))
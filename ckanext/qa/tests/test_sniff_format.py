@@ -1,10 +1,16 @@
+import io
 import os
+import struct
+import time
 import pytest
 import logging
 
 from ckan import plugins as p
 
-from ckanext.qa.sniff_format import sniff_file_format, is_json, is_ttl, turtle_regex
+from ckanext.qa.sniff_format import sniff_file_format, is_json, is_ttl, turtle_regex, SniffContext, \
+    run_bsd_file, is_excel, run_text_detectors, TEXT_FORMATS, TXT_FORMATS, Detector, DetectorRegistry, COST_CHEAP, \
+    COST_EXPENSIVE, CONFIDENCE_LOW, count_turtle_triples, is_csv, is_psv, is_xml_but_without_declaration, \
+    get_xml_variant_without_xml_declaration, is_html, is_iati
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger('ckan.sniff')
@@ -30,14 +36,14 @@ class TestSniffFormat:
         expected_format = format_extension
         sniffed_format = sniff_file_format(filepath)
         assert sniffed_format, expected_format
-        expected_format_without_zip = expected_format.replace('.zip', '')
-        assert sniffed_format['format'].lower() == expected_format_without_zip
 
         expected_container = None
-        if expected_format.endswith('.zip'):
-            expected_container = 'ZIP'
-        elif expected_format.endswith('.gzip'):
-            expected_container = 'ZIP'  # lumped together with zip for simplicity now
+        for container in ('.tar.gz', '.zip', '.gz', '.bz2', '.xz'):
+            if expected_format.endswith(container):
+                expected_format = expected_format[:-len(container)]
+                expected_container = container[1:].upper()
+                break
+        assert sniffed_format['format'].lower() == expected_format
         assert sniffed_format.get('container') == expected_container
 
     # def test_all(self):
@@ -181,6 +187,15 @@ class TestSniffFormat:
     def test_xml_zip(self):
         self.check_format('xml.zip', 'FHRS501en-GB.xml.zip')
 
+    def test_csv_gz(self):
+        self.check_format('csv.gz', 'elec00.csv.gz')
+
+    def test_xml_bz2(self):
+        self.check_format('xml.bz2', 'jobs.xml.bz2')
+
+    def test_csv_tar_gz(self):
+        self.check_format('csv.tar.gz', '9_sus_fisheries_201003.csv.tar.gz')
+
     # def test_torrent(self):
     #    self.check_format('torrent')
 
@@ -260,6 +275,47 @@ def test_is_json():
     # assert not is_json('[{"cat": [1]}2, 2]', log)
 
 
+def test_run_text_detectors():
+    assert run_text_detectors('{"cat": [1, 2], "dog": 5, "rabbit": "great"}') == {'format': 'JSON'}
+    assert run_text_detectors('a,b,c\n1,2,3\n4,5,6\n7,8,9\n') == {'format': 'CSV'}
+    assert run_text_detectors('<rowset><row>1</row></rowset>') == {'format': 'XML'}
+    assert run_text_detectors('@prefix foaf: <http://xmlns.com/foaf/0.1/> .\n') == {'format': 'TTL'}
+    assert run_text_detectors('Just some words\nand some more words\n') is None
+    # only the formats asked for are detected
+    assert run_text_detectors('<rowset><row>1</row></rowset>', TEXT_FORMATS) is None
+    assert run_text_detectors('<html><body></body></html>', ('HTML',)) == {'format': 'HTML'}
+
+
+def run_every_text_detector(buf, formats):
+    '''The detectors, run in turn without run_text_detectors' pre-filter.'''
+    for format_name in formats:
+        if format_name == 'JSON' and is_json(buf):
+            return {'format': 'JSON'}
+        elif format_name == 'CSV' and is_csv(buf):
+            return {'format': 'CSV'}
+        elif format_name == 'PSV' and is_psv(buf):
+            return {'format': 'PSV'}
+        elif format_name == 'XML' and is_xml_but_without_declaration(buf):
+            return get_xml_variant_without_xml_declaration(buf)
+        elif format_name == 'TTL' and is_ttl(buf):
+            return {'format': 'TTL'}
+        elif format_name in ('HTML', 'IATI'):
+            format_ = (is_html if format_name == 'HTML' else is_iati)(buf)
+            if format_:
+                return format_
+
+
+@pytest.mark.parametrize('formats', [TXT_FORMATS, TEXT_FORMATS, ('CSV', 'PSV'), ('HTML', 'IATI')])
+def test_run_text_detectors_matches_every_detector(formats):
+    fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    buffers = ['', ' {"a": 1}', 'a|b|c\n1|2|3\n']
+    for filename in sorted(os.listdir(fixture_data_dir)):
+        with io.open(os.path.join(fixture_data_dir, filename), 'r', encoding='ISO-8859-1', newline=None) as f:
+            buffers.append(f.read(10000))
+    for buf in buffers:
+        assert run_text_detectors(buf, formats) == run_every_text_detector(buf, formats), buf[:100]
+
+
 def test_turtle_regex():
     template = '<subject> <predicate> %s .'
     assert turtle_regex().search(template % '<url>')
@@ -290,7 +346,276 @@ def test_turtle_regex():
     assert not turtle_regex().search(template % 'prefix:node')
 
 
+def test_count_turtle_triples():
+    # gives the same results as turtle_regex
+    template = '<subject> <predicate> %s .'
+    for buf in [template % term for term in (
+                '<url>', '"a literal"', '"translation"@ru', '"literal type"^^<http://www.w3.org/2001/XMLSchema#string>',
+                '"literal typed with prefix"^^xsd:string', "'single quotes'", '"""triple quotes"""', '12', '.12',
+                '-4.2E-9', 'false', '_:blank_node', 'word', 'prefix:node')] + [
+            '<s> <p> <o> ;\n <p> <o> .', '<s> <p> <o>;<p> <o>.', '<s> <p> <o>;', ';\n<p> <o>;',
+            '<s> <p> <o>. rubbish']:
+        assert count_turtle_triples(buf) == len(turtle_regex().findall(buf)), buf
+
+    triple = '<subject> <predicate> <object>; <predicate> <object>.\n'
+    assert count_turtle_triples(triple * 10) == 10
+    assert count_turtle_triples(triple * 10, max_count=5) == 5
+    # the step budget is a number of tokens - 7 per line
+    assert count_turtle_triples(triple * 10, max_steps=35) == 5
+
+
+def test_count_turtle_triples_is_linear():
+    # turtle_regex backtracks a lot on this (it takes about a second)
+    buf = ('; "a' * 2500)[:10000]
+    start = time.time()
+    assert count_turtle_triples(buf) == 0
+    assert time.time() - start < 0.2
+
+
 def test_is_ttl__num_triples():
     triple = '<subject> <predicate> <object>; <predicate> <object>.'
     assert not is_ttl('\n'.join([triple]*2))
     assert is_ttl('\n'.join([triple]*5))
+
+
+def test_sniff_context(tmp_path):
+    filepath = tmp_path / 'data.csv'
+    filepath.write_bytes(b'a,b\r\n1,\xa32\r\n')
+    with SniffContext(str(filepath)) as context:
+        assert context.size == 11
+        assert context.head(3) == b'a,b'
+        assert context.text(5) == u'a,b\r\n'
+        assert context.text(100, universal_newlines=True) == u'a,b\n1,\xa32\n'
+        assert context.fileobj().read() == b'a,b\r\n1,\xa32\r\n'
+
+
+def test_sniff_context_empty_file(tmp_path):
+    filepath = tmp_path / 'empty'
+    filepath.write_bytes(b'')
+    with SniffContext(str(filepath)) as context:
+        assert context.size == 0
+        assert context.text(100) == u''
+        assert not sniff_file_format(str(filepath))
+
+
+@pytest.mark.usefixtures('ckan_config')
+@pytest.mark.ckan_config('qa.bsd_file_mode', 'native')
+def test_run_bsd_file_native():
+    fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+
+    def bsd_file(filename):
+        return run_bsd_file(os.path.join(fixture_data_dir, filename))
+    assert bsd_file('bis-quarterly-publications-dg-expenses-jul-sep-2010.doc') == {'format': 'DOC'}
+    assert bsd_file('directors-org-chart-march-2012.ppt') == {'format': 'PPT'}
+    assert bsd_file('10-p108-data-results-2010-finance-survey-mid-cap-businesses.xls') == {'format': 'XLS'}
+    assert bsd_file('HS2-ARP-00-GI-RW-00434_RCL_V4.shp') == {'format': 'SHP'}
+    assert bsd_file('ukti-admin-spend-nov-2011.xls') is None
+    assert bsd_file('elec00.csv') is None
+
+
+@pytest.mark.usefixtures('ckan_config')
+@pytest.mark.ckan_config('qa.bsd_file_mode', 'native')
+def test_run_bsd_file_native_corrupt_summary_information(tmp_path):
+    fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    with open(os.path.join(
+            fixture_data_dir,
+            'bis-quarterly-publications-dg-expenses-jul-sep-2010.doc'),
+            'rb') as f:
+        data = bytearray(f.read())
+    # point the SummaryInformation stream's directory entry at a sector
+    # beyond the end of the file, so that its sector chain is broken
+    entry_offset = data.index(u'\x05SummaryInformation'.encode('utf-16-le'))
+    data[entry_offset + 116:entry_offset + 120] = \
+        struct.pack('<I', 0xFFFFFFF0)
+    filepath = tmp_path / 'corrupt.doc'
+    filepath.write_bytes(bytes(data))
+
+    # the creating application cannot be read, so it is not recognized
+    assert run_bsd_file(str(filepath)) is None
+    sniff_file_format(str(filepath))
+
+
+def test_is_excel():
+    fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    for filename, expected in (
+            ('10-p108-data-results-2010-finance-survey-mid-cap-businesses.xls', True),
+            ('ukti-admin-spend-nov-2011.xls', True),
+            ('August-2010.xls', True),  # BIFF3
+            ('bis-quarterly-publications-dg-expenses-jul-sep-2010.doc', False),
+            ('directors-org-chart-march-2012.ppt', False),
+            ('decc_local_authority_data_xlsx.xlsx', False),
+            ('elec00.csv', False)):
+        filepath = os.path.join(fixture_data_dir, filename)
+        assert is_excel(filepath) == expected, filename
+        assert is_excel(filepath, full_parse=True) == expected, filename
+
+
+def test_detector_registry():
+    calls = []
+
+    def detector(name, format_, **kwargs):
+        def detect(context, mime_type):
+            calls.append(name)
+            return {'format': format_} if format_ else None
+        return Detector(name, detect, **kwargs)
+
+    registry = DetectorRegistry([
+        detector('expensive', 'CSV', mime_types=('text/*',), cost=COST_EXPENSIVE),
+        detector('cheap-miss', None, mime_types=('text/plain',), cost=COST_CHEAP),
+        detector('cheap-low', 'TXT', mime_types=('text/plain',), cost=COST_CHEAP,
+                 confidence=CONFIDENCE_LOW),
+        detector('no-mime', 'XLS', mime_types=(None,)),
+        detector('refine-txt', 'JSON', formats=('TXT',)),
+    ])
+
+    # cheapest first, and a high confidence detection stops the pipeline
+    assert registry.detect(None, 'text/plain') == {'format': 'CSV'}
+    assert calls == ['cheap-miss', 'cheap-low', 'expensive']
+    # a low confidence detection is used if nothing is more confident
+    registry.register(detector('expensive', None, mime_types=('text/*',), cost=COST_EXPENSIVE))
+    assert registry.detect(None, 'text/plain') == {'format': 'TXT'}
+    assert [d.name for d in registry.detectors][0] == 'expensive'
+
+    assert registry.detect(None, None) == {'format': 'XLS'}
+    assert registry.detect(None, 'application/pdf') is None
+    assert registry.refine(None, 'text/plain', {'format': 'TXT'}) == {'format': 'JSON'}
+    assert registry.refine(None, 'text/plain', None) is None
+    registry.unregister('refine-txt')
+    assert registry.refine(None, 'text/plain', {'format': 'TXT'}) is None
+
+
+def test_sniff_records():
+    from ckanext.qa.utils import iter_filepaths, sniff_records
+    fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    filepaths = list(iter_filepaths([fixture_data_dir]))
+    assert os.path.join(fixture_data_dir, 'elec00.csv') in filepaths
+
+    filepaths = [os.path.join(fixture_data_dir, 'elec00.csv'),
+                 os.path.join(fixture_data_dir, 'does-not-exist.csv')]
+    for workers in (1, 2):
+        records = sorted(sniff_records(filepaths, workers=workers),
+                         key=lambda record: record['filepath'])
+        assert [(record['format'], bool(record['error'])) for record in records] == \
+            [(None, True), ('CSV', False)]
+        assert records[1]['container'] is None
+        assert records[1]['elapsed'] >= 0
+
+
+def test_get_zipped_format_early_exit(tmp_path):
+    import zipfile
+    from ckanext.qa.sniff_format import get_zipped_format
+    filepath = str(tmp_path / 'bulk.zip')
+    with zipfile.ZipFile(filepath, 'w') as zip_:
+        for i in range(3000):
+            zip_.writestr('%d.csv' % i, b'')
+        # never reached - the CSV majority is stable by then
+        zip_.writestr('broken', b'')
+    with open(filepath, 'r+b') as f:
+        data = f.read()
+        f.seek(data.rfind(b'broken') - 46)
+        f.write(b'XXXX')
+    assert get_zipped_format(filepath) == {'format': 'CSV', 'container': 'ZIP'}
+
+    # shapefile members are spotted wherever they are in the zip
+    with zipfile.ZipFile(filepath, 'w') as zip_:
+        for name in ('map.shp', 'map.dbf', 'readme.txt', 'map.shx') + tuple('%d.csv' % i for i in range(100)):
+            zip_.writestr(name, b'')
+    assert get_zipped_format(filepath) == {'format': 'SHP'}
+
+
+def make_zip_of_csv_txt_files(filepath, num_files=3):
+    import zipfile
+    with zipfile.ZipFile(filepath, 'w') as zip_:
+        for i in range(num_files):
+            zip_.writestr('data%d.txt' % i, b'Date,Amount,Payee\n' + b'2012-01-01,100.00,Acme Ltd\n' * 50,
+                          compress_type=zipfile.ZIP_DEFLATED)
+
+
+@pytest.mark.usefixtures('ckan_config')
+@pytest.mark.ckan_config('qa.zip_member_sniff', 'true')
+def test_get_zipped_format_member_sniff(tmp_path):
+    filepath = str(tmp_path / 'data.zip')
+    make_zip_of_csv_txt_files(filepath)
+    assert sniff_file_format(filepath) == {'format': 'CSV', 'container': 'ZIP'}
+
+
+@pytest.mark.usefixtures('ckan_config')
+@pytest.mark.ckan_config('qa.zip_member_sniff', 'true')
+@pytest.mark.ckan_config('qa.zip_member_sniff.max_bytes', '0')
+def test_get_zipped_format_member_sniff_budget(tmp_path):
+    filepath = str(tmp_path / 'data.zip')
+    make_zip_of_csv_txt_files(filepath)
+    assert sniff_file_format(filepath) == {'format': 'TXT', 'container': 'ZIP'}
+
+
+@pytest.mark.usefixtures('ckan_config')
+@pytest.mark.ckan_config('qa.zip_member_sniff', 'true')
+def test_get_zipped_format_member_sniff_does_not_demote(tmp_path):
+    import zipfile
+    filepath = str(tmp_path / 'data.zip')
+    with zipfile.ZipFile(filepath, 'w') as zip_:
+        for i in range(3):
+            zip_.writestr('data%d.csv' % i, b'See the spreadsheet on our website.\n')
+    # the members sniff as TXT, which scores less than CSV
+    assert sniff_file_format(filepath) == {'format': 'CSV', 'container': 'ZIP'}
+
+
+def test_get_zipped_format_member_sniff_disabled(tmp_path):
+    filepath = str(tmp_path / 'data.zip')
+    make_zip_of_csv_txt_files(filepath)
+    assert sniff_file_format(filepath) == {'format': 'TXT', 'container': 'ZIP'}
+
+
+def test_get_compressed_format(tmp_path):
+    import tarfile
+    lzma = pytest.importorskip('lzma')
+    from ckanext.qa.sniff_format import get_compressed_format, decompress_head
+    fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    with open(os.path.join(fixture_data_dir, 'elec00.csv'), 'rb') as f:
+        csv_data = f.read()
+
+    filepath = str(tmp_path / 'elec00.csv.xz')
+    with lzma.open(filepath, 'wb') as f:
+        f.write(csv_data)
+    assert sniff_file_format(filepath) == {'format': 'CSV', 'container': 'XZ'}
+
+    # only the start is decompressed
+    with SniffContext(filepath) as context:
+        assert decompress_head(context.data, 'XZ', 1000) == csv_data[:1000]
+
+    filepath = str(tmp_path / 'data.tar')
+    with tarfile.open(filepath, 'w') as tar:
+        tar.add(os.path.join(fixture_data_dir, 'elec00.csv'), arcname='a/long/' + 'x' * 120 + '.csv')
+    assert sniff_file_format(filepath) == {'format': 'CSV', 'container': 'TAR'}
+
+    # a tar of unrecognised files
+    binary_filepath = str(tmp_path / 'data.bin')
+    with open(binary_filepath, 'wb') as f:
+        f.write(bytes(bytearray(range(256))) * 4)
+    filepath = str(tmp_path / 'data.tar.gz')
+    with tarfile.open(filepath, 'w:gz') as tar:
+        tar.add(binary_filepath, arcname='data.bin')
+    with SniffContext(filepath) as context:
+        assert get_compressed_format(context, 'application/gzip') == {'format': 'TAR', 'container': 'GZ'}
+
+
+def test_scan_rdfa():
+    from ckanext.qa.sniff_format import scan_rdfa, has_rdfa
+    fixture_data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    for filename, expected in (('BagotsResult2010.rdfa', True),
+                               ('index.html', False),
+                               ('hourly_means.html', False)):
+        with SniffContext(os.path.join(fixture_data_dir, filename)) as context:
+            for chunk_size in (100, 8192, 100000):
+                assert scan_rdfa(context.iter_text(100000, chunk_size)) == expected, (filename, chunk_size)
+            assert has_rdfa(context.text(100000)) == expected
+
+    # tags spanning chunks
+    html = '<html><head></head><body><div about="#me"><span property="name">Me</span></div></body></html>'
+    assert all(scan_rdfa([html[:i], html[i:]]) for i in range(len(html)))
+    # stops at the body budget
+    padding = '<p>text</p>' * 100
+    html = '<html><head></head><body>%s<div about="#me" property="name">Me</div></body></html>' % padding
+    assert scan_rdfa([html], body_budget=len(padding) + 100)
+    assert not scan_rdfa([html], body_budget=len(padding) - 100)
+    assert not scan_rdfa([html[i:i + 10] for i in range(0, len(html), 10)], body_budget=len(padding) - 100)
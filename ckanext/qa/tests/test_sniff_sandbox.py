@@ -0,0 +1,109 @@
+import os
+import signal
+import time
+
+import pytest
+
+from ckanext.qa import sniff_format
+from ckanext.qa.sniff_sandbox import (
+    SniffSandbox, SniffError, SniffTimeout, SniffMemoryError)
+
+pytest.importorskip('resource')
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def slow_sniff_file_format(filepath):
+    if filepath == 'slow':
+        time.sleep(30)
+    return {'format': 'CSV'}
+
+
+def busy_sniff_file_format(filepath):
+    while True:
+        pass
+
+
+def greedy_sniff_file_format(filepath):
+    return b'x' * (500 * 1024 * 1024)
+
+
+def failing_sniff_file_format(filepath):
+    raise ValueError('bad file')
+
+
+def killed_sniff_file_format(filepath):
+    # as the out-of-memory killer might
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+@pytest.fixture
+def sandbox():
+    sandbox_ = SniffSandbox(timeout=2, max_cpu_seconds=1, max_memory_mb=200)
+    yield sandbox_
+    sandbox_.close()
+
+
+def test_sniff(sandbox):
+    filepath = os.path.join(DATA_DIR, 'elec00.csv')
+    assert sandbox.sniff(filepath) == {'format': 'CSV'}
+    pid = sandbox.process.pid
+    # the same child is reused
+    assert sandbox.sniff(filepath) == {'format': 'CSV'}
+    assert sandbox.process.pid == pid
+
+
+def test_timeout(sandbox, monkeypatch):
+    # the child is forked after the patch, so it has it too
+    monkeypatch.setattr(sniff_format, 'sniff_file_format',
+                        slow_sniff_file_format)
+    with pytest.raises(SniffTimeout):
+        sandbox.sniff('slow')
+    assert sandbox.process is None
+    # another child is started for the next file
+    assert sandbox.sniff('fast') == {'format': 'CSV'}
+
+
+def test_cpu_limit(monkeypatch):
+    monkeypatch.setattr(sniff_format, 'sniff_file_format',
+                        busy_sniff_file_format)
+    sandbox = SniffSandbox(timeout=10, max_cpu_seconds=1, max_memory_mb=200)
+    start = time.time()
+    with pytest.raises(SniffTimeout):
+        sandbox.sniff('busy')
+    assert time.time() - start < 5
+
+
+def test_memory_limit(sandbox, monkeypatch):
+    monkeypatch.setattr(sniff_format, 'sniff_file_format',
+                        greedy_sniff_file_format)
+    with pytest.raises(SniffMemoryError):
+        sandbox.sniff('greedy')
+
+
+def test_error(sandbox, monkeypatch):
+    monkeypatch.setattr(sniff_format, 'sniff_file_format',
+                        failing_sniff_file_format)
+    with pytest.raises(SniffError) as e:
+        sandbox.sniff('bad')
+    assert 'ValueError: bad file' in str(e.value)
+
+
+def test_killed(sandbox, monkeypatch):
+    monkeypatch.setattr(sniff_format, 'sniff_file_format',
+                        killed_sniff_file_format)
+    start = time.time()
+    with pytest.raises(SniffError) as e:
+        sandbox.sniff('killed')
+    assert 'signal 9' in str(e.value)
+    assert time.time() - start < 2
+    assert sandbox.process is None
+
+
+@pytest.mark.ckan_config('qa.sniff_sandbox', 'true')
+def test_quarantine_enabled_with_the_sandbox(ckan_config, monkeypatch):
+    from ckanext.qa import quarantine
+    monkeypatch.delitem(ckan_config, 'qa.quarantine', raising=False)
+    assert quarantine.is_enabled()
+    monkeypatch.setitem(ckan_config, 'qa.quarantine', 'false')
+    assert not quarantine.is_enabled()
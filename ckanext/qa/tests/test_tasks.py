@@ -141,6 +141,8 @@ class TestResourceScore():
         assert 'Content of file appeared to be format "CSV"' in result['openness_score_reason'], result
         assert result['format'] == 'CSV', result
         assert result['archival_timestamp'] == TODAY_STR, result
+        from ckanext.qa.lib import get_score_table
+        assert result['score_table_version'] == get_score_table().version
 
     def test_not_archived(self):
         result = resource_score(self._test_resource(archived=False, cached=False, format=None))
@@ -266,6 +268,263 @@ class TestResourceScore():
                                                    ' Attempted on 10/10/2008. This URL last worked on: 01/10/2008.')
 
 
+@pytest.mark.usefixtures('with_plugins')
+@pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
+@pytest.mark.ckan_config('qa.sniff_cache', 'true')
+class TestSniffCache():
+    @pytest.fixture(autouse=True)
+    @pytest.mark.usefixtures('clean_db')
+    def init_data(cls, clean_db):
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def _test_resource(self, content_hash):
+        pkg = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'anything', 'format': 'TXT', 'description': 'Test'}])
+        res_id = pkg['resources'][0]['id']
+        archival = Archival.create(res_id)
+        archival.cache_filepath = __file__  # just needs to exist
+        archival.hash = content_hash
+        archival.updated = TODAY
+        model.Session.add(archival)
+        model.Session.commit()
+        return model.Resource.get(res_id)
+
+    def test_same_content_is_not_sniffed_again(self):
+        set_sniffed_format('CSV')
+        result = resource_score(self._test_resource(content_hash='abc'))
+        assert result['format'] == 'CSV', result
+        # were the file sniffed again, it would now come out as XLS
+        set_sniffed_format('XLS')
+        result = resource_score(self._test_resource(content_hash='abc'))
+        assert result['format'] == 'CSV', result
+
+    def test_changed_content_is_sniffed(self):
+        set_sniffed_format('CSV')
+        resource_score(self._test_resource(content_hash='abc'))
+        set_sniffed_format('XLS')
+        result = resource_score(self._test_resource(content_hash='def'))
+        assert result['format'] == 'XLS', result
+
+    def test_timeout_is_not_sniffed_again(self, monkeypatch):
+        from ckanext.qa.sniff_sandbox import SniffTimeout
+        calls = []
+
+        def timing_out_sniff_file_format(filepath):
+            calls.append(filepath)
+            raise SniffTimeout('Sniffing took longer than 60 seconds')
+        monkeypatch.setattr(ckanext.qa.tasks, 'sniff_file_format',
+                            timing_out_sniff_file_format)
+        result = resource_score(self._test_resource(content_hash='abc'))
+        assert 'timed out' in result['openness_score_reason'], result
+        # falls back to the format field
+        assert result['format'] == 'TXT', result
+        result = resource_score(self._test_resource(content_hash='abc'))
+        assert 'timed out' in result['openness_score_reason'], result
+        assert len(calls) == 1
+
+
+@pytest.mark.usefixtures('with_plugins')
+@pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
+@pytest.mark.ckan_config('qa.quarantine', 'true')
+class TestQuarantine():
+    @pytest.fixture(autouse=True)
+    @pytest.mark.usefixtures('clean_db')
+    def init_data(cls, clean_db):
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def _test_resource(self, content_hash):
+        pkg = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'anything', 'format': 'TXT', 'description': 'Test'}])
+        res_id = pkg['resources'][0]['id']
+        archival = Archival.create(res_id)
+        archival.cache_filepath = __file__  # just needs to exist
+        archival.hash = content_hash
+        archival.updated = TODAY
+        model.Session.add(archival)
+        model.Session.commit()
+        return model.Resource.get(res_id)
+
+    def _crash_sniffing(self, monkeypatch):
+        calls = []
+
+        def crashing_sniff_file_format(filepath):
+            calls.append(filepath)
+            raise ValueError('crash')
+        monkeypatch.setattr(ckanext.qa.tasks, 'sniff_file_format',
+                            crashing_sniff_file_format)
+        return calls
+
+    def test_failure_is_quarantined(self, monkeypatch):
+        calls = self._crash_sniffing(monkeypatch)
+        resource = self._test_resource(content_hash='abc')
+        result = resource_score(resource)
+        assert 'failed' in result['openness_score_reason'], result
+        # falls back to the format field
+        assert result['format'] == 'TXT', result
+        model.Session.commit()
+        entry = qa_model.SniffQuarantine.get(u'hash:abc')
+        assert entry.failure_count == 1
+        assert entry.resource_id == resource.id
+        assert 'ValueError: crash' in entry.last_error
+
+        result = resource_score(resource)
+        assert 'will not be tried again' in result['openness_score_reason']
+        assert len(calls) == 1
+
+    def test_changed_content_is_sniffed(self, monkeypatch):
+        calls = self._crash_sniffing(monkeypatch)
+        resource_score(self._test_resource(content_hash='abc'))
+        model.Session.commit()
+        resource_score(self._test_resource(content_hash='def'))
+        assert len(calls) == 2
+
+    def test_release(self, monkeypatch):
+        from ckanext.qa import quarantine
+        calls = self._crash_sniffing(monkeypatch)
+        resource = self._test_resource(content_hash='abc')
+        resource_score(resource)
+        model.Session.commit()
+        assert quarantine.release([resource.id]) == 1
+        set_sniffed_format('CSV')
+        monkeypatch.setattr(ckanext.qa.tasks, 'sniff_file_format',
+                            mock_sniff_file_format)
+        result = resource_score(resource)
+        assert result['format'] == 'CSV', result
+        assert len(calls) == 1
+
+    def test_backoff_doubles(self):
+        from ckanext.qa.quarantine import get_backoff
+        assert get_backoff(1) == datetime.timedelta(hours=1)
+        assert get_backoff(2) == datetime.timedelta(hours=2)
+        assert get_backoff(3) == datetime.timedelta(hours=4)
+        assert get_backoff(100) == datetime.timedelta(days=30)
+
+    def test_missing_cache_file(self, monkeypatch):
+        calls = self._crash_sniffing(monkeypatch)
+        resource = self._test_resource(content_hash=None)
+        archival = Archival.get_for_resource(resource.id)
+        archival.cache_filepath = '/nonexistent/cache/file'
+        model.Session.commit()
+        result = resource_score(resource)
+        assert 'Cache filepath does not exist' in \
+            result['openness_score_reason'], result
+        assert result['fingerprint'], result
+        assert calls == []
+
+    def test_sniff_cache_warm(self, monkeypatch):
+        from ckanext.qa import utils
+        calls = self._crash_sniffing(monkeypatch)
+        resources = [self._test_resource(content_hash=content_hash)
+                     for content_hash in ('abc', 'def')]
+        utils.sniff_cache_warm([])
+        assert len(calls) == 2
+        for content_hash, resource in zip(('abc', 'def'), resources):
+            entry = qa_model.SniffQuarantine.get(u'hash:' + content_hash)
+            assert entry.resource_id == resource.id
+        # quarantined, so not sniffed again
+        utils.sniff_cache_warm([])
+        assert len(calls) == 2
+
+
+@pytest.mark.usefixtures('with_plugins')
+@pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
+@pytest.mark.ckan_config('qa.sniff_sandbox', 'true')
+class TestQuarantineWithSniffSandbox():
+    @pytest.fixture(autouse=True)
+    @pytest.mark.usefixtures('clean_db')
+    def init_data(cls, clean_db):
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def _test_resource(self, content_hash):
+        pkg = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'anything', 'format': 'TXT', 'description': 'Test'}])
+        res_id = pkg['resources'][0]['id']
+        archival = Archival.create(res_id)
+        archival.cache_filepath = __file__  # just needs to exist
+        archival.hash = content_hash
+        archival.updated = TODAY
+        model.Session.add(archival)
+        model.Session.commit()
+        return model.Resource.get(res_id)
+
+    def test_timeout_is_not_sniffed_again(self, monkeypatch):
+        from ckanext.qa import sniff_sandbox
+        calls = []
+
+        def sniff(filepath):
+            calls.append(filepath)
+            raise sniff_sandbox.SniffTimeout('Sniffing took too long')
+        monkeypatch.setattr(sniff_sandbox, 'sniff', sniff)
+        resource = self._test_resource(content_hash='abc')
+        result = resource_score(resource)
+        assert 'timed out' in result['openness_score_reason'], result
+        model.Session.commit()
+
+        # without qa.quarantine set, the sandbox enables it
+        result = resource_score(resource)
+        assert 'will not be tried again' in result['openness_score_reason']
+        assert len(calls) == 1
+
+
+@pytest.mark.usefixtures('with_plugins')
+@pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
+@pytest.mark.ckan_config('qa.quarantine', 'true')
+@pytest.mark.ckan_config('qa.sniff_cache', 'true')
+class TestQuarantineWithSniffCache(TestQuarantine):
+    def _time_out_sniffing(self, monkeypatch):
+        from ckanext.qa.sniff_sandbox import SniffTimeout
+        calls = []
+
+        def timing_out_sniff_file_format(filepath):
+            calls.append(filepath)
+            raise SniffTimeout('Sniffing took longer than 60 seconds')
+        monkeypatch.setattr(ckanext.qa.tasks, 'sniff_file_format',
+                            timing_out_sniff_file_format)
+        return calls
+
+    def test_timeout_is_released(self, monkeypatch):
+        from ckanext.qa import quarantine
+        calls = self._time_out_sniffing(monkeypatch)
+        resource = self._test_resource(content_hash='abc')
+        result = resource_score(resource)
+        assert 'timed out' in result['openness_score_reason'], result
+        model.Session.commit()
+        # the quarantine, not the sniff cache, stops it being sniffed again
+        assert not qa_model.SniffCache.get(u'hash:abc')
+        result = resource_score(resource)
+        assert 'will not be tried again' in result['openness_score_reason']
+        assert len(calls) == 1
+
+        assert quarantine.release([resource.id]) == 1
+        set_sniffed_format('CSV')
+        monkeypatch.setattr(ckanext.qa.tasks, 'sniff_file_format',
+                            mock_sniff_file_format)
+        result = resource_score(resource)
+        assert result['format'] == 'CSV', result
+
+    def test_timeout_is_sniffed_after_backoff(self, monkeypatch):
+        from ckanext.qa import sniff_cache
+        calls = self._time_out_sniffing(monkeypatch)
+        resource = self._test_resource(content_hash='abc')
+        resource_score(resource)
+        # as cached before the quarantine was enabled
+        sniff_cache.put(u'hash:abc', None, outcome=u'timeout')
+        entry = qa_model.SniffQuarantine.get(u'hash:abc')
+        entry.retry_after = datetime.datetime.now() - \
+            datetime.timedelta(minutes=1)
+        model.Session.commit()
+
+        set_sniffed_format('CSV')
+        monkeypatch.setattr(ckanext.qa.tasks, 'sniff_file_format',
+                            mock_sniff_file_format)
+        result = resource_score(resource)
+        assert result['format'] == 'CSV', result
+        assert len(calls) == 1
+
+
 class TestExtensionVariants():
     def test_0_normal(self):
         assert extension_variants('http://dept.gov.uk/coins-data-1996.csv') == ['csv']
@@ -296,6 +555,7 @@ class TestSaveQaResult():
             'openness_score_reason': 'Detected as CSV which scores 3',
             'format': 'CSV',
             'archival_timestamp': datetime.datetime(2015, 12, 16),
+            'score_table_version': 'abc123',
             }
         qa_result.update(kwargs)
         return qa_result
@@ -311,8 +571,50 @@ class TestSaveQaResult():
         assert qa.openness_score_reason == qa_result['openness_score_reason']
         assert qa.format == qa_result['format']
         assert qa.archival_timestamp == qa_result['archival_timestamp']
+        assert qa.score_table_version == 'abc123'
         assert qa.updated == qa.updated
 
+    def test_resource_id_not_unique(self, monkeypatch):
+        # as on a site upgraded without running qa init
+        engine = model.meta.engine
+        with engine.begin() as connection:
+            connection.execute('DROP INDEX ix_qa_resource_id')
+            connection.execute('CREATE INDEX ix_qa_resource_id '
+                               'ON qa (resource_id)')
+        monkeypatch.setattr(qa_model, '_upsert_supported', {})
+        assert not qa_model.supports_upsert(engine)
+        resource = model.Resource.get(ckan_factories.Resource()['id'])
+
+        changed = ckanext.qa.tasks.save_qa_results(
+            [(resource, self.get_qa_result(), resource.package_id)])
+
+        assert changed == [resource.id]
+        assert qa_model.QA.get_for_resource(resource.id).format == 'CSV'
+        qa_model.make_qa_resource_id_unique(engine)
+        assert qa_model.supports_upsert(engine)
+
+    def test_duplicates_are_only_deleted_with_dedupe(self):
+        engine = model.meta.engine
+        with engine.begin() as connection:
+            connection.execute('DROP INDEX ix_qa_resource_id')
+            connection.execute('CREATE INDEX ix_qa_resource_id '
+                               'ON qa (resource_id)')
+        resource = model.Resource.get(ckan_factories.Resource()['id'])
+        for day in (1, 2):
+            qa = qa_model.QA.create(resource.id)
+            qa.updated = datetime.datetime(2020, 1, day)
+            model.Session.add(qa)
+        model.Session.commit()
+
+        assert qa_model.make_qa_resource_id_unique(engine) is False
+        assert model.Session.query(qa_model.QA) \
+            .filter_by(resource_id=resource.id).count() == 2
+
+        assert qa_model.make_qa_resource_id_unique(engine, dedupe=True)
+        qas = model.Session.query(qa_model.QA) \
+            .filter_by(resource_id=resource.id).all()
+        assert [qa.updated.day for qa in qas] == [2]
+
 
 @pytest.mark.usefixtures('with_plugins')
 @pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
@@ -339,6 +641,107 @@ class TestUpdatePackage():
         assert qa.openness_score == 0
         assert qa.openness_score_reason == 'License not open'
 
+    def test_package_show(self):
+        dataset = ckan_factories.Dataset(resources=[
+            {'url': 'http://example.com/file.csv', 'format': ''}])
+        ckanext.qa.tasks.update_package_(dataset['id'])
+
+        dataset = get_action('package_show')({}, {'id': dataset['id']})
+
+        assert sorted(dataset['resources'][0]['qa']) == [
+            'archival_timestamp', 'created', 'format', 'openness_score',
+            'openness_score_reason', 'resource_timestamp', 'updated']
+
+    def test_several_resources(self):
+        dataset = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'http://example.com/file.csv', 'format': ''},
+            {'url': 'http://example.com/file.xls', 'format': ''},
+            {'url': 'http://example.com/data', 'format': 'JSON'}])
+        # an existing result is updated
+        ckanext.qa.tasks.update_package_(dataset['id'])
+        ckanext.qa.tasks.update_package_(dataset['id'])
+
+        formats = []
+        for resource in dataset['resources']:
+            qas = model.Session.query(qa_model.QA) \
+                .filter_by(resource_id=resource['id']).all()
+            assert len(qas) == 1
+            assert qas[0].package_id == dataset['id']
+            formats.append(qas[0].format)
+        assert formats == ['CSV', 'XLS', 'JSON']
+
+    def test_unchanged_resources_are_skipped(self, monkeypatch):
+        dataset = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'http://example.com/file.csv', 'format': ''},
+            {'url': 'http://example.com/file.xls', 'format': ''}])
+        ckanext.qa.tasks.update_package_(dataset['id'])
+        qa = qa_model.QA.get_for_resource(dataset['resources'][0]['id'])
+        assert qa.fingerprint
+
+        scored = []
+
+        def resource_score(resource, **kwargs):
+            scored.append(resource.id)
+            return real_resource_score(resource, **kwargs)
+        real_resource_score = ckanext.qa.tasks.resource_score
+        monkeypatch.setattr(ckanext.qa.tasks, 'resource_score',
+                            resource_score)
+
+        ckanext.qa.tasks.update_package_(dataset['id'])
+        assert scored == []
+
+        resource = model.Resource.get(dataset['resources'][1]['id'])
+        resource.url = 'http://example.com/file.json'
+        model.Session.commit()
+        ckanext.qa.tasks.update_package_(dataset['id'])
+        assert scored == [resource.id]
+        assert qa_model.QA.get_for_resource(resource.id).format == 'JSON'
+
+        ckanext.qa.tasks.update_package_(dataset['id'], force=True)
+        assert len(scored) == 3
+
+
+@pytest.mark.usefixtures('with_plugins')
+@pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
+class TestUpdatePackages():
+    @pytest.fixture(autouse=True)
+    @pytest.mark.usefixtures('clean_db')
+    def init_data(cls, clean_db):
+        archiver_model.init_tables(model.meta.engine)
+        qa_model.init_tables(model.meta.engine)
+
+    def test_simple(self):
+        datasets = [
+            ckan_factories.Dataset(license_id='uk-ogl', resources=[
+                {'url': 'http://example.com/file.csv', 'format': ''}]),
+            ckan_factories.Dataset(license_id='uk-ogl', resources=[
+                {'url': 'http://example.com/file.xls', 'format': ''},
+                {'url': 'http://example.com/data', 'format': 'JSON'}])]
+
+        ckanext.qa.tasks.update_packages_(
+            [dataset['id'] for dataset in datasets] + ['missing'])
+
+        formats = [qa_model.QA.get_for_resource(resource['id']).format
+                   for dataset in datasets
+                   for resource in dataset['resources']]
+        assert formats == ['CSV', 'XLS', 'JSON']
+
+    def test_unchanged_results_are_not_saved(self):
+        dataset = ckan_factories.Dataset(license_id='uk-ogl', resources=[
+            {'url': 'http://example.com/file.csv', 'format': ''},
+            {'url': 'http://example.com/file.xls', 'format': ''}])
+        resources = [model.Resource.get(resource['id'])
+                     for resource in dataset['resources']]
+        results = [(resource, resource_score(resource), dataset['id'])
+                   for resource in resources]
+        changed = ckanext.qa.tasks.save_qa_results(results)
+        assert sorted(changed) == sorted(resource.id for resource in resources)
+
+        results[1][1]['format'] = 'CSV'
+        changed = ckanext.qa.tasks.save_qa_results(results)
+        assert changed == [resources[1].id]
+        assert qa_model.QA.get_for_resource(resources[1].id).format == 'CSV'
+
 
 @pytest.mark.usefixtures('with_plugins')
 @pytest.mark.ckan_config('ckan.plugins', 'qa archiver report')
@@ -0,0 +1,79 @@
+import pytest
+
+from ckanext.qa import timing
+
+
+@pytest.mark.usefixtures('ckan_config')
+class TestTiming(object):
+    def test_disabled(self):
+        with timing.job('update_package') as timings:
+            assert timings is None
+            assert timing.current() is None
+            with timing.stage('sniff'):
+                pass
+
+    @pytest.mark.ckan_config('qa.timing', 'true')
+    def test_stages_are_added_up(self):
+        with timing.job('resource', resource_id='r1') as timings:
+            for i in range(3):
+                with timing.stage('sniff'):
+                    pass
+            with timing.stage('archival'):
+                pass
+        assert timing.current() is None
+        timings_dict = timings.as_dict()
+        assert timings_dict['job'] == 'resource'
+        assert timings_dict['info'] == {'resource_id': 'r1'}
+        assert timings_dict['total'] >= 0
+        assert timings_dict['stages']['sniff']['count'] == 3
+        assert timings_dict['stages']['archival']['count'] == 1
+
+    @pytest.mark.ckan_config('qa.timing', 'true')
+    def test_nested_jobs_add_to_the_outer_job(self):
+        with timing.job('update_package') as package_timings:
+            for i in range(2):
+                with timing.job('resource') as resource_timings:
+                    with timing.stage('sniff'):
+                        pass
+                assert timing.current() is package_timings
+                assert resource_timings.stages['sniff'][0] == 1
+            with timing.stage('update_search_index'):
+                pass
+        assert package_timings.stages['sniff'][0] == 2
+        assert package_timings.stages['update_search_index'][0] == 1
+
+    @pytest.mark.ckan_config('qa.timing', 'true')
+    def test_stage_timed_when_it_raises(self):
+        with timing.job('resource') as timings:
+            with pytest.raises(ValueError):
+                with timing.stage('xlrd'):
+                    raise ValueError()
+        assert timings.stages['xlrd'][0] == 1
+
+    @pytest.mark.ckan_config('qa.timing', 'true')
+    @pytest.mark.ckan_config('qa.timing.store', 'true')
+    def test_stored_after_the_job(self, monkeypatch):
+        stored = []
+        monkeypatch.setattr(timing, '_store', stored.append)
+        with timing.job('update_package') as package_timings:
+            for resource_id in ('r1', 'r2'):
+                with timing.job('resource') as resource_timings:
+                    with timing.stage('sniff'):
+                        pass
+                    timing.save(resource_id, 'd1', resource_timings)
+            with timing.stage('save_qa_result'):
+                pass
+            with timing.stage('update_search_index'):
+                pass
+            assert stored == []
+        assert stored == [package_timings]
+
+        results = timing.resource_timings(package_timings)
+        assert [result[:2] for result in results] == [('r1', 'd1'),
+                                                      ('r2', 'd1')]
+        stages = results[0][2].stages
+        # its own sniffing, and the stages shared by the job's resources
+        assert stages['sniff'][0] == 1
+        assert stages['save_qa_result'][0] == 1
+        assert stages['update_search_index'][0] == 1
+        assert results[0][2].total <= package_timings.total
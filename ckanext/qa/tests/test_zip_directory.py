@@ -0,0 +1,69 @@
+import io
+import zipfile
+
+import pytest
+
+from ckanext.qa.zip_directory import ZipDirectory, ZipDirectoryError
+
+
+def make_zip(names, comment=b''):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zip_:
+        for name in names:
+            zip_.writestr(name, b'data')
+        zip_.comment = comment
+    return buf.getvalue()
+
+
+def test_iter_names():
+    names = [u'a.csv', u'dir/b.xml', u'caf\xe9.txt']
+    assert list(ZipDirectory(make_zip(names)).iter_names()) == names
+
+
+def test_iter_names_with_comment_and_prepended_data():
+    names = [u'a.csv', u'b.csv']
+    data = b'MZ' + b'\x00' * 1000 + make_zip(names, comment=b'PK comment')
+    zip_directory = ZipDirectory(data)
+    assert zip_directory.prepended_size == 1002
+    assert list(zip_directory.iter_names()) == names
+
+
+def test_zip64():
+    # more than 65535 members needs the zip64 end of central directory
+    names = [u'%d.csv' % i for i in range(70000)]
+    data = make_zip(names)
+    assert b'PK\x06\x06' in data
+    zip_directory = ZipDirectory(data)
+    assert zip_directory.num_entries == 70000
+    names_iter = zip_directory.iter_names()
+    assert [next(names_iter) for i in range(3)] == names[:3]
+
+
+def test_not_a_zip():
+    with pytest.raises(ZipDirectoryError):
+        ZipDirectory(b'not a zip file at all, just some text')
+    with pytest.raises(ZipDirectoryError):
+        ZipDirectory(b'')
+
+
+def test_truncated():
+    data = make_zip([u'a.csv', u'b.csv'])
+    # chop out the end of the central directory, keeping the EOCD
+    eocd_offset = data.rfind(b'PK\x05\x06')
+    with pytest.raises(ZipDirectoryError):
+        list(ZipDirectory(data[:eocd_offset - 10] + data[eocd_offset:]).iter_names())
+
+
+def test_read_prefix():
+    content = b'a,b,c\n' * 10000
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zip_:
+        zip_.writestr('stored.csv', content, compress_type=zipfile.ZIP_STORED)
+        zip_.writestr('deflated.csv', content, compress_type=zipfile.ZIP_DEFLATED)
+    zip_directory = ZipDirectory(buf.getvalue())
+    stored, deflated = list(zip_directory.iter_entries())
+    assert stored.size == deflated.size == len(content)
+    assert deflated.compressed_size < deflated.size
+    for entry in (stored, deflated):
+        assert zip_directory.read_prefix(entry, 100) == content[:100]
+        assert zip_directory.read_prefix(entry, 10 ** 6) == content
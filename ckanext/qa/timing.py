@@ -0,0 +1,243 @@
+'''
+Per-stage timing of QA jobs.
+
+Stages of a job (getting the archival, libmagic, each detector, xlrd, the
+"file" command, saving the result, reindexing etc.) are timed with:
+
+    with timing.stage('libmagic'):
+        ...
+
+and the time spent in each stage is added up over the job, which is run in:
+
+    with timing.job('update_package', package_id=package.id):
+        ...
+
+At the end of a job the timings are logged as a line of JSON, passed to
+plugins implementing IQATimings and, if qa.timing.store is enabled, saved in
+the qa_timing table for each resource. They are saved when the outermost job
+ends, so that they include the stages after the scoring, which are shared by
+all of the job's resources (e.g. save_qa_result and update_search_index).
+
+It is only enabled if qa.timing is true. Otherwise no job is started, and
+stage() just returns a shared no-op context manager, so the overhead is a
+thread-local lookup per stage.
+
+Stages can be nested (e.g. the detectors run within 'sniff'), so their times
+can add up to more than the job's total.
+'''
+import json
+import logging
+import threading
+import time
+
+from ckan.plugins import toolkit
+from ckan.plugins.toolkit import config
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def is_enabled():
+    return toolkit.asbool(config.get('qa.timing', False))
+
+
+def is_storing():
+    return is_enabled() and toolkit.asbool(config.get('qa.timing.store', False))
+
+
+class Timings(object):
+    '''The time spent in each stage of a job.'''
+    def __init__(self, job_name, info=None):
+        self.job_name = job_name
+        self.info = info or {}
+        self.stages = {}  # name: [count, seconds]
+        self.started = time.time()
+        self.total = None
+        # the job this is nested in
+        self.parent = None
+        # (resource_id, package_id, Timings) to store when the job ends
+        self.resources = []
+
+    def add(self, name, seconds, count=1):
+        totals = self.stages.get(name)
+        if totals is None:
+            self.stages[name] = [count, seconds]
+        else:
+            totals[0] += count
+            totals[1] += seconds
+
+    def merge(self, timings):
+        for name, (count, seconds) in timings.stages.items():
+            self.add(name, seconds, count)
+
+    def subtract(self, timings):
+        for name, (count, seconds) in timings.stages.items():
+            totals = self.stages.get(name)
+            if totals is None:
+                continue
+            totals[0] -= count
+            totals[1] -= seconds
+            if totals[0] <= 0:
+                del self.stages[name]
+
+    def root(self):
+        '''Returns the outermost job's Timings.'''
+        timings = self
+        while timings.parent is not None:
+            timings = timings.parent
+        return timings
+
+    def as_dict(self):
+        return {
+            'job': self.job_name,
+            'info': self.info,
+            'total': self.total if self.total is not None
+            else time.time() - self.started,
+            'stages': dict((name, {'count': count, 'seconds': seconds})
+                           for name, (count, seconds) in self.stages.items()),
+        }
+
+
+class _Stage(object):
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.add(self.name, time.time() - self.start)
+
+
+class _NoOpStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_OP_STAGE = _NoOpStage()
+
+
+def current():
+    '''Returns the Timings of the job that is running, or None.'''
+    return getattr(_local, 'timings', None)
+
+
+def stage(name):
+    '''Returns a context manager that times a stage of the current job.'''
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        return _NO_OP_STAGE
+    return _Stage(timings, name)
+
+
+class job(object):
+    '''Context manager that times the stages of a job, if qa.timing is
+    enabled. When it is nested in another job, its timings are added to that
+    job's too.
+
+    The Timings are available as the "as" target (None if disabled).
+    '''
+    def __init__(self, name, **info):
+        self.name = name
+        self.info = info
+        self.timings = None
+        self.parent = None
+
+    def __enter__(self):
+        if not is_enabled():
+            return None
+        self.parent = current()
+        self.timings = Timings(self.name, self.info)
+        self.timings.parent = self.parent
+        _local.timings = self.timings
+        return self.timings
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.timings is None:
+            return
+        _local.timings = self.parent
+        self.timings.total = time.time() - self.timings.started
+        if self.parent is not None:
+            self.parent.merge(self.timings)
+        report(self.timings, failed=exc_type is not None)
+        if self.parent is None and self.timings.resources and \
+                exc_type is None:
+            try:
+                _store(self.timings)
+            except Exception:
+                log.exception('Could not store the QA timings')
+
+
+def report(timings, failed=False):
+    '''Logs the timings of a job and passes them to IQATimings plugins.'''
+    timings_dict = timings.as_dict()
+    timings_dict['failed'] = failed
+    log.info('QA timings: %s', json.dumps(timings_dict, sort_keys=True,
+                                          default=str))
+    from ckan import plugins
+    from ckanext.qa.interfaces import IQATimings
+    for plugin in plugins.PluginImplementations(IQATimings):
+        try:
+            plugin.qa_timings(timings_dict)
+        except Exception:
+            log.exception('IQATimings plugin %r failed', plugin)
+
+
+def save(resource_id, package_id, timings):
+    '''Stores the timings of a resource's QA, if qa.timing.store is enabled.
+    They are stored when the outermost job ends, after the QA results have
+    been saved and the dataset reindexed.'''
+    if timings is None or not is_storing():
+        return
+    timings.root().resources.append((resource_id, package_id, timings))
+
+
+def resource_timings(job_timings):
+    '''Returns the timings of the resources QA'd in a job that has ended,
+    as a list of (resource_id, package_id, Timings). The stages of the job
+    that were outside any resource (e.g. save_qa_result and
+    update_search_index) are added to each, as they are shared by them
+    all.'''
+    shared = Timings(job_timings.job_name)
+    shared.merge(job_timings)
+    shared_total = job_timings.total
+    for resource_id, package_id, timings in job_timings.resources:
+        if timings is not job_timings:
+            shared.subtract(timings)
+            shared_total -= timings.total
+    results = []
+    for resource_id, package_id, timings in job_timings.resources:
+        resource_timings_ = Timings(timings.job_name, timings.info)
+        resource_timings_.merge(timings)
+        resource_timings_.total = timings.total
+        if timings is not job_timings:
+            resource_timings_.merge(shared)
+            resource_timings_.total += shared_total
+        results.append((resource_id, package_id, resource_timings_))
+    return results
+
+
+def _store(job_timings):
+    import datetime
+    from ckan import model
+    from ckanext.qa.model import QATiming
+    now = datetime.datetime.now()
+    for resource_id, package_id, timings in resource_timings(job_timings):
+        qa_timing = QATiming.get(resource_id)
+        if not qa_timing:
+            qa_timing = QATiming(resource_id=resource_id)
+            model.Session.add(qa_timing)
+        timings_dict = timings.as_dict()
+        qa_timing.package_id = package_id
+        qa_timing.total = timings_dict['total']
+        qa_timing.timings = json.dumps(timings_dict['stages'], sort_keys=True)
+        qa_timing.updated = now
+    model.Session.commit()
@@ -5,13 +5,13 @@ import logging
 log = logging.getLogger(__name__)
 
 
-def init_db():
+def init_db(dedupe=False):
     import ckan.model as model
     from ckanext.qa.model import init_tables
-    init_tables(model.meta.engine)
+    init_tables(model.meta.engine, dedupe=dedupe)
 
 
-def update(ids, queue):
+def update(ids, queue, batch_size=1, force=False):
     from ckan import model
     from ckanext.qa import lib
     packages = []
@@ -74,8 +74,16 @@ def update(ids, queue):
         sys.exit(1)
 
     log.info('Queue: %s', queue)
+    if batch_size > 1:
+        # several datasets per job, with their results saved together
+        for i in range(0, len(packages), batch_size):
+            batch = packages[i:i + batch_size]
+            lib.create_qa_update_packages_task(batch, queue, force=force)
+            log.info('Queuing %i datasets (%s to %s)', len(batch),
+                     batch[0].name, batch[-1].name)
+        packages = []
     for package in packages:
-        lib.create_qa_update_package_task(package, queue)
+        lib.create_qa_update_package_task(package, queue, force=force)
         log.info('Queuing dataset %s (%s resources)',
                  package.name, len(package.resources))
 
@@ -87,17 +95,251 @@ def update(ids, queue):
     log.info('Completed queueing')
 
 
-def sniff(filepaths):
-    from ckanext.qa.sniff_format import sniff_file_format
+def sniff(filepaths, workers=1, recursive=False, output='text'):
+    '''Sniffs the format of files and prints the results.
+
+    :param filepaths: files to sniff, or directories if recursive
+    :param workers: number of processes to sniff files in parallel
+    :param recursive: sniff all the files in directories
+    :param output: 'text' or 'jsonl' - one JSON record per file, with keys:
+                   filepath, format, container, elapsed (seconds) and error
+    '''
+    import json
 
-    for filepath in filepaths:
-        format_ = sniff_file_format(
-            filepath)
-        if format_:
-            print('Detected as: %s - %s' % (format_['display_name'],
-                                            filepath))
+    if recursive:
+        filepaths = iter_filepaths(filepaths)
+    for record in sniff_records(filepaths, workers=workers):
+        if output == 'jsonl':
+            print(json.dumps(record))
+        elif record['error']:
+            print('ERROR: Could not sniff %s - %s' % (record['filepath'],
+                                                      record['error']))
+        elif record['format']:
+            print('Detected as: %s - %s' % (
+                '%s (%s)' % (record['format'], record['container'])
+                if record['container'] else record['format'],
+                record['filepath']))
         else:
-            print('ERROR: Could not recognise format of: %s' % filepath)
+            print('ERROR: Could not recognise format of: %s'
+                  % record['filepath'])
+        sys.stdout.flush()
+
+
+def iter_filepaths(paths):
+    '''Yields the given file paths, and the paths of the files in the given
+    directories, recursively.'''
+    import os
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                yield os.path.join(dirpath, filename)
+
+
+def sniff_records(filepaths, workers=1):
+    '''Sniffs the files, in a pool of worker processes if workers > 1, and
+    yields a record dict for each (see sniff_record). With workers, the
+    records are yielded in the order that they finish.'''
+    if workers <= 1:
+        for filepath in filepaths:
+            yield sniff_record(filepath)
+        return
+    import multiprocessing
+    # forked workers inherit the loaded CKAN config
+    pool = multiprocessing.Pool(workers)
+    try:
+        for record in pool.imap_unordered(sniff_record, filepaths,
+                                          chunksize=16):
+            yield record
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def sniff_record(filepath):
+    '''Sniffs a file and returns a record dict with keys: filepath, format,
+    container, elapsed (seconds) and error (or None).'''
+    import time
+    from ckanext.qa.sniff_format import sniff_file_format
+
+    start = time.time()
+    format_ = error = None
+    try:
+        format_ = sniff_file_format(filepath)
+    except Exception as e:
+        # e.g. file unreadable - carry on with the rest of the batch
+        error = '%s: %s' % (type(e).__name__, e)
+    return {
+        'filepath': filepath,
+        'format': format_['format'] if format_ else None,
+        'container': format_.get('container') if format_ else None,
+        'elapsed': round(time.time() - start, 6),
+        'error': error,
+    }
+
+
+def sniff_cache_stats():
+    from ckanext.qa import sniff_cache
+
+    stats = sniff_cache.stats()
+    print('Sniff cache entries: %i (%i hits)' % (stats['entries'], stats['hits']))
+    print('Last used between %s and %s' % (stats['oldest_last_used'],
+                                           stats['newest_last_used']))
+    print('By detector version (current is %s):' %
+          stats['current_detector_version'])
+    for version, count in sorted(stats['by_detector_version'].items()):
+        print('* %s: %i' % (version, count))
+    print('By format:')
+    for format_, count in sorted(stats['by_format'].items(),
+                                 key=lambda x: -x[1]):
+        print('* %s: %i' % (format_ or '(not recognised)', count))
+    if stats['by_outcome']:
+        print('Exceeded a sniff sandbox limit:')
+        for outcome, count in sorted(stats['by_outcome'].items()):
+            print('* %s: %i' % (outcome, count))
+
+
+def sniff_cache_prune(max_age_days=None, max_entries=None):
+    from ckanext.qa import sniff_cache
+
+    deleted = sniff_cache.prune(max_age_days, max_entries)
+    print('%i sniff cache entries deleted' % deleted)
+
+
+def sniff_cache_warm(ids):
+    '''Sniffs the archived files of the given datasets (or all of them) that
+    are not in the sniff cache yet, without doing any scoring. Files are
+    sniffed as QA would sniff them - in the sniff sandbox and skipping
+    quarantined files, if they are enabled - and a file that fails is
+    logged (and quarantined) and the rest carry on.'''
+    import os
+    from ckan import model
+    from ckanext.archiver.model import Archival
+    from ckanext.qa import quarantine
+    from ckanext.qa import sniff_cache
+    from ckanext.qa.sniff_sandbox import SniffLimitError
+    from ckanext.qa.tasks import _sniff_file_format
+
+    q = model.Session.query(Archival.resource_id, Archival.hash,
+                            Archival.cache_filepath) \
+        .filter(Archival.cache_filepath != None)  # noqa: E711
+    if ids:
+        package_ids = []
+        for id in ids:
+            pkg = model.Package.get(id)
+            if not pkg:
+                log.error('Could not recognize as a package: %r', id)
+                sys.exit(1)
+            package_ids.append(pkg.id)
+        q = q.filter(Archival.package_id.in_(package_ids))
+    archivals = q.all()
+    print('Archived files to check: %i' % len(archivals))
+    sniffed = failed = 0
+    for i, (resource_id, content_hash, filepath) in enumerate(archivals):
+        if i % 100 == 99:
+            model.Session.commit()
+        if not os.path.exists(filepath):
+            continue
+        key = sniff_cache.cache_key(content_hash, filepath)
+        quarantine_entry = None
+        if quarantine.is_enabled():
+            quarantine_entry = quarantine.get(key)
+            if quarantine.is_quarantined(quarantine_entry):
+                continue
+            if quarantine_entry:
+                sniff_cache.forget_outcomes([key])
+        try:
+            hit, format_ = sniff_cache.get(key)
+        except SniffLimitError:
+            # sniffing it failed before
+            hit = True
+        if hit:
+            continue
+        try:
+            format_ = _sniff_file_format(filepath)
+        except SniffLimitError as e:
+            log.warning('Sniffing %s exceeded a limit: %s', filepath, e)
+            if quarantine.is_enabled():
+                quarantine.record_failure(key, resource_id, e)
+            else:
+                sniff_cache.put(key, None, outcome=e.outcome)
+            failed += 1
+            continue
+        except Exception as e:
+            log.exception('Sniffing %s failed', filepath)
+            if quarantine.is_enabled():
+                quarantine.record_failure(key, resource_id, e)
+            failed += 1
+            continue
+        sniff_cache.put(key, format_)
+        if quarantine_entry:
+            quarantine.record_success(quarantine_entry)
+        sniffed += 1
+    model.Session.commit()
+    print('Sniffed %i files into the cache' % sniffed)
+    if failed:
+        print('Sniffing %i files failed' % failed)
+
+
+def rescore_formats(dry_run=False):
+    from ckanext.qa import lib
+
+    score_table = lib.get_score_table()
+    print('Score table version: %s (%s)' % (score_table.version,
+                                            score_table.filepath))
+    changes, package_ids = lib.rescore_formats(dry_run=dry_run)
+    for (format_, old_score, new_score), count in sorted(changes.items()):
+        print('* %s: %i resources %s from %s to %s' % (
+            format_, count, 'would change' if dry_run else 'changed',
+            old_score, new_score))
+    print('%i resources in %i datasets %s' % (
+        sum(changes.values()), len(package_ids),
+        'would be re-scored' if dry_run else 're-scored'))
+    if dry_run or not package_ids:
+        return
+    print('Reindexing %i datasets' % len(package_ids))
+    lib.reindex_packages(package_ids)
+    print('Done')
+
+
+def reindex_flush():
+    from ckanext.qa import reindex_buffer
+
+    if not reindex_buffer.is_enabled():
+        print('qa.reindex_buffer is not enabled')
+        sys.exit(1)
+    package_ids = reindex_buffer.flush()
+    print('Reindexed %i datasets' % len(package_ids))
+
+
+def quarantine_list(include_expired=False):
+    from ckanext.qa import quarantine
+
+    entries = quarantine.list_entries(include_expired=include_expired)
+    print('Quarantined files: %i' % len(entries))
+    for entry in entries:
+        print('* %s' % entry.key)
+        print('  resource: %s' % entry.resource_id)
+        print('  failures: %i (first %s, last %s)' % (
+            entry.failure_count, entry.first_failure, entry.last_failure))
+        print('  retry after: %s' % entry.retry_after)
+        print('  last error: %s' % entry.last_error)
+
+
+def quarantine_release(ids, release_all=False):
+    from ckanext.qa import quarantine
+
+    if not ids and not release_all:
+        print('Give the keys or resource ids to release, or --all')
+        sys.exit(1)
+    released = quarantine.release(None if release_all else ids)
+    print('%i quarantined files released' % released)
 
 
 def view(package_ref=None):
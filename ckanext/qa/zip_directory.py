@@ -0,0 +1,221 @@
+'''
+Streaming reader for the central directory of a zip file.
+
+zipfile.ZipFile reads every entry into a ZipInfo before you can look at any
+of them, which for a zip with hundreds of thousands of members takes a lot of
+memory and time. This reads the member names one at a time, directly from a
+buffer (e.g. a memory map), so that the caller can stop as soon as it has seen
+enough. Zip64 archives (over 4GB or 65535 members) are supported.
+
+It can also decompress the start of a member, for sniffing its content
+without extracting the whole of it.
+'''
+import struct
+import time
+import zlib
+
+# End of central directory record
+EOCD_SIGNATURE = b'PK\x05\x06'
+EOCD_SIZE = 22
+# the EOCD is followed by a comment of up to 64KB
+EOCD_SEARCH_SIZE = EOCD_SIZE + 0xFFFF
+# Zip64 end of central directory locator and record
+ZIP64_LOCATOR_SIGNATURE = b'PK\x06\x07'
+ZIP64_LOCATOR_SIZE = 20
+ZIP64_EOCD_SIGNATURE = b'PK\x06\x06'
+ZIP64_EOCD_SIZE = 56
+# Central directory file header
+CENTRAL_HEADER_SIGNATURE = b'PK\x01\x02'
+CENTRAL_HEADER_SIZE = 46
+# Local file header
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+LOCAL_HEADER_SIZE = 30
+# extra field with the 64 bit sizes and offset, when the 32 bit ones overflow
+ZIP64_EXTRA_ID = 0x0001
+ZIP64_OVERFLOW = 0xFFFFFFFF
+
+# general purpose flags
+FLAG_ENCRYPTED = 0x1
+FLAG_UTF8 = 0x800
+
+# compression methods
+STORED = 0
+DEFLATED = 8
+
+# compressed data is decompressed this much at a time
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class ZipDirectoryError(Exception):
+    pass
+
+
+class ZipEntry(object):
+    def __init__(self, name, flags, method, compressed_size, size,
+                 header_offset):
+        self.name = name
+        self.flags = flags
+        self.method = method
+        self.compressed_size = compressed_size
+        self.size = size
+        self.header_offset = header_offset
+
+    def __repr__(self):
+        return '<ZipEntry %r method=%s size=%s>' % (self.name, self.method,
+                                                    self.size)
+
+
+class ZipDirectory(object):
+    '''The central directory of a zip file in a buffer - anything that
+    supports len(), slicing to bytes and rfind(), such as bytes or an mmap.
+
+    Raises ZipDirectoryError if the end of central directory record cannot
+    be found or is invalid.
+    '''
+    def __init__(self, buf):
+        self.buf = buf
+        eocd_offset = self._find_eocd()
+        (disk, cd_disk, num_entries_on_disk, self.num_entries, cd_size,
+         cd_offset) = struct.unpack(
+            '<HHHHII', buf[eocd_offset + 4:eocd_offset + 20])
+        if disk != cd_disk:
+            raise ZipDirectoryError('Multi-disk zips are not supported')
+        end_of_cd = eocd_offset
+        zip64_locator_offset = eocd_offset - ZIP64_LOCATOR_SIZE
+        if zip64_locator_offset >= 0 and \
+                buf[zip64_locator_offset:zip64_locator_offset + 4] == \
+                ZIP64_LOCATOR_SIGNATURE:
+            (self.num_entries, cd_size, cd_offset, end_of_cd) = \
+                self._read_zip64_eocd(zip64_locator_offset)
+        # Data can be prepended to a zip (e.g. a self-extracting exe), which
+        # shifts all the offsets
+        self.cd_start = end_of_cd - cd_size
+        if self.cd_start < 0 or cd_offset > self.cd_start:
+            raise ZipDirectoryError('Central directory is beyond the file')
+        self.prepended_size = self.cd_start - cd_offset
+        self.cd_end = end_of_cd
+
+    def _find_eocd(self):
+        size = len(self.buf)
+        if size < EOCD_SIZE:
+            raise ZipDirectoryError('File too small to be a zip')
+        # usually there is no comment, so try that quickly first
+        offset = size - EOCD_SIZE
+        if self.buf[offset:offset + 4] == EOCD_SIGNATURE:
+            return offset
+        offset = self.buf.rfind(EOCD_SIGNATURE, max(size - EOCD_SEARCH_SIZE, 0))
+        if offset == -1 or offset + EOCD_SIZE > size:
+            raise ZipDirectoryError('End of central directory not found')
+        return offset
+
+    def _read_zip64_eocd(self, locator_offset):
+        (zip64_eocd_offset,) = struct.unpack(
+            '<Q', self.buf[locator_offset + 8:locator_offset + 16])
+        # the offset is relative to the start of the zip, which may not be the
+        # start of the file, but the record comes right before the locator
+        expected_offset = locator_offset - ZIP64_EOCD_SIZE
+        for offset in (zip64_eocd_offset, expected_offset):
+            if 0 <= offset and self.buf[offset:offset + 4] == \
+                    ZIP64_EOCD_SIGNATURE:
+                break
+        else:
+            raise ZipDirectoryError('Zip64 end of central directory not found')
+        (num_entries, cd_size, cd_offset) = struct.unpack(
+            '<QQQ', self.buf[offset + 32:offset + 56])
+        return num_entries, cd_size, cd_offset, offset
+
+    def iter_names(self):
+        '''Yields the name of each member, in the order of the central
+        directory.'''
+        for entry in self.iter_entries():
+            yield entry.name
+
+    def iter_entries(self):
+        '''Yields a ZipEntry for each member, in the order of the central
+        directory.'''
+        offset = self.cd_start
+        for _ in range(self.num_entries):
+            header = self.buf[offset:offset + CENTRAL_HEADER_SIZE]
+            if len(header) < CENTRAL_HEADER_SIZE or \
+                    header[:4] != CENTRAL_HEADER_SIGNATURE:
+                raise ZipDirectoryError('Bad central directory entry at %s'
+                                        % offset)
+            (flags, method) = struct.unpack('<HH', header[8:12])
+            (compressed_size, size, name_length, extra_length,
+             comment_length) = struct.unpack('<IIHHH', header[20:34])
+            (header_offset,) = struct.unpack('<I', header[42:46])
+            start = offset + CENTRAL_HEADER_SIZE
+            name = self.buf[start:start + name_length]
+            if len(name) < name_length or start + name_length > self.cd_end:
+                raise ZipDirectoryError('Truncated central directory')
+            if ZIP64_OVERFLOW in (compressed_size, size, header_offset):
+                extra_start = start + name_length
+                (size, compressed_size, header_offset) = self._read_zip64_extra(
+                    self.buf[extra_start:extra_start + extra_length],
+                    size, compressed_size, header_offset)
+            # the same encodings as zipfile
+            yield ZipEntry(
+                name.decode('utf-8' if flags & FLAG_UTF8 else 'cp437',
+                            'replace'),
+                flags, method, compressed_size, size, header_offset)
+            offset = start + name_length + extra_length + comment_length
+
+    def _read_zip64_extra(self, extra, size, compressed_size, header_offset):
+        offset = 0
+        while offset + 4 <= len(extra):
+            (id_, length) = struct.unpack('<HH', extra[offset:offset + 4])
+            if id_ == ZIP64_EXTRA_ID:
+                values = extra[offset + 4:offset + 4 + length]
+                # only the fields that overflowed are present, in this order
+                fields = []
+                for value in (size, compressed_size, header_offset):
+                    if value == ZIP64_OVERFLOW:
+                        start = len(fields) * 8
+                        if start + 8 > len(values):
+                            raise ZipDirectoryError('Bad zip64 extra field')
+                        value = struct.unpack('<Q', values[start:start + 8])[0]
+                    fields.append(value)
+                return tuple(fields)
+            offset += 4 + length
+        raise ZipDirectoryError('Zip64 extra field not found')
+
+    def read_prefix(self, entry, max_bytes, deadline=None):
+        '''Returns the first max_bytes of a member, decompressed.
+
+        :param deadline: time.time() after which to stop decompressing and
+                         return what there is so far
+        '''
+        if entry.flags & FLAG_ENCRYPTED:
+            raise ZipDirectoryError('Member is encrypted')
+        offset = self.prepended_size + entry.header_offset
+        header = self.buf[offset:offset + LOCAL_HEADER_SIZE]
+        if len(header) < LOCAL_HEADER_SIZE or \
+                header[:4] != LOCAL_HEADER_SIGNATURE:
+            raise ZipDirectoryError('Bad local file header at %s' % offset)
+        (name_length, extra_length) = struct.unpack('<HH', header[26:30])
+        start = offset + LOCAL_HEADER_SIZE + name_length + extra_length
+        end = start + entry.compressed_size
+        if end > len(self.buf):
+            raise ZipDirectoryError('Member is beyond the end of the file')
+        if entry.method == STORED:
+            return self.buf[start:min(end, start + max_bytes)]
+        if entry.method != DEFLATED:
+            raise ZipDirectoryError('Unsupported compression method %s'
+                                    % entry.method)
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        data = []
+        length = 0
+        while start < end and length < max_bytes:
+            if deadline is not None and time.time() > deadline:
+                break
+            chunk = self.buf[start:min(start + READ_CHUNK_SIZE, end)]
+            start += len(chunk)
+            try:
+                # max_length bounds the output, however compressible the data
+                decompressed = decompressor.decompress(chunk,
+                                                       max_bytes - length)
+            except zlib.error as e:
+                raise ZipDirectoryError('Could not decompress member: %s' % e)
+            data.append(decompressed)
+            length += len(decompressed)
+        return b''.join(data)